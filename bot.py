@@ -5,6 +5,8 @@
 from modules import models
 from modules import initialize_data
 from modules import utilities
+from modules import name_index
+from modules import channels
 import settings
 import logging
 import sys
@@ -217,6 +219,8 @@ async def on_ready():
         for g in bot.guilds:
             if g.id in settings.config:
                 logger.debug(f'Loaded in guild {g.id} {g.name}')
+                name_index.build_member_index(g)
+                channels.rebuild_category_index(g)
             else:
                 logger.error(f'Unauthorized guild {g.id} {g.name} not found in settings.py configuration - Leaving...')
                 await g.leave()
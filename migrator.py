@@ -43,9 +43,16 @@
 # team_chan_external_server = BitField(unique=False, null=True, default=None)
 # tribe_direct = ForeignKeyField(Tribe, null=True, on_delete='SET NULL', field=Tribe.id)
 # emoji = TextField(null=False, default='')
-elo_after_game_global = SmallIntegerField(default=None, null=True)
-team_elo_after_game = SmallIntegerField(default=None, null=True)
-team_elo_after_game_alltime = SmallIntegerField(default=None, null=True)
+# elo_after_game_global = SmallIntegerField(default=None, null=True)
+# team_elo_after_game = SmallIntegerField(default=None, null=True)
+# team_elo_after_game_alltime = SmallIntegerField(default=None, null=True)
+# player_signature = TextField(null=True)
+# member_signature = TextField(null=True)
+# player_count = SmallIntegerField(default=0)
+# is_full = BooleanField(default=False)
+# elo_min = SmallIntegerField(default=0)
+# elo_max = SmallIntegerField(default=3000)
+# is_invite_only = BooleanField(default=False)
 
 migrate(
     # migrator.add_column('discordmember', 'elo_max', elo_max),
@@ -62,11 +69,79 @@
     # migrator.add_column('team', 'external_server', external_server)
     # migrator.add_column('lineup', 'tribe_direct_id', tribe_direct)
     # migrator.drop_column('tribe', 'emoji'),
-    migrator.add_column('lineup', 'elo_after_game_global', elo_after_game_global),
-    migrator.add_column('gameside', 'team_elo_after_game', team_elo_after_game),
-    migrator.add_column('gameside', 'team_elo_after_game_alltime', team_elo_after_game_alltime)
-
+    # migrator.add_column('lineup', 'elo_after_game_global', elo_after_game_global),
+    # migrator.add_column('gameside', 'team_elo_after_game', team_elo_after_game),
+    # migrator.add_column('gameside', 'team_elo_after_game_alltime', team_elo_after_game_alltime)
+    # migrator.add_column('gameside', 'player_signature', player_signature),
+    # migrator.add_index('gameside', ('player_signature',), False)
+    # migrator.add_column('squad', 'member_signature', member_signature),
+    # migrator.add_index('squadmember', ('player_id', 'squad_id'), False)
+    # migrator.add_column('gameside', 'player_count', player_count),
+    # migrator.add_column('gameside', 'is_full', is_full),
+    # migrator.add_column('game', 'is_full', is_full)
+    # migrator.add_column('game', 'elo_min', elo_min),
+    # migrator.add_column('game', 'elo_max', elo_max),
+    # migrator.add_column('game', 'global_elo_min', elo_min),
+    # migrator.add_column('game', 'global_elo_max', elo_max),
+    # migrator.add_column('game', 'is_invite_only', is_invite_only)
 )
 
+# Trigram indexes used by Game.search(title_filter=...) so ILIKE '%...%' on name/notes can use an index instead of a seq scan
+# CREATE EXTENSION needs a superuser or a trusted extension (postgres 13+)
+# db.execute_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+# db.execute_sql('CREATE INDEX IF NOT EXISTS game_name_trgm ON game USING gin (name gin_trgm_ops);')
+# db.execute_sql('CREATE INDEX IF NOT EXISTS game_notes_trgm ON game USING gin (notes gin_trgm_ops);')
+
+# Backfill GameSide.player_signature - must match GameSide.signature_for()
+# db.execute_sql("""UPDATE gameside SET player_signature = s.signature FROM (
+#                     SELECT gameside_id, md5(string_agg(player_id::text, ',' ORDER BY player_id)) AS signature FROM lineup GROUP BY gameside_id
+#                   ) s WHERE gameside.id = s.gameside_id;""")
+
+# Backfill Squad.member_signature before adding its unique index. If older rows contain duplicate squads with identical members
+# only the lowest squad id gets the signature (and so is the one Squad.upsert returns from now on), the rest stay NULL
+# db.execute_sql("""UPDATE squad SET member_signature = s.signature FROM (
+#                     SELECT DISTINCT ON (signature) squad_id, signature FROM (
+#                         SELECT squad_id, md5(string_agg(player_id::text, ',' ORDER BY player_id)) AS signature FROM squadmember GROUP BY squad_id
+#                     ) sigs ORDER BY signature, squad_id
+#                   ) s WHERE squad.id = s.squad_id;""")
+#
+# migrate(
+#     migrator.add_index('squad', ('member_signature',), True)
+# )
+
+# Backfill capacity counters maintained by Game.update_capacity(), then add the partial index used for the open game list
+# db.execute_sql('UPDATE gameside SET player_count = (SELECT COUNT(*) FROM lineup WHERE lineup.gameside_id = gameside.id);')
+# db.execute_sql('UPDATE gameside SET is_full = (player_count >= size);')
+# db.execute_sql('UPDATE game SET is_full = NOT EXISTS (SELECT 1 FROM gameside WHERE gameside.game_id = game.id AND NOT gameside.is_full);')
+# db.execute_sql('CREATE INDEX IF NOT EXISTS game_pending_guild_full ON game (guild_id, is_full) WHERE is_pending;')
+
+# Parse restrictions out of the notes of existing open games - must match Game.restrictions_from_notes() and Game.update_restrictions()
+# The gameinvitee table would otherwise only be created by models.py on the next bot start
+# db.execute_sql('CREATE TABLE IF NOT EXISTS gameinvitee (id SERIAL PRIMARY KEY, game_id INTEGER NOT NULL REFERENCES game (id) ON DELETE CASCADE, discord_id BIGINT NOT NULL);')
+# db.execute_sql('CREATE INDEX IF NOT EXISTS gameinvitee_game_id ON gameinvitee (game_id);')
+# db.execute_sql('CREATE INDEX IF NOT EXISTS gameinvitee_discord_id ON gameinvitee (discord_id);')
+# db.execute_sql(r"""UPDATE game SET
+#                     elo_min = COALESCE(LEAST(substring(notes from '(?i)(\d+) elo min')::bigint, 32767), 0),
+#                     elo_max = COALESCE(LEAST(substring(notes from '(?i)(\d+) elo max')::bigint, 32767), 3000),
+#                     global_elo_min = COALESCE(LEAST(substring(notes from '(?i)(\d+) global elo min')::bigint, 32767), 0),
+#                     global_elo_max = COALESCE(LEAST(substring(notes from '(?i)(\d+) global elo max')::bigint, 32767), 3000)
+#                   WHERE is_pending AND notes IS NOT NULL;""")
+# db.execute_sql(r"""INSERT INTO gameinvitee (game_id, discord_id)
+#                   SELECT DISTINCT game.id, m[1]::bigint FROM game, regexp_matches(game.notes, '<@!?(\d+)>', 'g') AS m WHERE game.is_pending;""")
+# db.execute_sql("""UPDATE game SET is_invite_only = (i.invitees >= c.capacity - 1) FROM
+#                     (SELECT game_id, COUNT(*) AS invitees FROM gameinvitee GROUP BY game_id) i,
+#                     (SELECT game_id, SUM(size) AS capacity FROM gameside GROUP BY game_id) c
+#                   WHERE game.id = i.game_id AND game.id = c.game_id;""")
+# db.execute_sql('CREATE INDEX IF NOT EXISTS game_pending_elo ON game (elo_min, elo_max, global_elo_min, global_elo_max) WHERE is_pending;')
 
+# Game.creator - first player on side 1, maintained by Game.update_capacity()
+# db.execute_sql('ALTER TABLE game ADD COLUMN IF NOT EXISTS creator_id INTEGER REFERENCES player (id) ON DELETE SET NULL;')
+# db.execute_sql('CREATE INDEX IF NOT EXISTS game_creator_id ON game (creator_id);')
+# db.execute_sql("""UPDATE game SET creator_id = s.player_id FROM (
+#                     SELECT DISTINCT ON (lineup.game_id) lineup.game_id, lineup.player_id FROM lineup
+#                     JOIN gameside ON lineup.gameside_id = gameside.id WHERE gameside.position = 1 ORDER BY lineup.game_id, lineup.id
+#                   ) s WHERE game.id = s.game_id;""")
+# db.execute_sql('CREATE INDEX IF NOT EXISTS game_pending_full_creator ON game (creator_id) WHERE is_pending AND is_full;')
 
+# Partial index for Game.purge_expired_games(), which deletes pending games by expiration
+db.execute_sql('CREATE INDEX IF NOT EXISTS game_pending_expiration ON game (expiration) WHERE is_pending;')
@@ -3,8 +3,9 @@
 import logging
 # import asyncio
 import modules.models as models
+import modules.outbound as outbound
 import settings
-import peewee
+# import peewee
 logger = logging.getLogger('polybot.' + __name__)
 
 # platinum - 1500
@@ -16,7 +17,28 @@
 # ELO Champion - #1 local or global leaderboard
 
 
+_champions = {}  # guild_id: {member id: reason} for who should hold ELO Champion there, as of the last set_champion_role()
+
+
+async def sync_champion_role(guild, member_id: int):
+    # Queued per member. Decides whether to add or remove the role when it runs, from the latest _champions and the member's roles at that time,
+    # so jobs queued by an earlier set_champion_role() can not undo a later one
+    role = discord.utils.get(guild.roles, name='ELO Champion')
+    member = guild.get_member(member_id)
+    if not role or not member:
+        return
+    reason = _champions.get(guild.id, {}).get(member_id)
+    if reason and role not in member.roles:
+        logger.info(f'adding ELO Champion role to {member.name}')
+        await member.add_roles(role, reason=reason)
+    elif not reason and role in member.roles:
+        logger.info(f'removing ELO Champion role from {member.name}')
+        await member.remove_roles(role, reason='Recurring reset of champion list')
+
+
 async def set_champion_role():
+    # Works out who should hold the ELO Champion role in each guild and queues a role check for members where that may differ
+    # from who holds it now. Changes go through the outbound queue, so guilds are handled concurrently within its rate limits
 
     # global_champion = models.DiscordMember.select().order_by(-models.DiscordMember.elo).limit(1).get()
     global_champion = models.DiscordMember.leaderboard(date_cutoff=settings.date_cutoff, guild_id=None, max_flag=False).limit(1).get()
@@ -34,26 +56,52 @@ async def set_champion_role():
         local_champion_member = guild.get_member(local_champion.discord_member.discord_id)
         global_champion_member = guild.get_member(global_champion.discord_id)
 
-        for old_champion in role.members:
-            await old_champion.remove_roles(role, reason='Recurring reset of champion list')
-            logger.info(f'removing ELO Champion role from {old_champion.name}')
-
-        if local_champion_member:
-            logger.info(f'adding ELO Champion role to {local_champion_member.name}')
-            await local_champion_member.add_roles(role, reason='Local champion')
-        else:
+        if not local_champion_member:
             logger.warn(f'Couldnt find local champion {local_champion} in guild {guild.name}!')
+        if not global_champion_member:
+            logger.warn(f'Couldnt find global champion {global_champion.name} in guild {guild.name}!')
 
+        champions = {}
         if global_champion_member:
-            logger.info(f'adding ELO Champion role to {global_champion_member.name}')
-            await global_champion_member.add_roles(role, reason='Global champion')
-        else:
-            logger.warn(f'Couldnt find global champion {global_champion.name} in guild {guild.name}!')
+            champions[global_champion_member.id] = 'Global champion'
+        if local_champion_member:
+            champions[local_champion_member.id] = 'Local champion'
+
+        # Previous champions are included since a job adding the role to them may still be queued
+        previous_champions = _champions.get(guild.id, {})
+        _champions[guild.id] = champions
+        current_holders = {member.id for member in role.members}
+        if current_holders == set(champions) and set(previous_champions) <= current_holders:
+            logger.debug(f'ELO Champion role unchanged in guild {guild.name}')
+            continue
+
+        for member_id in current_holders | set(champions) | set(previous_champions):
+            outbound.submit(lambda g=guild, m=member_id: sync_champion_role(g, m), route=('member_roles', guild.id),
+                            lane=outbound.MAINTENANCE, coalesce_key=('champion', guild.id, member_id),
+                            description=f'champion role check for member {member_id}')
+
+
+_experience_role_ids = {}  # guild_id: {role name: role id} for the experience roles that exist in that guild
+experience_role_names = ['ELO Rookie', 'ELO Player', 'ELO Veteran', 'ELO Hero']
+
+
+def experience_roles(guild):
+    # Role names are resolved once per guild. Cleared by the role listeners in the games cog when a guild's roles change
+    role_ids = _experience_role_ids.get(guild.id)
+    if role_ids is None:
+        roles = [discord.utils.get(guild.roles, name=name) for name in experience_role_names]
+        role_ids = _experience_role_ids[guild.id] = {role.name: role.id for role in roles if role}
+    return {name: guild.get_role(role_id) for name, role_id in role_ids.items()}
+
+
+def clear_role_cache(guild_id: int):
+    _experience_role_ids.pop(guild_id, None)
 
 
 async def set_experience_role(discord_member):
     logger.debug(f'processing experience role for member {discord_member.name}')
     completed_games = discord_member.completed_game_count(only_ranked=False)
+    is_champion = False
 
     for guildmember in list(discord_member.guildmembers):
         guild = discord.utils.get(settings.bot.guilds, id=guildmember.guild_id)
@@ -62,35 +110,41 @@ async def set_experience_role(discord_member):
         if not member:
             continue
 
+        guild_roles = experience_roles(guild)
         role_list = []
 
         role = None
         if completed_games >= 2:
-            role = discord.utils.get(guild.roles, name='ELO Rookie')
+            role = guild_roles.get('ELO Rookie')
             role_list.append(role) if role is not None else None
         if completed_games >= 10:
-            role = discord.utils.get(guild.roles, name='ELO Player')
+            role = guild_roles.get('ELO Player')
             role_list.append(role) if role is not None else None
         if discord_member.elo_max >= 1200:
-            role = discord.utils.get(guild.roles, name='ELO Veteran')
+            role = guild_roles.get('ELO Veteran')
             role_list.append(role) if role is not None else None
         if discord_member.elo_max >= 1350:
-            role = discord.utils.get(guild.roles, name='ELO Hero')
+            role = guild_roles.get('ELO Hero')
             role_list.append(role) if role is not None else None
 
         if not role:
             continue
 
         if role not in member.roles:
-            if role not in role_list or len(role_list) > 1:
-                await member.remove_roles(*role_list)
-                logger.info(f'removing roles from member {member}:\n:{role_list}')
-            await member.add_roles(role)
-            logger.info(f'adding role {role} to member {member}')
-
-        max_local_elo = models.Player.select(peewee.fn.Max(models.Player.elo)).where(models.Player.guild_id == guild.id).scalar()
-        max_global_elo = models.DiscordMember.select(peewee.fn.Max(models.DiscordMember.elo)).scalar()
-
-        if discord_member.elo >= max_global_elo or guildmember.elo >= max_local_elo:
-            # This player has #1 spot in either local OR global leaderboard. Apply ELO Champion role on any server where the player is:
-            await set_champion_role()
+            async def update_roles(member, role, role_list):
+                if role not in role_list or len(role_list) > 1:
+                    await member.remove_roles(*role_list)
+                    logger.info(f'removing roles from member {member}:\n:{role_list}')
+                await member.add_roles(role)
+                logger.info(f'adding role {role} to member {member}')
+
+            outbound.submit(lambda m=member, r=role, rl=role_list: update_roles(m, r, rl), route=('member_roles', guild.id), lane=outbound.MAINTENANCE,
+                            coalesce_key=('experience', guild.id, member.id), description=f'experience role for member {member.id}')
+
+        if discord_member.elo >= models.max_elo() or guildmember.elo >= models.max_elo(guild.id):
+            # This player has #1 spot in either local OR global leaderboard
+            is_champion = True
+
+    if is_champion:
+        # Apply ELO Champion role on any server where the player is. set_champion_role() covers every guild so it only needs to run once
+        await set_champion_role()
@@ -1,6 +1,8 @@
 from discord.ext import commands
 import modules.models as models
 import modules.utilities as utilities
+import modules.name_index as name_index
+import modules.outbound as outbound
 import settings
 import logging
 import peewee
@@ -362,7 +364,7 @@ async def unstart(self, ctx, game: PolyGame = None):
 
         if game.announcement_message:
             game.name = f'~~{game.name}~~ GAME CANCELLED'
-            await game.update_announcement(guild=ctx.guild, prefix=ctx.prefix)
+            await game.update_announcement(guild=ctx.guild, prefix=ctx.prefix, immediate=True)
 
         await game.delete_game_channels(self.bot.guilds, ctx.guild.id)
 
@@ -658,6 +660,7 @@ async def migrate_player(self, ctx, from_string: str, to_string: str):
             logger.warn(f'Migrating player profile of ID {from_id} {old_discord_member.name} to new guild member {new_guild_member.id}{new_guild_member.name} with existing incomplete games')
 
             with models.db.atomic():
+                pending_games = list(new_discord_member.pending_games()) + list(old_discord_member.pending_games())
                 for gm in new_discord_member.guildmembers:
                     old_gm = models.Player.get_or_none(discord_member=old_discord_member, guild_id=gm.guild_id)
                     if old_gm:
@@ -666,6 +669,8 @@ async def migrate_player(self, ctx, from_string: str, to_string: str):
                             # cycle through new incomplete games and switch to the old player
                             l.player = old_gm
                             l.save()
+                            l.gameside.update_signature()
+                        models.Game.update(creator=old_gm).where(models.Game.creator == gm).execute()
                     else:
                         # New account in this guild but old account not
                         # associate its player in this guild with the old account
@@ -679,6 +684,11 @@ async def migrate_player(self, ctx, from_string: str, to_string: str):
                 old_discord_member.save()
                 old_discord_member.update_name(new_name=new_guild_member.name)
 
+                for game in pending_games:
+                    game.update_capacity()  # creator and side counts can change with the moved or deleted Lineups
+
+            name_index.clear_player_indexes()
+            models.clear_max_elo()
             return await ctx.send('Migration complete!')
 
         else:
@@ -693,6 +703,7 @@ async def migrate_player(self, ctx, from_string: str, to_string: str):
                 old_discord_member.save()
                 old_discord_member.update_name(new_name=new_guild_member.name)
 
+            name_index.clear_player_indexes()
             await ctx.send('Migration complete!')
 
     @commands.command(aliases=['delplayer'])
@@ -721,7 +732,16 @@ async def delete_player(self, ctx, *, args=None):
             return await ctx.send(f'DiscordMember {discord_member.name} was found but has {player_games} associated ELO games. Can only delete players with zero games.')
 
         name = discord_member.name
-        discord_member.delete_instance()
+        with models.db.atomic():
+            # Lineup.player is ON DELETE RESTRICT, so the member's places in open games are removed first
+            pending_games = list(discord_member.pending_games())
+            models.Lineup.delete().where(
+                (models.Lineup.game.in_(pending_games)) & (models.Lineup.player.in_(list(discord_member.guildmembers)))
+            ).execute()
+            discord_member.delete_instance()
+            for game in pending_games:
+                game.update_capacity()
+        models.clear_max_elo()
         await ctx.send(f'Deleting DiscordMember {name} with discord ID `{player_id}` from ELO database. They have zero games associated with their profile.')
 
     @commands.command(aliases=['dbb'])
@@ -742,6 +762,20 @@ async def backup_db(self, ctx):
                 logger.error('Error during execution')
                 return await ctx.send(f'Error during execution: {str(process.stderr)}')
 
+    @settings.is_mod_check()
+    @commands.command(aliases=['queuestats'])
+    async def outbound_stats(self, ctx):
+        """*Mod*: Show depth, latency and counts for the queue of outgoing Discord operations
+        """
+        stats = outbound.stats()
+        depth_str = ', '.join(f'{lane}: {depth}' for lane, depth in stats['depth'].items())
+        counts_str = ', '.join(f'{name}: {count}' for name, count in sorted(stats['counts'].items())) or 'none'
+
+        await ctx.send(f'**Queued:** {depth_str} (max {stats["max_depth"]}), {stats["running"]} running, {stats["throttled_routes"]} routes throttled\n'
+                       f'**Wait:** {stats["wait"][0]:.2f}s average, {stats["wait"][1]:.2f}s max\n'
+                       f'**Run:** {stats["run"][0]:.2f}s average, {stats["run"][1]:.2f}s max\n'
+                       f'**Operations:** {counts_str}')
+
 
 def setup(bot):
     bot.add_cog(administration(bot))
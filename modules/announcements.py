@@ -0,0 +1,84 @@
+import asyncio
+import collections
+import time
+import discord
+import modules.outbound as outbound
+import logging
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# Debounced edits of new game announcement messages (see models.Game.update_announcement()).
+# An update waits debounce_delay seconds before rendering, and any further update for the same game in that time replaces it,
+# so a burst of joins/settribes/renames is rendered and edited once. A steady stream of updates still gets one edit at least every
+# max_debounce_wait seconds. Announcement message objects are cached so edits do not
+# need a fetch first. This module does not import models - callers pass a render() function that returns (embed, content).
+
+debounce_delay = 5  # seconds
+max_debounce_wait = 30  # seconds from the first update that has not been applied yet
+max_cached_messages = 500
+
+_pending = {}  # game_id: asyncio.Task of a debounced update
+_first_pending = {}  # game_id: time.monotonic() of the oldest update not applied yet
+_messages = collections.OrderedDict()  # message_id: discord.Message or discord.PartialMessage, least recently used first
+
+
+async def announcement_message(channel, message_id: int):
+    message = _messages.get(message_id)
+    if message is not None:
+        _messages.move_to_end(message_id)
+        return message
+
+    if hasattr(channel, 'get_partial_message'):
+        # discord.py 1.6+ can edit a message from its id alone
+        message = channel.get_partial_message(message_id)
+    else:
+        message = await channel.fetch_message(message_id)
+
+    _messages[message_id] = message
+    if len(_messages) > max_cached_messages:
+        _messages.popitem(last=False)
+    return message
+
+
+async def schedule_update(game_id: int, channel, message_id: int, render, immediate: bool = False):
+    # immediate=True cancels any waiting update and applies this one now, returning once the edit is done
+    pending = _pending.pop(game_id, None)
+    if pending is not None:
+        pending.cancel()
+
+    if immediate:
+        _first_pending.pop(game_id, None)
+        return await apply_update(game_id, channel, message_id, render)
+
+    now = time.monotonic()
+    first = _first_pending.setdefault(game_id, now)
+    delay = min(debounce_delay, max(0, first + max_debounce_wait - now))
+    _pending[game_id] = asyncio.ensure_future(debounced_update(game_id, channel, message_id, render, delay))
+
+
+async def debounced_update(game_id: int, channel, message_id: int, render, delay: float):
+    await asyncio.sleep(delay)
+    del _pending[game_id]  # no await since the sleep, so this is still this task's entry
+    del _first_pending[game_id]
+    await apply_update(game_id, channel, message_id, render)
+
+
+async def apply_update(game_id: int, channel, message_id: int, render):
+    try:
+        message = await announcement_message(channel, message_id)
+    except discord.DiscordException:
+        return logger.warn('Couldn\'t get message in update_announacement')
+
+    try:
+        embed, content = render()
+    except Exception as e:
+        return logger.warn(f'Couldn\'t render announcement for game {game_id}: {e}')
+
+    try:
+        await outbound.submit(lambda: message.edit(embed=embed, content=content), route=('send', channel.id), lane=outbound.GAME,
+                              description=f'announcement for game {game_id}')
+    except discord.NotFound:
+        _messages.pop(message_id, None)
+        logger.warn('Couldn\'t update message in update_announacement - message no longer exists')
+    except discord.DiscordException:
+        return logger.warn('Couldn\'t update message in update_announacement')
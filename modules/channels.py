@@ -1,10 +1,11 @@
 import discord
-# import asyncio
+import asyncio
 # from discord.ext import commands
 import settings
 # import peewee
 # import modules.models as models
 import modules.exceptions as exceptions
+import modules.outbound as outbound
 import logging
 
 logger = logging.getLogger('polybot.' + __name__)
@@ -32,52 +33,155 @@ def generate_channel_name(game_id, game_name: str, team_name: str = None):
     return chan_name
 
 
+max_category_channels = 50  # Discord limit on channels in one category
+
+_category_indexes = {}  # guild_id: CategoryIndex
+
+
+class CategoryIndex:
+    # Channel counts for every category in one guild, and which categories are candidates for each team name, so that
+    # get_channel_category() does not need to walk guild.categories or build cat.channels for every side of every game.
+    # Kept current by the on_guild_channel_* listeners in the games cog. Slots can be reserved while a channel is being created,
+    # so several games starting at once do not all pick the last free slot in a category.
+
+    def __init__(self, guild):
+        self.guild_id = guild.id
+        self.category_names = {cat.id: cat.name.lower() for cat in guild.categories}  # category_id: lowercased name, in guild order
+        self.channel_counts = {cat_id: 0 for cat_id in self.category_names}  # category_id: channels in category
+        self.reserved = {}  # category_id: channels being created
+        self.channel_categories = {}  # channel_id: category_id
+        self.text_channel_ids = set()
+        self.team_candidates = {}  # (team_name_lc, using_team_server_flag): list of category_id in order of preference
+
+        for chan in guild.channels:
+            self.add_channel(chan)
+
+    def add_category(self, category):
+        self.category_names[category.id] = category.name.lower()
+        self.channel_counts.setdefault(category.id, 0)
+        self.team_candidates.clear()
+
+    def remove_category(self, category_id: int):
+        self.category_names.pop(category_id, None)
+        self.channel_counts.pop(category_id, None)
+        self.reserved.pop(category_id, None)
+        self.team_candidates.clear()
+
+    def add_channel(self, chan):
+        if isinstance(chan, discord.CategoryChannel):
+            return self.add_category(chan)
+        self.remove_channel(chan.id)
+        if isinstance(chan, discord.TextChannel):
+            self.text_channel_ids.add(chan.id)
+        if chan.category_id:
+            self.channel_categories[chan.id] = chan.category_id
+            self.channel_counts[chan.category_id] = self.channel_counts.get(chan.category_id, 0) + 1
+
+    def remove_channel(self, channel_id: int):
+        self.text_channel_ids.discard(channel_id)
+        category_id = self.channel_categories.pop(channel_id, None)
+        if category_id in self.channel_counts:
+            self.channel_counts[category_id] -= 1
+
+    def is_full(self, category_id: int):
+        return self.channel_counts.get(category_id, 0) + self.reserved.get(category_id, 0) >= max_category_channels
+
+    def reserve(self, category_id: int):
+        self.reserved[category_id] = self.reserved.get(category_id, 0) + 1
+
+    def release(self, category_id: int):
+        if self.reserved.get(category_id, 0) > 1:
+            self.reserved[category_id] -= 1
+        else:
+            self.reserved.pop(category_id, None)
+
+    def candidates(self, team_name: str, using_team_server_flag: bool):
+        # Same preference order as the original scans of guild.categories, worked out once per team name until categories change:
+        # categories like 'Polychamps Ronin Games', then any category with 'Ronin' in the name, then 'Polychamps Other' for mixed teams
+        team_name_lc = team_name.lower().replace('the', '').strip()  # The Ronin > ronin
+        key = (team_name_lc, team_name in generic_team_names() and using_team_server_flag)
+        if key not in self.team_candidates:
+            cats = self.category_names.items()
+            candidates = [cat_id for cat_id, name in cats if 'polychamp' in name and team_name_lc in name]
+            candidates += [cat_id for cat_id, name in cats if team_name_lc in name and cat_id not in candidates]
+            if key[1]:
+                candidates += [cat_id for cat_id, name in cats if 'polychamp' in name and 'other' in name and cat_id not in candidates]
+            self.team_candidates[key] = candidates
+        return self.team_candidates[key]
+
+
+def generic_team_names():
+    return [a[0] for a in settings.generic_teams_long] + [a[0] for a in settings.generic_teams_short]
+
+
+def category_index(guild):
+    # Built on first use for each guild
+    index = _category_indexes.get(guild.id)
+    if index is None:
+        index = _category_indexes[guild.id] = CategoryIndex(guild)
+        logger.debug(f'Built category index for guild {guild.id} with {len(index.category_names)} categories')
+    return index
+
+
+def rebuild_category_index(guild):
+    # Called from on_ready, since channel events missed while disconnected would leave the counts wrong. Reservations for
+    # channels still being created carry over to the new index
+    old_index = _category_indexes.get(guild.id)
+    index = _category_indexes[guild.id] = CategoryIndex(guild)
+    if old_index:
+        index.reserved = {cat_id: count for cat_id, count in old_index.reserved.items() if cat_id in index.category_names}
+    logger.debug(f'Rebuilt category index for guild {guild.id} with {len(index.category_names)} categories')
+
+
+def update_category_index(channel, removed: bool = False):
+    # Called from guild channel create/update/delete events. Guilds whose index has not been built yet will pick the change up when it is
+    index = _category_indexes.get(channel.guild.id)
+    if not index:
+        return
+    if removed and isinstance(channel, discord.CategoryChannel):
+        index.remove_category(channel.id)
+    elif removed:
+        index.remove_channel(channel.id)
+    else:
+        index.add_channel(channel)
+
+
+def text_channel_count(guild):
+    return len(category_index(guild).text_channel_ids)
+
+
 def get_channel_category(guild, team_name: str = None, using_team_server_flag: bool = False):
     # Returns (DiscordCategory, Bool_IsTeamCategory?) or None
     # Bool_IsTeamCategory? == True if its using a team-specific category, False if using a central games category
+    # Fullness counts reserved slots, so callers creating a channel should reserve one on category_index(guild) before their first await
 
-    list_of_generic_team_names = [a[0] for a in settings.generic_teams_long] + [a[0] for a in settings.generic_teams_short]
+    index = category_index(guild)
 
     if guild.me.guild_permissions.manage_channels is not True:
         logger.warn('manage_channels permission is false.')  # TODO: change this to see if bot has this perm in the category it selects
         # return None, None
 
     if team_name:
-        team_name_lc = team_name.lower().replace('the', '').strip()  # The Ronin > ronin
-        # first seek a category named something like 'Polychamps Ronin Games', fallback to any category with 'Ronin' in the name.
-        for cat in guild.categories:
-            if 'polychamp' in cat.name.lower() and team_name_lc in cat.name.lower():
-                logger.debug(f'Using {cat.id} - {cat.name} as a team channel category')
-                if len(cat.channels) >= 50:
-                    logger.warn(f'Chosen category is full - falling back')
-                    continue
-                return cat, True
-        for cat in guild.categories:
-            if team_name_lc in cat.name.lower():
-                logger.debug(f'Using {cat.id} - {cat.name} as a team channel category')
-                if len(cat.channels) >= 50:
-                    logger.warn(f'Chosen category is full - falling back')
-                    continue
-                return cat, True
-        if team_name in list_of_generic_team_names and using_team_server_flag:
-            for cat in guild.categories:
-                if 'polychamp' in cat.name.lower() and 'other' in cat.name.lower():
-                    logger.debug(f'Mixed team - Using {cat.id} - {cat.name} as a team channel category')
-                    if len(cat.channels) >= 50:
-                        logger.warn(f'Chosen category is full - falling back')
-                        continue
-                    return cat, True
+        for cat_id in index.candidates(team_name, using_team_server_flag):
+            cat = guild.get_channel(cat_id)
+            if cat is None:
+                continue
+            logger.debug(f'Using {cat.id} - {cat.name} as a team channel category')
+            if index.is_full(cat_id):
+                logger.warn(f'Chosen category is full - falling back')
+                continue
+            return cat, True
 
     # No team category found - using default category. ie. intermingled home/away games or channel for entire game
 
     for game_channel_category in settings.guild_setting(guild.id, 'game_channel_categories'):
 
-        chan_category = discord.utils.get(guild.categories, id=int(game_channel_category))
+        chan_category = guild.get_channel(int(game_channel_category))
         if chan_category is None:
             logger.warn(f'chans_category_id {game_channel_category} was supplied but cannot be loaded')
             continue
 
-        if len(chan_category.channels) >= 50:
+        if index.is_full(chan_category.id):
             logger.warn(f'chans_category_id {game_channel_category} was supplied but is full')
             continue
 
@@ -88,7 +192,8 @@ def get_channel_category(guild, team_name: str = None, using_team_server_flag: b
     return None, None
 
 
-async def create_game_channel(guild, game, player_list, team_name: str = None, using_team_server_flag: bool = False):
+async def create_game_channel(guild, game, player_list, team_name: str = None, using_team_server_flag: bool = False, topic: str = None):
+    # topic is set as part of the create call, saving a separate edit (which counts against the channel's edit rate limit)
     chan_cat, team_cat_flag = get_channel_category(guild, team_name, using_team_server_flag)
     if chan_cat is None:
         logger.error(f'in create_squad_channel - cannot proceed due to None category')
@@ -118,7 +223,12 @@ async def create_game_channel(guild, game, player_list, team_name: str = None, u
     for m in chan_members + [guild.me]:
         chan_permissions[m] = perm
     try:
-        new_chan = await guild.create_text_channel(name=chan_name, overwrites=chan_permissions, category=chan_cat, reason='ELO Game chan')
+        # Hold a slot in the category until the channel exists, so concurrent game starts see it as taken
+        category_index(guild).reserve(chan_cat.id)
+        # REPLY lane since the command that created the game is waiting on its channels. Up to outbound.route_concurrency['channel_create'] run at once per guild
+        new_chan = await outbound.submit(lambda: guild.create_text_channel(name=chan_name, overwrites=chan_permissions, category=chan_cat, reason='ELO Game chan',
+                                                                           topic=topic[:1024] if topic else None),
+                                         route=('channel_create', guild.id), lane=outbound.REPLY, description=f'create channel {chan_name}')
     except (discord.errors.Forbidden, discord.errors.HTTPException) as e:
         logger.error(f'Exception in create_game_channels:\n{e} - Status {e.status}, Code {e.code}: {e.text}')
         raise exceptions.MyBaseException(e)
@@ -127,12 +237,15 @@ async def create_game_channel(guild, game, player_list, team_name: str = None, u
         logger.error(f'Exception in create_game_channels:\n{e}')
         raise exceptions.MyBaseException(e)
         # return None
+    finally:
+        category_index(guild).release(chan_cat.id)  # looked up again in case the index was rebuilt in the meantime
+    category_index(guild).add_channel(new_chan)  # in case the channel create event has not been processed yet
     logger.debug(f'Created channel {new_chan.name}')
 
     return new_chan
 
 
-async def greet_game_channel(guild, chan, roster_names, game, player_list, full_game: bool = False):
+def game_channel_greeting(roster_names, game, player_list, full_game: bool = False):
 
     chan_mentions = [f'<@{p.discord_member.discord_id}>' for p in player_list]
 
@@ -149,42 +262,79 @@ async def greet_game_channel(guild, chan, roster_names, game, player_list, full_
     else:
         match_content = ''
 
-    greeting_message = (f'This is the {chan_type_str} for game **{game.name}**, ID {game.id}.\n{allies_str}'
+    return (f'This is the {chan_type_str} for game **{game.name}**, ID {game.id}.\n{allies_str}'
             f'The teams for this game are:\n{roster_names}\n\n'
             f'{match_content}'
             '*This channel will self-destruct soon after the game is marked as concluded.*')
 
-    try:
-        await chan.send(greeting_message)
-        await chan.edit(topic=greeting_message[:1024], reason='Add topic')
-    except (discord.errors.Forbidden, discord.errors.HTTPException) as e:
-        logger.error(f'Could not send to created channel:\n{e} - Status {e.status}, Code {e.code}: {e.text}')
 
+def greet_game_channel(chan, greeting_message: str):
+    # The same message is used as the channel topic, which is set by create_game_channel()
+    # Queued rather than awaited - failures are logged by the outbound queue
+    outbound.submit(lambda: chan.send(greeting_message), route=('send', chan.id), lane=outbound.GAME, description=f'greet channel {chan.id}')
 
-async def delete_game_channel(guild, channel_id: int):
 
-    try:
-        chan = await settings.bot.fetch_channel(channel_id)
-    except discord.DiscordException as e:
-        logger.warn(f'Could not retrieve channel with id {channel_id}: {e}')
-        return
+async def delete_game_channel(guild, channel_id: int):
+    # Returns once the channel is deleted (or could not be). Deletions are run by the outbound queue, which limits how many run at once
+
+    async def delete():
+        chan = guild.get_channel(channel_id)  # cached copy, if discord.py has one
+        if chan is None:
+            try:
+                chan = await settings.bot.fetch_channel(channel_id)
+            except discord.DiscordException as e:
+                logger.warn(f'Could not retrieve channel with id {channel_id}: {e}')
+                return
+
+        try:
+            logger.warn(f'Deleting channel {chan.name}')
+            await chan.delete(reason='Game concluded')
+        except discord.HTTPException as e:
+            if e.status == 429:
+                raise  # let the outbound queue retry it
+            logger.error(f'Could not delete channel: {e}')
+        except discord.DiscordException as e:
+            logger.error(f'Could not delete channel: {e}')
 
     try:
-        logger.warn(f'Deleting channel {chan.name}')
-        await chan.delete(reason='Game concluded')
-    except discord.DiscordException as e:
-        logger.error(f'Could not delete channel: {e}')
+        await outbound.submit(delete, route=('channel_delete', guild.id), lane=outbound.MAINTENANCE,
+                              coalesce_key=('delete', channel_id), description=f'delete channel {channel_id}')
+    except discord.DiscordException:
+        pass  # already logged by the outbound queue
 
 
-async def send_message_to_channel(guild, channel_id: int, message: str):
-    chan = guild.get_channel(channel_id)
+def resolve_channel(guild, channel_id: int):
+    chan = guild.get_channel(channel_id) if guild else None
     if chan is None:
-        return logger.warn(f'Channel ID {channel_id} provided for message but it could not be loaded from guild')
+        logger.warn(f'Channel ID {channel_id} provided for message but it could not be loaded from guild')
+    return chan
 
-    try:
-        await chan.send(message)
-    except discord.DiscordException as e:
-        logger.error(f'Could not send message to channel: {e}')
+
+def fan_out(targets, lane: int = outbound.GAME, description: str = 'message'):
+    # Sends to several channels at once through the outbound queue, without waiting for any of them
+    # targets is a list of (channel, kwargs for channel.send()). Sends to the same channel keep their order
+    # Returns a list of futures in the same order as targets, each resolving to the sent Message, for callers that need one
+    # Failed targets are logged together once every send has finished
+    targets = [(chan, kwargs) for chan, kwargs in targets if chan is not None]
+    futures = [outbound.submit(lambda chan=chan, kwargs=kwargs: chan.send(**kwargs), route=('send', chan.id), lane=lane,
+                               description=f'{description} to channel {chan.id}') for chan, kwargs in targets]
+    if futures:
+        asyncio.ensure_future(report_fan_out(targets, futures, description))
+    return futures
+
+
+async def report_fan_out(targets, futures, description: str):
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    failures = [(chan, result) for (chan, kwargs), result in zip(targets, results) if isinstance(result, BaseException)]
+    for chan, e in failures:
+        logger.error(f'Could not send {description} to channel {chan.id} in guild {chan.guild.name}: {e}')
+    if failures:
+        logger.warn(f'{len(failures)} of {len(targets)} sends of {description} failed')
+    return failures
+
+
+async def send_message_to_channel(guild, channel_id: int, message: str):
+    fan_out([(resolve_channel(guild, channel_id), {'content': message})])
 
 
 async def update_game_channel_name(guild, channel_id: int, game_id: int, game_name: str, team_name: str = None):
@@ -194,16 +344,14 @@ async def update_game_channel_name(guild, channel_id: int, game_id: int, game_na
 
     chan_name = generate_channel_name(game_id=game_id, game_name=game_name, team_name=team_name)
 
-    if chan_name.lower() == chan.name.lower():
-        return logger.debug(f'Newly-generated channel name for channel {channel_id} game {game_id} is the same - no change to channel.')
-
-    try:
+    async def rename():
+        # Compared when the rename actually runs, since an earlier queued rename may have been coalesced into this one
+        if chan_name.lower() == chan.name.lower():
+            return logger.debug(f'Newly-generated channel name for channel {channel_id} game {game_id} is the same - no change to channel.')
         await chan.edit(name=chan_name, reason='Game renamed')
         logger.info(f'Renamed channel for game {game_id} to {chan_name}')
-    except discord.DiscordException as e:
-        logger.error(f'Could not edit channel: {e}')
 
-    try:
-        await chan.send(f'This game has been renamed to *{game_name}*.')
-    except discord.DiscordException as e:
-        logger.error(f'Could not send to channel: {e}')
+    # Discord only allows two name changes per channel every 10 minutes. Repeated renames while one is waiting collapse into the latest name
+    outbound.submit(rename, route=('channel_edit', channel_id), lane=outbound.GAME, coalesce_key=('rename', channel_id), description=f'rename channel {channel_id}')
+    outbound.submit(lambda: chan.send(f'This game has been renamed to *{game_name}*.'), route=('send', channel_id), lane=outbound.GAME,
+                    description=f'rename notice to channel {channel_id}')
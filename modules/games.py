@@ -4,6 +4,9 @@
 import settings
 import modules.exceptions as exceptions
 import modules.achievements as achievements
+import modules.name_index as name_index
+import modules.channels as channels
+import modules.reactions as reactions
 import peewee
 import modules.models as models
 from modules.models import Game, db, Player, Team, DiscordMember, Squad, GameSide, Tribe, Lineup
@@ -59,9 +62,52 @@ def __init__(self, bot):
             self.bg_task = bot.loop.create_task(self.task_purge_game_channels())
             self.bg_task2 = bot.loop.create_task(self.task_set_champion_role())
 
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        name_index.update_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        name_index.remove_member(member)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        channels.update_category_index(channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        channels.update_category_index(channel, removed=True)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        if before.category_id != after.category_id or before.name != after.name:
+            channels.update_category_index(after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        achievements.clear_role_cache(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        achievements.clear_role_cache(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if before.name != after.name:
+            achievements.clear_role_cache(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_reaction_add(self, reaction, user):
+        reactions.dispatch(reaction, user)
+
     @commands.Cog.listener()
     async def on_user_update(self, before, after):
         if before.name != after.name:
+            for guild in self.bot.guilds:
+                member = guild.get_member(after.id)
+                if member:
+                    name_index.update_member(member)
+
             logger.debug(f'Attempting to change member discordname for {before.name} to {after.name}')
             # update Discord Member Name, and update display name for each Guild/Player they share with the bot
             utilities.connect()
@@ -73,6 +119,9 @@ async def on_user_update(self, before, after):
 
     @commands.Cog.listener()
     async def on_member_update(self, before, after):
+        if before.nick != after.nick or before.name != after.name:
+            name_index.update_member(after)
+
         player_query = Player.select().join(DiscordMember).where(
             (DiscordMember.discord_id == after.id) & (Player.guild_id == after.guild.id)
         )
@@ -183,7 +232,6 @@ async def lb(self, ctx, *, filters: str = ''):
         `[p]lbactivealltime` - Most active players of all time
         """
 
-        leaderboard = []
         max_flag, global_flag = False, False
         target_model = Player
         lb_title = 'Individual Leaderboard'
@@ -208,22 +256,26 @@ async def lb(self, ctx, *, filters: str = ''):
         def process_leaderboard():
             utilities.connect()
             leaderboard_query = target_model.leaderboard(date_cutoff=date_cutoff, guild_id=ctx.guild.id, max_flag=max_flag)
+            return leaderboard_query.order_by_extend(target_model.id), leaderboard_query.count()
 
-            for counter, player in enumerate(leaderboard_query[:2000]):
+        def leaderboard_page(offset, limit):
+            # Only the pages someone actually looks at get their W/L records loaded
+            leaderboard = []
+            for counter, player in enumerate(leaderboard_query.offset(offset).limit(limit), start=offset):
                 wins, losses = player.get_record()
                 emoji_str = player.team.emoji if not global_flag and player.team else ''
                 leaderboard.append(
                     (f'{(counter + 1):>3}. {emoji_str}{player.name}', f'`ELO {player.elo_max if max_flag else player.elo}\u00A0\u00A0\u00A0\u00A0W {wins} / L {losses}`')
                 )
-            return leaderboard, leaderboard_query.count()
+            return leaderboard
 
-        leaderboard, leaderboard_size = await self.bot.loop.run_in_executor(None, process_leaderboard)
+        leaderboard_query, leaderboard_size = await self.bot.loop.run_in_executor(None, process_leaderboard)
 
         # if ctx.guild.id != settings.server_ids['polychampions']:
         #     await ctx.send('Powered by PolyChampions. League server with a team focus and competitive players.\n'
         #         'Supporting up to 6-player team ELO games and automatic team channels. - <https://tinyurl.com/polychampions>')
         #     # link put behind url shortener to not show big invite embed
-        await utilities.paginate(self.bot, ctx, title=f'**{lb_title}**\n{leaderboard_size} ranked players', message_list=leaderboard, page_start=0, page_end=10, page_size=10)
+        await utilities.paginate_lazy(self.bot, ctx, title=f'**{lb_title}**\n{leaderboard_size} ranked players', page_provider=leaderboard_page, item_count=min(leaderboard_size, 2000), page_size=10)
 
     @settings.in_bot_channel_strict()
     @commands.command(aliases=['recent', 'active', 'lbactivealltime'], hidden=True)
@@ -749,6 +801,7 @@ async def setcode(self, ctx, *args):
                                         team=team_list[0])
         player.discord_member.polytopia_id = new_id
         player.discord_member.save()
+        name_index.update_discord_member(player.discord_member)
 
         if created:
             await ctx.send(f'Player **{player.name}** added to system with Polytopia code `{player.discord_member.polytopia_id}` and ELO **{player.elo}**\n'
@@ -895,6 +948,7 @@ async def setname(self, ctx, *args):
         new_name = discord.utils.escape_mentions(new_name)
         player_target.discord_member.polytopia_name = new_name
         player_target.discord_member.save()
+        name_index.update_discord_member(player_target.discord_member)
         await ctx.send(f'Player **{player_target.name}** updated in system with Polytopia name **{new_name}**.')
 
     @commands.command(brief='Set player time zone', usage='UTC±#')
@@ -1398,7 +1452,7 @@ async def delete(self, ctx, game: PolyGame = None):
 
         if game.announcement_message:
             game.name = f'~~{game.name}~~ GAME DELETED'
-            await game.update_announcement(guild=ctx.guild, prefix=ctx.prefix)
+            await game.update_announcement(guild=ctx.guild, prefix=ctx.prefix, immediate=True)
 
         await game.delete_game_channels(self.bot.guilds, ctx.guild.id)
         gid = game.id
@@ -1577,15 +1631,14 @@ def async_game_search():
                 utilities.connect()
                 query = Game.search(status_filter=status_filter, guild_id=ctx.guild.id)
                 if status_filter == 2:
-                    query = list(query)  # reversing 'Incomplete' queries so oldest is at top
-                    query.reverse()
+                    query = query.order_by(Game.completed_ts, Game.date)  # reversing 'Incomplete' queries so oldest is at top
                 logger.debug(f'Searching games, status filter: {status_filter}')
-                logger.debug(f'Returned {len(query)} results')
-                list_name = f'All {status_str}s ({len(query)})'
-                game_list = utilities.summarize_game_list(query[:500])
-                return game_list, list_name
+                query_count = query.count()
+                logger.debug(f'Returned {query_count} results')
+                list_name = f'All {status_str}s ({query_count})'
+                return query, query_count, list_name
 
-            game_list, list_name = await self.bot.loop.run_in_executor(None, async_game_search)
+            query, query_count, list_name = await self.bot.loop.run_in_executor(None, async_game_search)
         else:
             if not target_list:
                 # Target is person issuing command
@@ -1612,16 +1665,19 @@ def async_game_search():
                 utilities.connect()
                 query = Game.search(status_filter=status_filter, player_filter=player_matches, team_filter=team_matches, title_filter=remaining_args, guild_id=ctx.guild.id)
                 logger.debug(f'Searching games, status filter: {status_filter}, player_filter: {player_matches}, team_filter: {team_matches}, title_filter: {remaining_args}')
-                logger.debug(f'Returned {len(query)} results')
-                game_list = utilities.summarize_game_list(query[:500])
-                list_name = f'{len(query)} {status_str}{"s" if len(query) != 1 else ""}\n{results_str}'
-                return game_list, list_name
+                query_count = query.count()
+                logger.debug(f'Returned {query_count} results')
+                list_name = f'{query_count} {status_str}{"s" if query_count != 1 else ""}\n{results_str}'
+                return query, query_count, list_name
 
-            game_list, list_name = await self.bot.loop.run_in_executor(None, async_game_search)
+            query, query_count, list_name = await self.bot.loop.run_in_executor(None, async_game_search)
 
-        if len(game_list) == 0:
+        if query_count == 0:
             return await ctx.send(f'No results. See `{ctx.prefix}help {ctx.invoked_with}` for usage examples. Searched for:\n{results_str}')
-        await utilities.paginate(self.bot, ctx, title=list_name, message_list=game_list, page_start=0, page_end=15, page_size=15)
+
+        # Game.id as a tiebreaker keeps offset/limit pages stable for games sharing the same date
+        query = query.order_by_extend(-Game.id)
+        await utilities.paginate_lazy(self.bot, ctx, title=list_name, page_provider=lambda offset, limit: utilities.summarize_game_list(query.offset(offset).limit(limit)), item_count=min(query_count, 500), page_size=15)
 
     async def task_purge_game_channels(self):
         await self.bot.wait_until_ready()
@@ -1633,16 +1689,27 @@ async def task_purge_game_channels(self):
             yesterday = (datetime.datetime.now() + datetime.timedelta(hours=-24))
 
             utilities.connect()
-            old_games = Game.select().join(GameSide, on=(GameSide.game == Game.id)).where(
+            # Subquery rather than a join so each game is only listed once, however many of its sides have a channel
+            sides_with_channels = GameSide.select(GameSide.game).where(GameSide.team_chan.is_null(False))
+            old_games = Game.select().where(
                 (Game.is_confirmed == 1) & (Game.completed_ts < yesterday) &
-                ((GameSide.team_chan.is_null(False)) | (Game.game_chan.is_null(False)))
-            )
+                ((Game.id.in_(sides_with_channels)) | (Game.game_chan.is_null(False)))
+            ).prefetch(GameSide)
 
-            logger.info(f'running task_purge_game_channels on {len(old_games)} games')
+            game_targets = []
             for game in old_games:
                 guild = discord.utils.get(self.bot.guilds, id=game.guild_id)
                 if guild:
-                    await game.delete_game_channels(self.bot.guilds, game.guild_id)
+                    targets = game.channel_deletion_targets(self.bot.guilds, game.guild_id)
+                    if targets:
+                        game_targets.append((game, targets))
+
+            logger.info(f'running task_purge_game_channels on {len(old_games)} games, {sum(len(t) for g, t in game_targets)} channels')
+            if game_targets:
+                try:
+                    await Game.delete_channels_bulk(game_targets)
+                except peewee.PeeweeException as e:
+                    logger.error(f'Error clearing purged channels in task_purge_game_channels: {e}')
 
             await asyncio.sleep(60 * 60 * 2)
 
@@ -1670,8 +1737,8 @@ async def post_win_messaging(guild, prefix, current_chan, winning_game):
     if settings.guild_setting(guild.id, 'game_announce_channel') is not None:
         channel = guild.get_channel(settings.guild_setting(guild.id, 'game_announce_channel'))
         if channel is not None:
-            await channel.send(f'Game concluded! Congrats **{winning_game.winner.name()}**. Roster: {" ".join(player_mentions)}')
-            await channel.send(embed=embed)
+            channels.fan_out([(channel, {'content': f'Game concluded! Congrats **{winning_game.winner.name()}**. Roster: {" ".join(player_mentions)}'}),
+                              (channel, {'embed': embed})], description=f'game {winning_game.id} win announcement')
             return await current_chan.send(f'Game concluded! See {channel.mention} for full details.')
 
     await current_chan.send(f'Game concluded! Congrats **{winning_game.winner.name()}**. Roster: {" ".join(player_mentions)}')
@@ -1701,12 +1768,10 @@ async def post_newgame_messaging(ctx, game):
     if settings.guild_setting(ctx.guild.id, 'game_announce_channel'):
         channel = ctx.guild.get_channel(settings.guild_setting(ctx.guild.id, 'game_announce_channel'))
         if channel:
-            await channel.send(f'{announce_str}')
-            announcement = await channel.send(embed=embed, content=content)
+            announce_futures = channels.fan_out([(channel, {'content': announce_str}), (channel, {'embed': embed, 'content': content})],
+                                                description=f'game {game.id} announcement')
             await ctx.send(f'New {ranked_str}game ID **{game.id}** started! See {channel.mention} for full details.')
-            game.announcement_message = announcement.id
-            game.announcement_channel = announcement.channel.id
-            game.save()
+            asyncio.ensure_future(save_announcement(game, announce_futures[1]))
         else:
             await ctx.send(embed=embed, content=content)
             await ctx.send(f'Error loading game announcement channel from server settings. Please inform the bot owner.')
@@ -1726,6 +1791,19 @@ async def post_newgame_messaging(ctx, game):
     await auto_grad_novas(ctx, game)
 
 
+async def save_announcement(game, announcement_future):
+    # Records the announcement message once fan_out() has sent it, so the new game command does not wait on the announcement channel
+    try:
+        announcement = await announcement_future
+    except discord.DiscordException:
+        return  # already logged by channels.fan_out()
+
+    game.announcement_message = announcement.id
+    game.announcement_channel = announcement.channel.id
+    utilities.connect()
+    Game.update(announcement_message=announcement.id, announcement_channel=announcement.channel.id).where(Game.id == game.id).execute()
+
+
 def parse_players_and_teams(input_list, guild_id: int):
     # Given a [List, of, string, args], try to match each one against a Team or a Player, and return lists of those matches
     # return any args that matched nothing back in edited input_list
@@ -4,6 +4,8 @@
 import modules.utilities as utilities
 import settings
 import modules.exceptions as exceptions
+import modules.matchqueue as matchqueue
+import modules.outbound as outbound
 from modules.games import post_newgame_messaging
 import peewee
 import re
@@ -39,6 +41,85 @@ async def convert(self, ctx, match_id: int):
             raise commands.UserInputError()
 
 
+def filter_joinable_games(member, guild_id: int, user_level: int, ranked_filter: int = 2):
+    # Open games with capacity that guild member 'member' could join.
+    # returns (list of joinable games, int count of unjoinable games)
+    # ELO and invite restrictions are filtered by the database, if member is registered. The member's roles are loaded once and
+    # the remaining checks run against each game's prefetched sides and lineups, so the number of queries does not grow with the number of open games.
+    # Games the member is already in are always kept.
+    player, _ = models.Player.get_by_discord_id(discord_id=member.id, discord_name=member.name, discord_nick=member.nick, guild_id=guild_id)
+    role_ids = {role.id for role in member.roles}
+    invited_game_ids = set() if player else models.Game.invited_game_ids(member.id)  # invitations of unregistered members, checked in memory below
+
+    game_list = models.Game.search_pending(status_filter=2, guild_id=guild_id, ranked_filter=ranked_filter, eligible_player=player)
+    unjoinable_count = 0
+    if player:
+        # games skipped for ELO requirements or invite lists
+        ranked_list = [0, 1] if ranked_filter == 2 else [ranked_filter]
+        unjoinable_count = models.Game.subq_open_games_with_capacity(guild_id=guild_id).where(
+            (models.Game.is_ranked.in_(ranked_list)) & (models.Game.id.not_in(models.Game.subq_eligible_for(player)))
+        ).count()
+
+    joinable_games = []
+    for game in game_list:
+        sides = game.sorted_sides()
+        if any(l.player.discord_member.discord_id == member.id for side in sides for l in side.lineup):
+            joinable_games.append(game)
+            continue
+
+        capacity = sum(side.size for side in sides)
+        game_allowed, _ = settings.can_user_join_game(user_level=user_level, game_size=capacity, is_ranked=game.is_ranked, is_host=False)
+        if not game_allowed:
+            # skipping games that user level restricts (ie joining a large ranked game for ELO Rookie/level 1)
+            unjoinable_count += 1
+            continue
+
+        if not player and game.is_invite_only and game.id not in invited_game_ids:
+            # skipping games that the command issuer is not invited to
+            unjoinable_count += 1
+            continue
+
+        # same rules as Game.first_open_side(): an open side locked to one of the member's roles, or else any open unlocked side
+        open_sides = [side for side in sides if len(side.lineup) < side.size and (side.required_role_id is None or side.required_role_id in role_ids)]
+        if not open_sides:
+            # skipping games that are role-locked that player doesn't have role for
+            unjoinable_count += 1
+            continue
+
+        joinable_games.append(game)
+
+    return joinable_games, unjoinable_count
+
+
+def max_open_games(user_level: int):
+    # Pending games a player may host with $opengame, or be in when the $queue matchmaker puts them in a new game
+    if user_level > 5:
+        return 75
+    return max(1, user_level * 3)
+
+
+def pending_game_count(player_id: int):
+    return models.Lineup.select().join(models.Game).where((models.Lineup.player == player_id) & (models.Game.is_pending == 1)).count()
+
+
+def matchlist_snapshot(game_list):
+    # Returns [(is_ranked, (embed field name, embed field value)), ...] for each game of a search_pending() result, in order
+    snapshot = []
+    for game in game_list:
+        notes_str = game.notes if game.notes else '\u200b'
+        sides = game.sorted_sides()
+        capacity_str = f' {sum(len(side.lineup) for side in sides)}/{sum(side.size for side in sides)}'
+        expiration = int((game.expiration - datetime.datetime.now()).total_seconds() / 3600.0)
+        expiration = 'Exp' if expiration < 0 else f'{expiration}H'
+        creating_player = game.sorted_creating_player()
+        host_name = creating_player.name[:35] if creating_player else '<Vacant>'
+        ranked_str = '*Unranked*' if not game.is_ranked else ''
+        ranked_str = ranked_str + ' - ' if game.notes and ranked_str else ranked_str
+
+        snapshot.append((game.is_ranked, (f'`{game.id:<8}{host_name:<40} {game.size_string():<7} {capacity_str:<7} {expiration:>5}`', f'{ranked_str}{notes_str}\n \u200b')))
+    return snapshot
+
+
 class matchmaking(commands.Cog):
     """
     Host open and find open games.
@@ -50,6 +131,13 @@ def __init__(self, bot):
             self.bg_task = bot.loop.create_task(self.task_print_matchlist())
             self.bg_task2 = bot.loop.create_task(self.task_dm_game_creators())
             self.bg_task3 = bot.loop.create_task(self.task_create_empty_matchmaking_lobbies())
+            self.bg_task4 = bot.loop.create_task(self.task_process_queues())
+        # not limited to run_tasks instances - $games used to purge on every call, so every instance still needs expired games removed
+        self.bg_task5 = bot.loop.create_task(self.task_purge_expired_games())
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        matchqueue.dequeue(member.guild.id, member.id)
 
     @settings.in_bot_channel()
     @models.is_registered_member()
@@ -104,9 +192,7 @@ async def opengame(self, ctx, *, args=None):
         if settings.guild_setting(ctx.guild.id, 'require_teams') and not on_team:
             return await ctx.send(f'You must join a Team in order to participate in games on this server.')
 
-        max_open = max(1, settings.get_user_level(ctx) * 3)
-        if settings.get_user_level(ctx) > 5:
-            max_open = 75
+        max_open = max_open_games(settings.get_user_level(ctx))
 
         if models.Game.select().where((models.Game.host == host) & (models.Game.is_pending == 1)).count() > max_open:
             return await ctx.send(f'You have too many open games already (max of {max_open}). Try using `{ctx.prefix}delete` on an existing one.')
@@ -232,9 +318,8 @@ async def opengame(self, ctx, *, args=None):
             host.team = player_team
             host.save()
 
-            opengame = models.Game.create(host=host, expiration=expiration_timestamp, notes=game_notes, guild_id=ctx.guild.id, is_pending=True, is_ranked=is_ranked)
-            for count, size in enumerate(team_sizes):
-                models.GameSide.create(game=opengame, size=size, position=count + 1, required_role_id=required_roles[count], sidename=required_role_names[count])
+            opengame = models.Game.create_open_game(guild_id=ctx.guild.id, team_sizes=team_sizes, is_ranked=is_ranked, expiration=expiration_timestamp,
+                                                    notes=game_notes, host=host, required_roles=required_roles, required_role_names=required_role_names)
 
             first_side, _ = opengame.first_open_side(roles=[role.id for role in ctx.author.roles])
             if not first_side:
@@ -247,6 +332,7 @@ async def opengame(self, ctx, *, args=None):
                     fatal_warning = True
             else:
                 models.Lineup.create(player=host, game=opengame, gameside=first_side)
+                opengame.update_capacity()
                 if first_side.position > 1:
                     warning_message = '**Warning:** You are not joined to side 1, due to the ordering of the role restrictions. Therefore you will not be the game host.'
 
@@ -321,7 +407,7 @@ async def join(self, ctx, game: PolyMatch = None, *args):
             return await ctx.send(f'The game has already started and can no longer be joined.')
 
         waitlist_hosting = [f'{g.id}' for g in models.Game.search_pending(status_filter=1, guild_id=ctx.guild.id, host_discord_id=ctx.author.id)]
-        waitlist_creating = [f'{g.game}' for g in models.Game.waiting_for_creator(creator_discord_id=ctx.author.id)]
+        waitlist_creating = [f'{g.id}' for g in models.Game.waiting_for_creator(creator_discord_id=ctx.author.id)]
         waitlist = set(waitlist_hosting + waitlist_creating)
 
         if len(waitlist) > 2 and settings.get_user_level(ctx) < 3:
@@ -423,7 +509,6 @@ async def join(self, ctx, game: PolyMatch = None, *args):
         #     if (game.is_ranked and game_size) > 6 or (not game.is_ranked and game_size > 12):
         #         return await ctx.send(f'You are a restricted user (*level 2*) - complete a few more ELO games to have more permissions.\n{settings.levels_info}')
 
-        notes = game.notes if game.notes else ''
         (min_elo, max_elo, min_elo_g, max_elo_g) = game.elo_requirements()
 
         if player.elo < min_elo or player.elo > max_elo:
@@ -436,19 +521,15 @@ async def join(self, ctx, game: PolyMatch = None, *args):
                 return await ctx.send(f'This game has a global ELO restriction of {min_elo_g} - {max_elo_g} and **{player.name}** has a global ELO of **{player.discord_member.elo}**. Cannot join! :cry:')
             await ctx.send(f'This game has an ELO restriction of {min_elo_g} - {max_elo_g}. Bypassing because you are game host or a mod.')
 
-        # list of ID strings that are allowed to join game, e.g. ['272510639124250625', '481527584107003904']
-        player_restricted_list = re.findall(r'<@!?(\d+)>', notes)
-
-        if player_restricted_list and str(player.discord_member.discord_id) not in player_restricted_list and (len(player_restricted_list) >= game_size - 1):
-            # checking length of player_restricted_list compared to game capacity.. only using restriction if capacity is at least game_size - 1
-            # if its game_size - 1, assuming that the host is the 'other' person
-            # this isnt really ideal.. could have some games where the restriction should be honored but people are allowed to join.. but better than making the lock too restrictive
+        if not game.is_invited(player.discord_member.discord_id):
+            # game notes @Mention enough players to fill the game - see Game.update_restrictions()
             return await ctx.send(f'Game {game.id} is limited to specific players. You are not allowed to join. See game notes for details: `{ctx.prefix}game {game.id}`')
 
         logger.info(f'Checks passed. Joining player {player.discord_member.discord_id} to side {side.position} of game {game.id}')
 
         with models.db.atomic():
             models.Lineup.create(player=player, game=game, gameside=side)
+            game.update_capacity()
             player.team = player_team  # update player record with detected team in case its changed since last game.
             logger.debug(f'Associating team {player_team} with player {player.id} {player.name}')
             player.save()
@@ -467,7 +548,7 @@ async def join(self, ctx, game: PolyMatch = None, *args):
 
         # Alert user if they have >1 games ready to start
         waitlist_hosting = [f'{g.id}' for g in models.Game.search_pending(status_filter=1, guild_id=ctx.guild.id, host_discord_id=ctx.author.id)]
-        waitlist_creating = [f'{g.game}' for g in models.Game.waiting_for_creator(creator_discord_id=ctx.author.id)]
+        waitlist_creating = [f'{g.id}' for g in models.Game.waiting_for_creator(creator_discord_id=ctx.author.id)]
         waitlist = set(waitlist_hosting + waitlist_creating)
 
         if len(waitlist) > 1:
@@ -505,6 +586,7 @@ async def leave(self, ctx, game: PolyMatch = None):
             return await ctx.send(f'You are not a member of game {game.id}')
 
         lineup.delete_instance()
+        game.update_capacity()
         await ctx.send('Removing you from the game.')
 
     @settings.in_bot_channel()
@@ -535,6 +617,8 @@ async def gamenotes(self, ctx, game: PolyMatch, *, notes: discord.ext.commands.c
 
         game.notes = notes[:150] if notes else None
         game.save()
+        if game.is_pending:
+            game.update_restrictions()
 
         await ctx.send(f'Updated notes for game {game.id} to: {game.notes}')
         embed, content = game.embed(guild=ctx.guild, prefix=ctx.prefix)
@@ -572,6 +656,7 @@ async def kick(self, ctx, game: PolyMatch, player: str):
 
         await ctx.send(f'Removing **{lineup.player.name}** from the game.')
         lineup.delete_instance()
+        game.update_capacity()
 
         if game.expiration < (datetime.datetime.now() + datetime.timedelta(hours=2)):
             # This catches the case of kicking someone from a full game, so that the game wont immediately get purged due to not being full
@@ -579,6 +664,99 @@ async def kick(self, ctx, game: PolyMatch, player: str):
             game.save()
             await ctx.send(f'Game {game.id} expiration has been reset to 24 hours from now')
 
+    @settings.in_bot_channel()
+    @models.is_registered_member()
+    @commands.command(usage='size [unranked]')
+    async def queue(self, ctx, *args):
+        """
+        Wait to be matched automatically with players of similar ELO
+
+        Once enough players are queued for the same size, a full game is opened for them and the first player must create it in Polytopia.
+        The ELO range you can be matched with widens the longer you wait.
+
+        **Examples:**
+        `[p]queue 1v1` - Queue for a ranked 1v1
+        `[p]queue 2v2 unranked` - Queue for an unranked 2v2. Teams are balanced by ELO
+        `[p]queue 3ffa` - Queue for a 3 player free-for-all
+        `[p]queue` - See your place in the queue
+        `[p]queue leave` - Leave the queue
+        """
+
+        if not args:
+            key, position, queue_length = matchqueue.queue_status(guild_id=ctx.guild.id, discord_id=ctx.author.id)
+            if not key:
+                queue_list = [f'**{queue.key.size_str()}** {"ranked" if queue.key.is_ranked else "unranked"}: {len(queue)}' for queue in matchqueue.guild_queues(ctx.guild.id)]
+                queue_str = ', '.join(queue_list) if queue_list else 'none'
+                return await ctx.send(f'You are not in a queue. Join one with `{ctx.prefix}queue 1v1`. Players waiting: {queue_str}')
+            return await ctx.send(f'You are number {position} of {queue_length} in the **{key.size_str()}** {"ranked" if key.is_ranked else "unranked"} queue. '
+                f'Use `{ctx.prefix}queue leave` to leave.')
+
+        if args[0].upper() == 'LEAVE':
+            key, _ = matchqueue.dequeue(guild_id=ctx.guild.id, discord_id=ctx.author.id)
+            if not key:
+                return await ctx.send('You are not in a queue.')
+            return await ctx.send(f'Removed you from the **{key.size_str()}** queue.')
+
+        team_sizes, is_ranked = None, True
+        for arg in args:
+            m = re.fullmatch(r"\d+(?:(v|vs)\d+)+", arg.lower())
+            if m:
+                team_sizes = [int(x) for x in arg.lower().split(m[1])]
+                continue
+            m = re.fullmatch(r"(\d+)ffa", arg.lower())
+            if m:
+                team_sizes = [1] * int(m[1])
+                continue
+            if arg.lower()[:8] == 'unranked':
+                is_ranked = False
+                continue
+            if arg.lower() == 'ranked':
+                continue
+            return await ctx.send(f'Unrecognized argument **{arg}**. Example: `{ctx.prefix}queue 1v1 unranked`')
+
+        if not team_sizes:
+            return await ctx.send(f'Game size is required. Include argument like *1v1* to specify size. Example: `{ctx.prefix}queue 1v1`')
+        if len(team_sizes) < 2 or min(team_sizes) < 1:
+            return await ctx.send('Games must have at least 2 sides and each side must have at least 1 player.')
+        if sum(team_sizes) > 12:
+            return await ctx.send('Games can have a maximum of 12 players.')
+
+        game_allowed, join_error_message = settings.can_user_join_game(user_level=settings.get_user_level(ctx), game_size=sum(team_sizes), is_ranked=is_ranked, is_host=False)
+        if not game_allowed:
+            return await ctx.send(join_error_message)
+
+        player, _ = models.Player.get_by_discord_id(discord_id=ctx.author.id, discord_name=ctx.author.name, discord_nick=ctx.author.nick, guild_id=ctx.guild.id)
+        if not player:
+            return await ctx.send(f'You must be a registered player before joining a queue. Try `{ctx.prefix}setcode POLYCODE`')
+
+        if not player.discord_member.polytopia_id:
+            return await ctx.send(f'You do not have a Polytopia game code on file. Use `{ctx.prefix}setcode` to set one.')
+
+        if player.is_banned or player.discord_member.is_banned:
+            return await ctx.send(f'**{player.name}** has been **ELO Banned** and cannot join any new games. :cry:')
+
+        on_team, _ = models.Player.is_in_team(guild_id=ctx.guild.id, discord_member=ctx.author)
+        if settings.guild_setting(ctx.guild.id, 'require_teams') and not on_team:
+            return await ctx.send(f'You must join a Team in order to participate in games on this server.')
+
+        inactive_role = discord.utils.get(ctx.guild.roles, name=settings.guild_setting(ctx.guild.id, 'inactive_role'))
+        if inactive_role and inactive_role in ctx.author.roles:
+            await ctx.send(f'You have the inactive role **{inactive_role.name}**. Removing it since you seem to be active!')
+            await ctx.author.remove_roles(inactive_role, reason='Player joined a queue so should no longer be inactive')
+
+        max_open = max_open_games(settings.get_user_level(ctx))
+        if pending_game_count(player.id) > max_open:
+            return await ctx.send(f'You are in too many open games already (max of {max_open}). Leave one or wait for them to start before joining a queue.')
+
+        key = matchqueue.QueueKey(guild_id=ctx.guild.id, team_sizes=team_sizes, is_ranked=is_ranked)
+        entry = matchqueue.QueueEntry(discord_id=ctx.author.id, player_id=player.id, elo=player.elo, channel_id=ctx.channel.id, max_open=max_open)
+        previous_key = matchqueue.enqueue(key, entry)
+        _, position, queue_length = matchqueue.queue_status(guild_id=ctx.guild.id, discord_id=ctx.author.id)
+
+        previous_str = f' (and left the **{previous_key.size_str()}** queue)' if previous_key and previous_key != key else ''
+        await ctx.send(f'Added you to the **{key.size_str()}** {"ranked" if is_ranked else "unranked"} queue{previous_str}. '
+            f'{queue_length} player{"s" if queue_length != 1 else ""} waiting. You will be mentioned here when a game is found.')
+
     @settings.in_bot_channel()
     @commands.command(aliases=['opengames', 'novagames'])
     async def games(self, ctx, *args):
@@ -594,7 +772,6 @@ async def games(self, ctx, *args):
         `[p]opengames me` - List unstarted opengames that you have joined
         You can also add keywords **ranked** or **unranked** to filter by those types of games.
         """
-        models.Game.purge_expired_games()
 
         ranked_filter, ranked_str = 2, ''
         filter_unjoinable, novas_only = False, False
@@ -632,40 +809,18 @@ async def games(self, ctx, *args):
                 filter_unjoinable = True
 
             title_str = f'Current{filter_str}{ranked_str} open games with available spots'
-            game_list = models.Game.search_pending(status_filter=2, guild_id=ctx.guild.id, ranked_filter=ranked_filter)
+            if filter_unjoinable:
+                game_list, unjoinable_count = filter_joinable_games(member=ctx.author, guild_id=ctx.guild.id, user_level=user_level, ranked_filter=ranked_filter)
+            else:
+                game_list = models.Game.search_pending(status_filter=2, guild_id=ctx.guild.id, ranked_filter=ranked_filter)
 
         gamelist_fields = [(f'`{"ID":<8}{"Host":<40} {"Type":<7} {"Capacity":<7} {"Exp":>4}` ', '\u200b')]
 
         for game in game_list:
 
             notes_str = game.notes if game.notes else '\u200b'
-            players, capacity = game.capacity()
-            player_restricted_list = re.findall(r'<@!?(\d+)>', notes_str)
-
-            if filter_unjoinable and not game.has_player(discord_id=ctx.author.id)[0]:
-
-                game_allowed, _ = settings.can_user_join_game(user_level=user_level, game_size=capacity, is_ranked=game.is_ranked, is_host=False)
-                if not game_allowed:
-                    # skipping games that user level restricts (ie joining a large ranked game for ELO Rookie/level 1)
-                    unjoinable_count += 1
-                    continue
-
-                if player_restricted_list and str(ctx.author.id) not in player_restricted_list and (len(player_restricted_list) >= capacity - 1):
-                    # skipping games that the command issuer is not invited to
-                    unjoinable_count += 1
-                    continue
-                open_side, _ = game.first_open_side(roles=[role.id for role in ctx.author.roles])
-                if not open_side:
-                    # skipping games that are role-locked that player doesn't have role for
-                    unjoinable_count += 1
-                    continue
-                player, _ = models.Player.get_by_discord_id(discord_id=ctx.author.id, discord_name=ctx.author.name, discord_nick=ctx.author.nick, guild_id=ctx.guild.id)
-                if player:
-                    # skip any games for which player does not meet ELO requirements, IF player is registered (unless ctx.author is already in game)
-                    (min_elo, max_elo, min_elo_g, max_elo_g) = game.elo_requirements()
-                    if player.elo < min_elo or player.elo > max_elo or player.discord_member.elo < min_elo_g or player.discord_member.elo > max_elo_g:
-                        unjoinable_count += 1
-                        continue
+            sides = game.sorted_sides()
+            players, capacity = sum(len(side.lineup) for side in sides), sum(side.size for side in sides)
 
             if (novas_only and not game.notes) or (novas_only and game.notes and 'NOVA' not in game.notes.upper()):
                 # skip all non-nova league template games, (will also include anything with "nova" in the game notes)
@@ -677,7 +832,7 @@ async def games(self, ctx, *args):
             expiration = 'Exp' if expiration < 0 else f'{expiration}H'
             ranked_str = '*Unranked*' if not game.is_ranked else ''
             ranked_str = ranked_str + ' - ' if game.notes and ranked_str else ranked_str
-            creating_player = game.creating_player()
+            creating_player = game.sorted_creating_player()
             host_name = creating_player.name[:35] if creating_player else '<Vacant>'
             gamelist_fields.append((f'`{f"{game.id}":<8}{host_name:<40} {game.size_string():<7} {capacity_str:<7} {expiration:>5}`',
                 f'{ranked_str}{notes_str}\n \u200b'))
@@ -695,7 +850,7 @@ async def games(self, ctx, *args):
 
         # Alert user if a game they are hosting OR should be creating is waiting to be created
         waitlist_hosting = [f'{g.id}' for g in models.Game.search_pending(status_filter=1, guild_id=ctx.guild.id, host_discord_id=ctx.author.id)]
-        waitlist_creating = [f'{g.game}' for g in models.Game.waiting_for_creator(creator_discord_id=ctx.author.id)]
+        waitlist_creating = [f'{g.id}' for g in models.Game.waiting_for_creator(creator_discord_id=ctx.author.id)]
         waitlist = set(waitlist_hosting + waitlist_creating)
 
         if waitlist:
@@ -791,12 +946,14 @@ async def start(self, ctx, game: PolyMatch = None, *, name: str = None):
                     side.squad = squad
 
                 side.team = allied_team
+                side.player_signature = models.GameSide.signature_for(side_players)
                 side.save()
 
             game.name = name
             game.date = datetime.datetime.today()
             game.is_pending = False
             game.save()
+            game.update_capacity()
 
         logger.info(f'Game {game.id} closed and being tracked for ELO')
         await post_newgame_messaging(ctx, game=game)
@@ -846,48 +1003,72 @@ async def task_create_empty_matchmaking_lobbies(self):
             await asyncio.sleep(60)
             logger.debug('Task running: task_create_empty_matchmaking_lobbies')
             utilities.connect()
-            unhosted_game_list = models.Game.search_pending(status_filter=2, host_discord_id=0)
+            current_lobbies = models.Game.unhosted_lobby_summary()
+            missing_lobbies, checked_keys = [], set()
+
             for lobby in settings.lobbies:
-                matching_lobby = False
-                for g in unhosted_game_list:
-                    if (g.guild_id == lobby['guild'] and g.size_string() == lobby['size_str'] and
-                            g.is_ranked == lobby['ranked'] and g.notes == lobby['notes']):
+                lobby_key = (lobby['guild'], tuple(lobby['size']), lobby['ranked'], lobby['notes'])
+                if lobby_key in checked_keys:
+                    continue  # duplicate entries in settings.lobbies are satisfied by the same open game
+                checked_keys.add(lobby_key)
+
+                # if remake_partial == True, lobby will be regenerated if anybody is in it.
+                # if remake_partial == False, lobby will only be regenerated once it is full
+                if lobby_key in current_lobbies and (current_lobbies[lobby_key] or not lobby['remake_partial']):
+                    continue  # Lobby meets desired criteria, so nothing new will be created
+
+                logger.info(f'creating new lobby {lobby}')
+                guild = discord.utils.get(self.bot.guilds, id=lobby['guild'])
+                if not guild:
+                    logger.warn(f'Bot not a member of guild {lobby["guild"]}')
+                    continue
+                expiration_hours = lobby.get('exp', 30)
+                expiration_timestamp = (datetime.datetime.now() + datetime.timedelta(hours=expiration_hours)).strftime("%Y-%m-%d %H:%M:%S")
 
-                        players_in_lobby = g.capacity()[0]
-                        # if remake_partial == True, lobby will be regenerated if anybody is in it.
-                        # if remake_partial == False, lobby will only be regenerated once it is full
+                if len(lobby.get('role_locks', lobby['size'])) != len(lobby['size']):
+                    logger.error(f'Skipping lobby {lobby}: role_locks must have one entry (or None) per side')
+                    continue
 
-                        if lobby['remake_partial'] and players_in_lobby > 0:
-                            pass  # Leave matching_lobby as current value. So it will be remade if no other open games change it
+                role_locks = []
+                for role_lock_id in lobby.get('role_locks', [None] * len(lobby['size'])):
+                    role_lock_name = None
+                    if role_lock_id:
+                        role_lock = discord.utils.get(guild.roles, id=role_lock_id)
+                        if not role_lock:
+                            logger.warn(f'Lock to role {role_lock_id} was specified, but that role is not found in guild {guild.id} {guild.name}')
+                            role_lock_id = None
                         else:
-                            matching_lobby = True  # Lobby meets desired criteria, so nothing new will be created
+                            # successfully found role - using its ID to lock a side and its name for the role side
+                            role_lock_name = role_lock.name
+                    role_locks.append((role_lock_id, role_lock_name))
 
-                if not matching_lobby:
-                    logger.info(f'creating new lobby {lobby}')
-                    guild = discord.utils.get(self.bot.guilds, id=lobby['guild'])
-                    if not guild:
-                        logger.warn(f'Bot not a member of guild {lobby["guild"]}')
-                        continue
-                    expiration_hours = lobby.get('exp', 30)
-                    expiration_timestamp = (datetime.datetime.now() + datetime.timedelta(hours=expiration_hours)).strftime("%Y-%m-%d %H:%M:%S")
-                    role_locks = lobby.get('role_locks', [None] * len(lobby['size']))
-                    with models.db.atomic():
-                        opengame = models.Game.create(host=None, notes=lobby['notes'],
-                                                      guild_id=lobby['guild'], is_pending=True,
-                                                      is_ranked=lobby['ranked'], expiration=expiration_timestamp)
-                        for count, size in enumerate(lobby['size']):
-                            role_lock_id = role_locks[count]
-                            role_lock_name = None
-                            if role_lock_id:
-                                role_lock = discord.utils.get(guild.roles, id=role_lock_id)
-                                if not role_lock:
-                                    logger.warn(f'Lock to role {role_lock_id} was specified, but that role is not found in guild {guild.id} {guild.name}')
-                                    role_lock_id = None
-                                else:
-                                    # successfully found role - using its ID to lock a side and its name for the role side
-                                    role_lock_name = role_lock.name
-
-                            models.GameSide.create(game=opengame, size=size, position=count + 1, required_role_id=role_lock_id, sidename=role_lock_name)
+                missing_lobbies.append({'guild_id': lobby['guild'], 'team_sizes': lobby['size'], 'is_ranked': lobby['ranked'],
+                                        'notes': lobby['notes'], 'expiration': expiration_timestamp, 'role_locks': role_locks})
+
+            if missing_lobbies:
+                game_ids = models.Game.create_lobbies(missing_lobbies)
+                logger.info(f'Created {len(game_ids)} lobbies: {game_ids}')
+
+    async def task_purge_expired_games(self):
+        # Removes expired open games. Runs on its own schedule so no command or listing has to wait for the DELETE
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            logger.debug('Task running: task_purge_expired_games')
+            utilities.connect()
+            try:
+                models.Game.purge_expired_games()  # logs the number of games purged
+            except peewee.PeeweeException as e:
+                logger.error(f'Error purging expired games: {e}')
+            await asyncio.sleep(60 * 10)
+
+    async def broadcast_matchlist(self, chan, embed, delete_after: int):
+        try:
+            message = await outbound.submit(lambda: chan.send(embed=embed, delete_after=delete_after), route=('send', chan.id), lane=outbound.MAINTENANCE,
+                                            coalesce_key=('matchlist', chan.id), description=f'game list broadcast to channel {chan.id}')
+        except discord.DiscordException as e:
+            logger.warn(f'Error broadcasting game list: {e}')
+        else:
+            logger.info(f'Broadcast game list to channel {chan.id} in message {message.id}')
 
     async def task_print_matchlist(self):
         await self.bot.wait_until_ready()
@@ -897,64 +1078,148 @@ async def task_print_matchlist(self):
             await asyncio.sleep(5)
             logger.debug('Task running: task_print_matchlist')
             utilities.connect()
-            models.Game.purge_expired_games()
+            broadcasts = []
             for guild in self.bot.guilds:
                 broadcast_channels = [guild.get_channel(chan) for chan in settings.guild_setting(guild.id, 'match_challenge_channels')]
+                broadcast_channels = [chan for chan in broadcast_channels if chan]
                 if not broadcast_channels:
                     continue
 
                 ranked_chan = settings.guild_setting(guild.id, 'ranked_game_channel')
                 unranked_chan = settings.guild_setting(guild.id, 'unranked_game_channel')
+                pfx = settings.guild_setting(guild.id, 'command_prefix')
+
+                # One snapshot of the guild's open games, shared by every broadcast channel. Sides, lineups and players are prefetched
+                # by search_pending() so capacity, creating player and size string are all built in memory
+                snapshot = matchlist_snapshot(models.Game.search_pending(status_filter=2, ranked_filter=2, guild_id=guild.id))
 
                 for chan in broadcast_channels:
-                    if not chan:
-                        continue
                     if chan.id == ranked_chan:
-                        game_list = models.Game.search_pending(status_filter=2, ranked_filter=1, guild_id=chan.guild.id)[:12]
+                        game_list = [game for game in snapshot if game[0]][:12]
                         list_title = 'Current ranked open games'
                     elif chan.id == unranked_chan:
-                        game_list = models.Game.search_pending(status_filter=2, ranked_filter=0, guild_id=chan.guild.id)[:12]
+                        game_list = [game for game in snapshot if not game[0]][:12]
                         list_title = 'Current unranked open games'
                     else:
-                        game_list = models.Game.search_pending(status_filter=2, ranked_filter=2, guild_id=chan.guild.id)[:12]
+                        game_list = snapshot[:12]
                         list_title = 'Current open games'
                     if not game_list:
                         continue
 
-                    pfx = settings.guild_setting(guild.id, 'command_prefix')
-
                     embed = discord.Embed(title=f'{list_title}\n'
                         f'Use __`{pfx}join ID`__ to join one or __`{pfx}game ID`__ for more details.')
                     embed.add_field(name=f'`{"ID":<8}{"Host":<40} {"Type":<7} {"Capacity":<7} {"Exp":>4} `', value='\u200b', inline=False)
-                    for game in game_list:
-
-                        notes_str = game.notes if game.notes else '\u200b'
-                        players, capacity = game.capacity()
-                        player_restricted_list = re.findall(r'<@!?(\d+)>', notes_str)
-
-                        if player_restricted_list and (len(player_restricted_list) >= capacity - 1) and len(game_list) > 15:
-                            # skipping invite-only games IF the games list is large
-                            continue
-
-                        capacity_str = f' {players}/{capacity}'
-                        expiration = int((game.expiration - datetime.datetime.now()).total_seconds() / 3600.0)
-                        expiration = 'Exp' if expiration < 0 else f'{expiration}H'
-                        creating_player = game.creating_player()
-                        host_name = creating_player.name[:35] if creating_player else '<Vacant>'
-                        ranked_str = '*Unranked*' if not game.is_ranked else ''
-                        ranked_str = ranked_str + ' - ' if game.notes and ranked_str else ranked_str
-
-                        embed.add_field(name=f'`{game.id:<8}{host_name:<40} {game.size_string():<7} {capacity_str:<7} {expiration:>5}`', value=f'{ranked_str}{notes_str}\n \u200b', inline=False)
-
-                    try:
-                        message = await chan.send(embed=embed, delete_after=sleep_cycle)
-                    except discord.DiscordException as e:
-                        logger.warn(f'Error broadcasting game list: {e}')
-                    else:
-                        logger.info(f'Broadcast game list to channel {chan.id} in message {message.id}')
+                    for _, (name, value) in game_list:
+                        embed.add_field(name=name, value=value, inline=False)
+                    broadcasts.append(self.broadcast_matchlist(chan, embed, delete_after=sleep_cycle))
 
+            await asyncio.gather(*broadcasts)
             await asyncio.sleep(sleep_cycle)
 
+    def create_queue_game(self, key, sides):
+        # Turns one matchqueue match into a full open game. Side 1's first player is the creating player, who must start it
+        expiration_timestamp = (datetime.datetime.now() + datetime.timedelta(hours=24)).strftime("%Y-%m-%d %H:%M:%S")
+        with models.db.atomic():
+            game = models.Game.create_open_game(guild_id=key.guild_id, team_sizes=key.team_sizes, is_ranked=key.is_ranked, expiration=expiration_timestamp,
+                                                notes=f'Matched by {key.size_str()} queue')
+            for side, side_entries in zip(game.ordered_side_list(), sides):
+                for entry in side_entries:
+                    models.Lineup.create(player=entry.player_id, game=game, gameside=side)
+            game.update_capacity()
+        return game
+
+    def queue_entry_problem(self, guild, entry):
+        # Players are only checked by $queue when they join, so this checks them again once they are matched
+        # Returns the reason a queued player can no longer be put in a game, or None if they still can
+        member = guild.get_member(entry.discord_id) if guild else None
+        if not member:
+            return 'no longer on this server'
+        if member.id in settings.discord_id_ban_list or discord.utils.get(member.roles, name='ELO Banned'):
+            return '**ELO Banned**'
+        player = models.Player.get_or_none(id=entry.player_id)
+        if not player or player.is_banned or player.discord_member.is_banned:
+            return '**ELO Banned**'
+        if entry.max_open is not None and pending_game_count(player.id) > entry.max_open:
+            return f'in too many open games (max of {entry.max_open})'
+        return None
+
+    async def queue_notice(self, channel_id: int, message: str):
+        channel = self.bot.get_channel(channel_id)
+        if not channel:
+            return
+        try:
+            await channel.send(message)
+        except discord.DiscordException as e:
+            logger.warn(f'Error sending queue notice to channel {channel_id}: {e}')
+
+    async def process_queue_match(self, key, sides):
+        guild = self.bot.get_guild(key.guild_id)
+        entries = [entry for side_entries in sides for entry in side_entries]
+        problems = [(entry, self.queue_entry_problem(guild, entry)) for entry in entries]
+        dropped = [(entry, problem) for entry, problem in problems if problem]
+        if dropped:
+            # put everyone else back in the queue with their original wait time, so they are matched again on the next pass
+            for entry, problem in problems:
+                if not problem:
+                    matchqueue.enqueue(key, entry)
+            for entry, problem in dropped:
+                logger.info(f'Dropped player {entry.player_id} from {key.size_str()} queue match in guild {key.guild_id}: {problem}')
+                await self.queue_notice(entry.channel_id, f'<@{entry.discord_id}>, you have been removed from the **{key.size_str()}** queue since you are {problem}.')
+            return
+
+        try:
+            game = self.create_queue_game(key, sides)
+        except peewee.PeeweeException as e:
+            logger.error(f'Error creating game from queue {key}: {e}')
+            for entry in entries:
+                matchqueue.enqueue(key, entry)
+                await self.queue_notice(entry.channel_id, f'<@{entry.discord_id}>, a match was found in the **{key.size_str()}** queue but the game could not be created. '
+                    'You have been put back in the queue.')
+            return
+
+        logger.info(f'Created game {game.id} from {key.size_str()} queue in guild {key.guild_id}')
+        channel = self.bot.get_channel(sides[0][0].channel_id)
+        if not guild or not channel:
+            return
+        prefix = settings.guild_setting(guild.id, 'command_prefix')
+        mentions = ' '.join(f'<@{entry.discord_id}>' for entry in entries)
+        embed, content = game.embed(guild=guild, prefix=prefix)
+        try:
+            await channel.send(f'{mentions}\nA **{key.size_str()}** game has been found! Game {game.id} is full and <@{sides[0][0].discord_id}> should create the game in Polytopia, '
+                f'then use `{prefix}start {game.id} Name of Game`.')
+            await channel.send(embed=embed, content=content)
+        except discord.DiscordException as e:
+            logger.warn(f'Error announcing queue game {game.id}: {e}')
+
+    async def task_process_queues(self):
+        # Matching itself is in-memory (see matchqueue.py) so this only touches the database when a match is found
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            await asyncio.sleep(20)
+            try:
+                await self.process_queues()
+            except Exception as e:
+                # any error is logged and the next pass runs as normal, rather than ending the task
+                logger.error(f'Error in task_process_queues: {e}', exc_info=True)
+
+    async def process_queues(self):
+        matches, expired = matchqueue.process_queues()
+
+        for key, entry in expired:
+            await self.queue_notice(entry.channel_id, f'<@{entry.discord_id}>, no match was found in the **{key.size_str()}** queue so you have been removed from it. '
+                f'You can queue again or look for an open game with `{settings.guild_setting(key.guild_id, "command_prefix")}games`.')
+
+        if not matches:
+            return
+
+        logger.debug(f'Task running: task_process_queues - creating {len(matches)} games')
+        utilities.connect()
+        for key, sides in matches:
+            try:
+                await self.process_queue_match(key, sides)
+            except Exception as e:
+                logger.error(f'Error processing match from queue {key}: {e}', exc_info=True)
+
 
 def setup(bot):
     bot.add_cog(matchmaking(bot))
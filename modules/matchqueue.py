@@ -0,0 +1,228 @@
+import bisect
+import itertools
+import time
+import logging
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# In-memory state for the $queue matchmaker. Players are loaded from the database once, when they join a queue, and the
+# periodic matching pass only works with what is stored here, so it costs no queries no matter how many players are waiting.
+# Nothing here imports models or discord - the matchmaking cog turns each match into an open game.
+
+base_elo_band = 50  # players this close in ELO can be matched as soon as they queue
+elo_band_growth = 25  # band widens by this much per minute spent waiting...
+max_elo_band = 500  # ...up to this limit
+max_wait = 60 * 60 * 2  # seconds before a queued player is dropped
+
+_queues = {}  # QueueKey: MatchQueue
+_queued_players = {}  # (guild_id, discord_id): QueueKey. A player can only wait in one queue per guild
+_sequence = itertools.count()  # tie-breaker so entries with equal ELO sort by queue order
+
+
+class QueueKey(tuple):
+    # (guild_id, team_sizes, is_ranked), ie. (283436219780825088, (1, 1), True)
+
+    def __new__(cls, guild_id: int, team_sizes, is_ranked: bool):
+        return super().__new__(cls, (guild_id, tuple(team_sizes), bool(is_ranked)))
+
+    @property
+    def guild_id(self):
+        return self[0]
+
+    @property
+    def team_sizes(self):
+        return self[1]
+
+    @property
+    def is_ranked(self):
+        return self[2]
+
+    def size_str(self):
+        if len(self.team_sizes) > 2 and max(self.team_sizes) == 1:
+            return f'{len(self.team_sizes)}FFA'
+        return 'v'.join(str(size) for size in self.team_sizes)
+
+
+class QueueEntry:
+    __slots__ = ('discord_id', 'player_id', 'elo', 'channel_id', 'max_open', 'queued_at', 'sequence')
+
+    def __init__(self, discord_id: int, player_id: int, elo: int, channel_id: int, max_open: int = None, queued_at: float = None):
+        self.discord_id = discord_id
+        self.player_id = player_id
+        self.elo = elo
+        self.channel_id = channel_id  # where the player queued, used to announce their match
+        self.max_open = max_open  # open game limit for the player's user level when they queued, checked again when they are matched
+        self.queued_at = time.monotonic() if queued_at is None else queued_at
+        self.sequence = next(_sequence)
+
+    def sort_key(self):
+        return (self.elo, self.sequence)
+
+    def elo_band(self, now: float):
+        waited_minutes = max(0, now - self.queued_at) / 60
+        return min(base_elo_band + int(elo_band_growth * waited_minutes), max_elo_band)
+
+
+class MatchQueue:
+    # Players waiting for one game format. Two views of the same entries:
+    # self.entries keeps queue order (dict insertion order), so the longest-waiting player is matched first
+    # self.by_elo is sorted by ELO, so the players closest to any given ELO are found with a bisect instead of a scan
+
+    def __init__(self, key: QueueKey):
+        self.key = key
+        self.entries = {}  # discord_id: QueueEntry
+        self.by_elo = []  # sorted list of (elo, sequence)
+        self.by_sort_key = {}  # (elo, sequence): QueueEntry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def players_needed(self):
+        return sum(self.key.team_sizes)
+
+    def add(self, entry: QueueEntry):
+        self.remove(entry.discord_id)
+        newest = list(self.entries.values())[-1] if self.entries else None
+        self.entries[entry.discord_id] = entry
+        if newest and entry.queued_at < newest.queued_at:
+            # re-queued with its original wait time (ie. after a match fell through), so move it back to its place in queue order.
+            # expire() and find_matches() rely on self.entries being ordered by queued_at
+            self.entries = {e.discord_id: e for e in sorted(self.entries.values(), key=lambda e: (e.queued_at, e.sequence))}
+        bisect.insort(self.by_elo, entry.sort_key())
+        self.by_sort_key[entry.sort_key()] = entry
+
+    def remove(self, discord_id: int):
+        entry = self.entries.pop(discord_id, None)
+        if entry is None:
+            return None
+        index = bisect.bisect_left(self.by_elo, entry.sort_key())
+        del self.by_elo[index]
+        del self.by_sort_key[entry.sort_key()]
+        return entry
+
+    def position(self, discord_id: int):
+        # 1-based position in queue order, or None
+        for count, queued_id in enumerate(self.entries, start=1):
+            if queued_id == discord_id:
+                return count
+        return None
+
+    def nearest(self, anchor: QueueEntry):
+        # Yields other entries ordered by ELO distance from anchor, walking outwards from anchor's spot in self.by_elo
+        index = bisect.bisect_left(self.by_elo, anchor.sort_key())
+        below, above = index - 1, index + 1
+        while below >= 0 or above < len(self.by_elo):
+            below_distance = anchor.elo - self.by_elo[below][0] if below >= 0 else None
+            above_distance = self.by_elo[above][0] - anchor.elo if above < len(self.by_elo) else None
+            if above_distance is None or (below_distance is not None and below_distance <= above_distance):
+                yield self.by_sort_key[self.by_elo[below]], below_distance
+                below -= 1
+            else:
+                yield self.by_sort_key[self.by_elo[above]], above_distance
+                above += 1
+
+    def find_group(self, anchor: QueueEntry, now: float):
+        # Returns a list of entries including anchor, all within each other's ELO bands, or None
+        # Two players are compatible if their ELO difference fits inside the narrower of their two bands
+        group = [anchor]
+        needed = self.players_needed()
+        anchor_band = anchor.elo_band(now)
+
+        for candidate, distance in self.nearest(anchor):
+            if distance > anchor_band:
+                break  # every remaining candidate is further away
+            if all(abs(candidate.elo - member.elo) <= min(candidate.elo_band(now), member.elo_band(now)) for member in group):
+                group.append(candidate)
+                if len(group) == needed:
+                    return group
+        return None
+
+    def find_matches(self, now: float):
+        # Returns list of matches, each a list of sides (lists of QueueEntry) ready to become a game. Matched entries are removed
+        matches = []
+        if len(self.entries) < self.players_needed():
+            return matches
+
+        for entry in list(self.entries.values()):
+            if entry.discord_id not in self.entries:
+                continue  # already matched earlier in this pass
+            group = self.find_group(entry, now)
+            if not group:
+                continue
+            for member in group:
+                self.remove(member.discord_id)
+                _queued_players.pop((self.key.guild_id, member.discord_id), None)
+            matches.append(balanced_sides(group, self.key.team_sizes))
+            if len(self.entries) < self.players_needed():
+                break
+        return matches
+
+    def expire(self, now: float):
+        expired = []
+        for entry in list(self.entries.values()):
+            if now - entry.queued_at < max_wait:
+                break  # entries are in queue order so the rest are newer
+            self.remove(entry.discord_id)
+            _queued_players.pop((self.key.guild_id, entry.discord_id), None)
+            expired.append(entry)
+        return expired
+
+
+def balanced_sides(group, team_sizes):
+    # Greedy split: strongest player first, each to the side with room whose average ELO is currently lowest
+    sides = [[] for _ in team_sizes]
+    totals = [0] * len(team_sizes)
+    for entry in sorted(group, key=lambda e: -e.elo):
+        open_sides = [i for i, size in enumerate(team_sizes) if len(sides[i]) < size]
+        target = min(open_sides, key=lambda i: (totals[i] / team_sizes[i], i))
+        sides[target].append(entry)
+        totals[target] += entry.elo
+    return sides
+
+
+def enqueue(key: QueueKey, entry: QueueEntry):
+    # Adds entry to the queue for key, first removing the player from any other queue in the same guild. Returns the previous QueueKey or None
+    previous_key = dequeue(key.guild_id, entry.discord_id)[0]
+    _queues.setdefault(key, MatchQueue(key)).add(entry)
+    _queued_players[(key.guild_id, entry.discord_id)] = key
+    return previous_key
+
+
+def dequeue(guild_id: int, discord_id: int):
+    # returns (QueueKey, QueueEntry) the player was removed from, or (None, None)
+    key = _queued_players.pop((guild_id, discord_id), None)
+    if key is None:
+        return None, None
+    queue = _queues.get(key)
+    entry = queue.remove(discord_id) if queue else None
+    if queue is not None and not queue:
+        del _queues[key]
+    return key, entry
+
+
+def queue_status(guild_id: int, discord_id: int):
+    # returns (QueueKey, position, queue length) for the player's current queue, or (None, None, None)
+    key = _queued_players.get((guild_id, discord_id))
+    if key is None:
+        return None, None, None
+    queue = _queues[key]
+    return key, queue.position(discord_id), len(queue)
+
+
+def guild_queues(guild_id: int):
+    return [queue for key, queue in _queues.items() if key.guild_id == guild_id]
+
+
+def process_queues(now: float = None):
+    # One matching pass over every queue. Pure in-memory work.
+    # returns (list of (QueueKey, sides) matches, list of (QueueKey, QueueEntry) expired entries)
+    now = time.monotonic() if now is None else now
+    matches, expired = [], []
+    for key, queue in list(_queues.items()):
+        expired.extend((key, entry) for entry in queue.expire(now))
+        matches.extend((key, sides) for sides in queue.find_matches(now))
+        if not queue:
+            del _queues[key]
+    if matches:
+        logger.debug(f'process_queues made {len(matches)} matches')
+    return matches, expired
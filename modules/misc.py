@@ -62,15 +62,22 @@ async def bulk_global_elo(self, ctx, *, args=None):
         player_stats.sort(key=lambda tup: tup[0], reverse=True)     # sort the list descending by ELO
         print(player_stats)
 
-        if ctx.invoked_with in ['bulk_local_elo', 'ble']:
-            message = '__Player name - Local ELO - Local games played__\n'
-        else:
-            message = '__Player name - Global ELO - Local games played__\n'
+        def games_played_count(player):
+            utilities.connect()
+            return player.games_played().count()
+
+        async def stat_lines():
+            # pages are sent while games_played() counts for later players are still running. Counts run in an executor so the bot is not blocked
+            if ctx.invoked_with in ['bulk_local_elo', 'ble']:
+                yield '__Player name - Local ELO - Local games played__'
+            else:
+                yield '__Player name - Global ELO - Local games played__'
 
-        for player in player_stats:
-            message += f'{player[1].name} - {player[0]} - {player[1].games_played().count()}\n'
+            for player in player_stats:
+                games_played = await self.bot.loop.run_in_executor(None, games_played_count, player[1])
+                yield f'{player[1].name} - {player[0]} - {games_played}'
 
-        await utilities.buffered_send(destination=ctx, content=message)
+        await utilities.buffered_send_lines(destination=ctx, lines=stat_lines())
 
     @commands.command(usage=None)
     @settings.in_bot_channel_strict()
@@ -1,4 +1,6 @@
+import asyncio
 import datetime
+import hashlib
 import discord
 from discord.ext import commands
 import re
@@ -10,6 +12,8 @@
 # from modules import utilities
 # import modules.utilities as utilities
 from modules import channels
+from modules import announcements
+from modules import name_index
 import statistics
 import settings
 import logging
@@ -54,6 +58,36 @@ async def predicate(ctx):
     return commands.check(predicate)
 
 
+_max_elo = {}  # guild_id: highest Player.elo in that guild. Key None: highest DiscordMember.elo (global leaderboard)
+
+
+def max_elo(guild_id: int = None):
+    # Highest current ELO in a guild, or globally if guild_id is None. Loaded with a MAX() query the first time it is needed
+    # and then kept current by Game.note_elo_changes() after each win is committed, so role checks after each game do not need aggregate queries
+    if guild_id not in _max_elo:
+        if guild_id is None:
+            _max_elo[None] = DiscordMember.select(fn.Max(DiscordMember.elo)).scalar() or 0
+        else:
+            _max_elo[guild_id] = Player.select(fn.Max(Player.elo)).where(Player.guild_id == guild_id).scalar() or 0
+    return _max_elo[guild_id]
+
+
+def note_elo_change(guild_id, old_elo: int, new_elo: int):
+    # guild_id None for a DiscordMember (global) ELO change
+    cached = _max_elo.get(guild_id)
+    if cached is None:
+        return
+    if new_elo > cached:
+        _max_elo[guild_id] = new_elo
+    elif old_elo >= cached and new_elo < old_elo:
+        del _max_elo[guild_id]  # the leader lost ELO and may no longer be the leader - reload on next use
+
+
+def clear_max_elo():
+    # For changes that can lower ELO in bulk or remove players, such as reversing, deleting or recalculating games and deleting players
+    _max_elo.clear()
+
+
 class BaseModel(Model):
     class Meta:
         database = db
@@ -221,6 +255,7 @@ def advanced_stats(self):
     def update_name(self, new_name: str):
         self.name = new_name
         self.save()
+        name_index.update_discord_member(self)
         for guildmember in self.guildmembers:
             guildmember.generate_display_name(player_name=new_name, player_nick=guildmember.nick)
 
@@ -267,6 +302,10 @@ def games_played(self, in_days: int = None):
             (Lineup.player.discord_member == self)
         ).order_by(-Game.date)
 
+    def pending_games(self):
+        # Open games this member is in, on any server. Their capacity needs updating if the member's Lineups are moved or deleted
+        return Game.select().join(Lineup).join(Player).where((Game.is_pending == 1) & (Player.discord_member == self)).distinct()
+
     def completed_game_count(self, only_ranked=True):
 
         if only_ranked:
@@ -374,6 +413,7 @@ def generate_display_name(self=None, player_name=None, player_nick=None):
             self.name = display_name
             self.nick = player_nick
             self.save()
+            name_index.update_player_nick(guild_id=self.guild_id, player_id=self.id, nick=player_nick)
         return display_name
 
     def upsert(discord_id, guild_id, discord_name=None, discord_nick=None, team=None):
@@ -405,6 +445,7 @@ def upsert(discord_id, guild_id, discord_name=None, discord_nick=None, team=None
                 player.nick = discord_nick
             player.save()
 
+        name_index.add_player(player, discord_member)
         return player, created
 
     def get_teams_of_players(guild_id, list_of_players):
@@ -449,17 +490,20 @@ def is_in_team(guild_id, discord_member):
         return (True, list_of_teams[0])
 
     def string_matches(player_string: str, guild_id: int, include_poly_info: bool = True):
-        # Returns QuerySet containing players in current guild matching string. Searches against discord mention ID first, then exact discord name match,
+        # Returns list of players in current guild matching string. Searches against discord mention ID first, then exact discord name match,
         # then falls back to substring match on name/nick, then a lastly a substring match of polytopia ID or polytopia in-game name
+        # Matching happens against the guild's in-memory name_index.PlayerNameIndex so only the matching players are loaded from the database
+
+        index = name_index.player_index(guild_id, loader=Player.name_index_rows)
 
         p_id = string_to_user_id(str(player_string))
         if p_id:
             # lookup either on <@####> mention string or raw ID #
-            query_by_id = Player.select(Player, DiscordMember).join(DiscordMember).where(
-                (DiscordMember.discord_id == p_id) & (Player.guild_id == guild_id)
-            )
-            if query_by_id.count() > 0:
-                return query_by_id
+            player_id = index.player_by_discord_id(p_id)
+            if player_id:
+                players_by_id = Player.get_by_ids([player_id])
+                if players_by_id:
+                    return players_by_id
 
         if len(player_string.split('#', 1)[0]) > 2:
             discord_str = player_string.split('#', 1)[0]
@@ -468,33 +512,50 @@ def string_matches(player_string: str, guild_id: int, include_poly_info: bool =
         else:
             discord_str = player_string
 
-        name_exact_match = Player.select(Player, DiscordMember).join(DiscordMember).where(
-            (DiscordMember.name ** discord_str) & (Player.guild_id == guild_id)  # ** is case-insensitive
-        )
+        name_exact_match = index.exact_name_matches(discord_str)  # case-insensitive
 
-        if name_exact_match.count() == 1:
+        if len(name_exact_match) == 1:
             # String matches DiscordUser.name exactly
-            return name_exact_match
+            return Player.get_by_ids(name_exact_match)
 
         # If no exact match, return any substring matches - prioritized by number of games played
 
-        name_substring_match = Lineup.select(Lineup.player, fn.COUNT('*').alias('games_played')).join(Player).join(DiscordMember).where(
-            ((Player.nick.contains(player_string)) | (DiscordMember.name.contains(discord_str))) & (Player.guild_id == guild_id)
-        ).group_by(Lineup.player).order_by(-SQL('games_played'))
+        name_substring_match = index.substring_matches(nick_string=player_string, name_string=discord_str)
 
-        if name_substring_match.count() > 0:
-            return [l.player for l in name_substring_match]
+        if name_substring_match:
+            # Games are counted live for just the candidates, so a player who joined their first game a moment ago is included
+            games_played = dict(Lineup.select(Lineup.player, fn.COUNT('*')).where(
+                Lineup.player.in_(name_substring_match)
+            ).group_by(Lineup.player).tuples())
+            for player_id, count in games_played.items():
+                index.set_games_played(player_id, count)
+            name_substring_match = sorted([player_id for player_id in name_substring_match if games_played.get(player_id)],
+                                          key=lambda player_id: -games_played[player_id])  # stable sort keeps index order for ties
+            if name_substring_match:
+                return Player.get_by_ids(name_substring_match)
 
         if include_poly_info:
             # If no substring name matches, return anything with matching polytopia name or code
-            poly_fields_match = Player.select(Player, DiscordMember).join(DiscordMember).where(
-                ((DiscordMember.polytopia_id.contains(player_string)) | (DiscordMember.polytopia_name.contains(player_string))) & (Player.guild_id == guild_id)
-            )
-            return poly_fields_match
+            return Player.get_by_ids(index.polytopia_matches(player_string))
         else:
             # if include_poly_info == False, then do not fall back to searching by polytopia_id or polytopia_name
             return []
 
+    def name_index_rows(guild_id: int):
+        # Loader for name_index.player_index() - one row per player in the guild, with the number of games they have been in
+        return Player.select(
+            Player.id, DiscordMember.discord_id, DiscordMember.name, Player.nick, DiscordMember.polytopia_id, DiscordMember.polytopia_name, fn.COUNT(Lineup.id)
+        ).join(DiscordMember).join_from(Player, Lineup, JOIN.LEFT_OUTER).where(
+            Player.guild_id == guild_id
+        ).group_by(Player.id, DiscordMember.id).tuples()
+
+    def get_by_ids(player_ids):
+        # Returns list of players (with DiscordMember loaded) in the same order as player_ids. ids that no longer exist are skipped
+        if not player_ids:
+            return []
+        players = {p.id: p for p in Player.select(Player, DiscordMember).join(DiscordMember).where(Player.id.in_(player_ids))}
+        return [players[player_id] for player_id in player_ids if player_id in players]
+
     def get_or_except(player_string: str, guild_id: int):
         results = Player.string_matches(player_string=player_string, guild_id=guild_id)
         if len(results) == 0:
@@ -712,6 +773,13 @@ class Game(BaseModel):
     is_pending = BooleanField(default=False)  # True == open, unstarted game
     is_ranked = BooleanField(default=True)
     game_chan = BitField(default=None, null=True)
+    is_full = BooleanField(default=False)  # True when every GameSide.is_full. Maintained by update_capacity() for pending games
+    elo_min = SmallIntegerField(default=0)  # Join restrictions for pending games, parsed from notes by update_restrictions()
+    elo_max = SmallIntegerField(default=3000)
+    global_elo_min = SmallIntegerField(default=0)
+    global_elo_max = SmallIntegerField(default=3000)
+    is_invite_only = BooleanField(default=False)  # True if only players in GameInvitee can join
+    creator = ForeignKeyField(Player, null=True, backref='creating', on_delete='SET NULL')  # first player on side 1. Maintained by update_capacity()
 
     def __setattr__(self, name, value):
         if name == 'name':
@@ -724,8 +792,10 @@ async def create_game_channels(self, guild_list, guild_id):
         ordered_side_list = list(self.ordered_side_list())
         error_message = ''
 
+        side_lineups = {}  # gameside.id: lineup list, reused below instead of querying each side again
         for s in ordered_side_list:
             lineup_list = s.ordered_player_list()
+            side_lineups[s.id] = lineup_list
             playernames = [l.player.name for l in lineup_list]
             player_external_servers = [l.player.team.external_server if l.player.team else None for l in lineup_list]
             logger.debug(player_external_servers)
@@ -739,6 +809,11 @@ async def create_game_channels(self, guild_list, guild_id):
         logger.debug(f'Side_external_servers: {side_external_servers}')
         roster_names = '\n'.join(game_roster)  # "Side **Home**: Nelluk, player2\n Side **Away**: Player 3, Player 4"
 
+        # Decide where every channel goes first, then create them all at once. Creation is limited per guild by the outbound queue
+        side_channel_plans = []  # (gameside, side_guild, player_list, using_team_server_flag)
+        # create game channel for larger games - 4+ sides, or 3+ sides with 6+ players
+        full_game_channel = (len(ordered_side_list) > 2 and len(self.lineup) > 5) or len(ordered_side_list) > 3
+        planned_channel_count = 1 if full_game_channel else 0  # channels this game will add to guild, on top of its current count
         for gameside, side_external_server in zip(ordered_side_list, side_external_servers):
             logger.debug(f'Checking for external server usage for side {gameside.id}: {side_external_server}')
             if side_external_server and discord.utils.get(guild_list, id=side_external_server):
@@ -760,10 +835,10 @@ async def create_game_channels(self, guild_list, guild_id):
             #
             ###
 
-            player_list = [l.player for l in gameside.ordered_player_list()]
+            player_list = [l.player for l in side_lineups[gameside.id]]
             if len(player_list) < 2:
                 continue
-            if (len(guild.text_channels) > 440 and  # Give server some breathing room for non-game channels
+            if (channels.text_channel_count(guild) + planned_channel_count > 440 and  # Give server some breathing room for non-game channels
                    len(player_list) < 3 and  # Large-team chans still get created
                    not using_team_server_flag and  # if on external server, skip check
                    not self.name.upper()[:3] == 'LR1' and  # temp hack for LigaRex games which use external server but not flag):
@@ -774,7 +849,14 @@ async def create_game_channels(self, guild_list, guild_id):
                 error_message = 'Server has nearly reached the maximum number of channels: skipping channel creation for this game.'
                 logger.warn('Skipping channel creation for a team due to server exceeding 425 channels')
                 continue
-            chan = await channels.create_game_channel(side_guild, game=self, team_name=gameside.team.name, player_list=player_list, using_team_server_flag=using_team_server_flag)
+            side_channel_plans.append((gameside, side_guild, player_list, using_team_server_flag))
+            if side_guild == guild:
+                planned_channel_count += 1
+
+        async def create_side_channel(gameside, side_guild, player_list, using_team_server_flag):
+            greeting = channels.game_channel_greeting(roster_names=roster_names, game=self, player_list=player_list, full_game=False)
+            chan = await channels.create_game_channel(side_guild, game=self, team_name=gameside.team.name, player_list=player_list,
+                                                      using_team_server_flag=using_team_server_flag, topic=greeting)
             if chan:
                 gameside.team_chan = chan.id
                 if side_guild.id != guild_id:
@@ -783,33 +865,54 @@ async def create_game_channels(self, guild_list, guild_id):
                     gameside.team_chan_external_server = None
                     # Making sure this is set to None for the edge case of a restarted game that previously had been on a team server
                     # and now no longer needs to be
-                gameside.save()
+                channels.greet_game_channel(chan, greeting)
+            return chan
 
-                await channels.greet_game_channel(side_guild, chan=chan, player_list=player_list, roster_names=roster_names, game=self, full_game=False)
+        channel_tasks = [create_side_channel(*plan) for plan in side_channel_plans]
 
-        if (len(ordered_side_list) > 2 and len(self.lineup) > 5) or len(ordered_side_list) > 3:
-            # create game channel for larger games - 4+ sides, or 3+ sides with 6+ players
-            player_list = [l.player for l in self.lineup]
-            chan = await channels.create_game_channel(guild, game=self, team_name=None, player_list=player_list)
-            if chan:
+        full_game_player_list = None
+        if full_game_channel:
+            full_game_player_list = [l.player for l in self.lineup]
+            full_game_greeting = channels.game_channel_greeting(roster_names=roster_names, game=self, player_list=full_game_player_list, full_game=True)
+            channel_tasks.append(channels.create_game_channel(guild, game=self, team_name=None, player_list=full_game_player_list, topic=full_game_greeting))
+
+        results = await asyncio.gather(*channel_tasks, return_exceptions=True)
+
+        # Save whichever channels were created before surfacing any error, so they are still tracked and deleted with the game
+        created_sides = [plan[0] for plan, result in zip(side_channel_plans, results) if result and not isinstance(result, BaseException)]
+        if created_sides:
+            GameSide.bulk_update(created_sides, fields=[GameSide.team_chan, GameSide.team_chan_external_server])
+
+        if full_game_player_list is not None:
+            chan = results[-1]
+            if chan and not isinstance(chan, BaseException):
                 self.game_chan = chan.id
                 self.save()
-                await channels.greet_game_channel(guild, chan=chan, player_list=player_list, roster_names=roster_names, game=self, full_game=True)
+                channels.greet_game_channel(chan, full_game_greeting)
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
 
         if error_message:
             raise exceptions.MyBaseException('Server has nearly reached the maximum number of channels: skipping 2-player team channel creation for this game.')
 
-    async def delete_game_channels(self, guild_list, guild_id):
+    def channel_deletion_targets(self, guild_list, guild_id):
+        # Returns list of (guild, channel_id, gameside) for this game's channels. gameside is None for the full game channel
+        # Empty list for games whose channels are protected from deletion
         guild = discord.utils.get(guild_list, id=guild_id)
 
         if self.name and ('s8' in self.name.lower() or 's6' in self.name.lower() or 's7' in self.name.lower()):
             last_week = (datetime.datetime.now() + datetime.timedelta(days=-7))
             if self.completed_ts and self.completed_ts > last_week:
-                return logger.warn(f'Skipping team channel deletion for game {self.id} {self.name} since it is a Season game concluded recently')
+                logger.warn(f'Skipping team channel deletion for game {self.id} {self.name} since it is a Season game concluded recently')
+                return []
 
         if self.name and self.name.upper()[:3] == 'LR1':
-            return logger.warn(f'Skipping team channel deletion for game {self.id} {self.name} since it is a protected LigaRex event game (Sept 2019 event)')
+            logger.warn(f'Skipping team channel deletion for game {self.id} {self.name} since it is a protected LigaRex event game (Sept 2019 event)')
+            return []
 
+        targets = []
         for gameside in self.gamesides:
             if gameside.team_chan:
                 if gameside.team_chan_external_server:
@@ -819,18 +922,43 @@ async def delete_game_channels(self, guild_list, guild_id):
                         continue
                 else:
                     side_guild = guild
-                await channels.delete_game_channel(side_guild, channel_id=gameside.team_chan)
-                gameside.team_chan = None
-                gameside.save()
+                targets.append((side_guild, gameside.team_chan, gameside))
 
-        if self.game_chan:
-            await channels.delete_game_channel(guild, channel_id=self.game_chan)
-            self.game_chan = None
-            self.save()
+        if self.game_chan and guild:
+            targets.append((guild, self.game_chan, None))
+        return targets
+
+    async def delete_channels_bulk(game_targets):
+        # game_targets: list of (game, list of targets from game.channel_deletion_targets())
+        # Deletes every channel concurrently (bounded by the outbound queue) and then clears the channel columns with one UPDATE per table
+        await asyncio.gather(*[channels.delete_game_channel(target_guild, channel_id=channel_id)
+                               for game, targets in game_targets for target_guild, channel_id, _ in targets])
+
+        cleared_sides = [gameside for game, targets in game_targets for _, _, gameside in targets if gameside]
+        cleared_games = [game for game, targets in game_targets if any(gameside is None for _, _, gameside in targets)]
+        with db.atomic():
+            if cleared_sides:
+                GameSide.update(team_chan=None).where(GameSide.id.in_([gameside.id for gameside in cleared_sides])).execute()
+            if cleared_games:
+                Game.update(game_chan=None).where(Game.id.in_([game.id for game in cleared_games])).execute()
+
+        # keep in-memory copies in step, so a later save() does not write the old channel ids back
+        for gameside in cleared_sides:
+            gameside.team_chan = None
+        for game in cleared_games:
+            game.game_chan = None
+        return len(cleared_sides) + len(cleared_games)
+
+    async def delete_game_channels(self, guild_list, guild_id):
+        targets = self.channel_deletion_targets(guild_list, guild_id)
+        if targets:
+            await Game.delete_channels_bulk([(self, targets)])
 
     async def update_squad_channels(self, guild_list, guild_id, message: str = None):
+        # With a message, sends it to every game channel at once via channels.fan_out(). Otherwise renames the channels to match the game name
         guild = discord.utils.get(guild_list, id=guild_id)
         game_chan = self.game_chan  # loading early here trying to avoid InterfaceError
+        message_targets = []
 
         for gameside in list(self.gamesides):
             if gameside.team_chan:
@@ -845,18 +973,23 @@ async def update_squad_channels(self, guild_list, guild_id, message: str = None)
                     side_guild = guild
                 if message:
                     logger.debug(f'Pinging message to channel {gameside.team_chan} in guild {side_guild}')
-                    await channels.send_message_to_channel(side_guild, channel_id=gameside.team_chan, message=message)
+                    message_targets.append((channels.resolve_channel(side_guild, gameside.team_chan), {'content': message}))
                 else:
                     await channels.update_game_channel_name(side_guild, channel_id=gameside.team_chan, game_id=self.id, game_name=self.name, team_name=gameside.team.name)
 
         if game_chan:
             if message:
-                await channels.send_message_to_channel(guild, channel_id=game_chan, message=message)
+                message_targets.append((channels.resolve_channel(guild, game_chan), {'content': message}))
             else:
                 await channels.update_game_channel_name(guild, channel_id=game_chan, game_id=self.id, game_name=self.name, team_name=None)
 
-    async def update_announcement(self, guild, prefix):
+        if message_targets:
+            channels.fan_out(message_targets, description=f'game {self.id} channel message')
+
+    async def update_announcement(self, guild, prefix, immediate: bool = False):
         # Updates contents of new game announcement with updated game_embed card
+        # Debounced by modules.announcements: the embed is rendered from the database a few seconds later, once for any number of updates
+        # immediate=True renders this instance right away instead, for changes that will not be saved (ie. a game about to be deleted)
 
         if self.announcement_channel is None or self.announcement_message is None:
             return
@@ -864,16 +997,17 @@ async def update_announcement(self, guild, prefix):
         if channel is None:
             return logger.warn('Couldn\'t get channel in update_announacement')
 
-        try:
-            message = await channel.fetch_message(self.announcement_message)
-        except discord.DiscordException:
-            return logger.warn('Couldn\'t get message in update_announacement')
+        if immediate:
+            def render():
+                return self.embed(guild=guild, prefix=prefix)
+        else:
+            game_id = self.id
 
-        try:
-            embed, content = self.embed(guild=guild, prefix=prefix)
-            await message.edit(embed=embed, content=content)
-        except discord.DiscordException:
-            return logger.warn('Couldn\'t update message in update_announacement')
+            def render():
+                db.connect(reuse_if_open=True)
+                return Game.load_full_game(game_id=game_id).embed(guild=guild, prefix=prefix)
+
+        await announcements.schedule_update(self.id, channel, self.announcement_message, render, immediate=immediate)
 
     def is_hosted_by(self, discord_id: int):
 
@@ -888,12 +1022,23 @@ def is_created_by(self, discord_id: int):
     def creating_player(self):
         # return Player who is in 'first position' for this game, ie. the game creator in Polytopia
         # will not always be Game.host if it was a staff member who removed themselves from lineup
+        if self.creator_id is not None:
+            return self.creator
+
+        # creator is NULL for games from before the column was backfilled, or if that player was deleted - look it up from the lineup
         first_side = self.ordered_side_list().limit(1).get()
         side_players = first_side.ordered_player_list()
         if side_players:
-            return first_side.ordered_player_list()[0].player
+            return side_players[0].player
         return None
 
+    def sorted_creating_player(self):
+        # Same as creating_player() but uses prefetched self.gamesides and side.lineup instead of querying
+        sides = self.sorted_sides()
+        if not sides or not sides[0].lineup:
+            return None
+        return min(sides[0].lineup, key=lambda l: l.id).player
+
     def draft_order(self):
         # Returns list of tuples, in order of recommended draft order list:
         # [(Side #, Side Name, Player 1), ... ]
@@ -949,6 +1094,10 @@ def draft_order(self):
     def ordered_side_list(self):
         return GameSide.select().where(GameSide.game == self).order_by(GameSide.position)
 
+    def sorted_sides(self):
+        # Same order as ordered_side_list() but sorts self.gamesides in python, so results of a prefetch() stay in memory
+        return sorted(self.gamesides, key=lambda gameside: gameside.position)
+
     def embed(self, guild, prefix):
         if self.is_pending:
             return self.embed_pending_game(prefix)
@@ -1107,14 +1256,17 @@ def embed_pending_game(self, prefix):
     def get_gamesides_string(self, include_emoji=True):
         # yields string like:
         # :fried_shrimp: The Crawfish vs :fried_shrimp: TestAccount1 vs :spy: TestBoye1
+        # Works from self.gamesides/gameside.lineup so a prefetch()ed game (see utilities.summarize_game_list) needs no further queries
         gameside_strings = []
-        for gameside in self.ordered_side_list():
+        gamesides = self.sorted_sides()
+        game_player_count = sum(len(gameside.lineup) for gameside in gamesides)
+        for gameside in gamesides:
             # logger.info(f'{self.id} gameside:', gameside)
             emoji = ''
             if gameside.team and len(gameside.lineup) > 1 and include_emoji:
                 emoji = gameside.team.emoji
 
-            gameside_strings.append(f'{emoji} **{gameside.name()}**')
+            gameside_strings.append(f'{emoji} **{gameside.name(game_player_count=game_player_count)}**')
         full_squad_string = ' *vs* '.join(gameside_strings)[:225]
         return full_squad_string
 
@@ -1125,14 +1277,19 @@ def get_game_status_string(self):
         elif game.is_completed is False:
             status_str = 'Incomplete'
         else:
+            gamesides = game.sorted_sides()
+            game_player_count = sum(len(gameside.lineup) for gameside in gamesides)
+            winner = next((gameside for gameside in gamesides if gameside.id == game.winner_id), None)
+            winner_name = winner.name(game_player_count=game_player_count) if winner else 'Unknown'
+
             if game.is_confirmed is False:
                 (confirmed_count, side_count, _) = game.confirmations_count()
                 if side_count > 2:
-                    status_str = f'**WINNER** (Unconfirmed by {side_count - confirmed_count} of {side_count}): {game.winner.name()}'
+                    status_str = f'**WINNER** (Unconfirmed by {side_count - confirmed_count} of {side_count}): {winner_name}'
                 else:
-                    status_str = f'**WINNER** (Unconfirmed): {game.winner.name()}'
+                    status_str = f'**WINNER** (Unconfirmed): {winner_name}'
             else:
-                status_str = f'**WINNER:** {game.winner.name()}'
+                status_str = f'**WINNER:** {winner_name}'
         return status_str
 
     def get_headline(self):
@@ -1152,7 +1309,7 @@ def smallest_team(self):
 
     def size_string(self):
 
-        gamesides = self.ordered_side_list()
+        gamesides = self.sorted_sides()
 
         if self.is_pending:
             # use capacity for matchmaking strings
@@ -1250,9 +1407,10 @@ def create_game(discord_groups, guild_id, name: str = None, require_teams: bool
         with db.atomic():
             newgame = Game.create(name=name,
                                   guild_id=guild_id,
-                                  is_ranked=is_ranked)
+                                  is_ranked=is_ranked,
+                                  is_full=True)
 
-            side_position = 1
+            side_position, creator = 1, None
             for team_group, allied_team, discord_group in zip(teams_for_each_discord_member, list_of_final_teams, discord_groups):
                 logger.debug(f'Making side {side_position} for new game {newgame.id}: {team_group} - {allied_team} - {discord_group}')
                 # team_group is each team that the individual discord.Member is associated with on the server, often None
@@ -1273,12 +1431,18 @@ def create_game(discord_groups, guild_id, name: str = None, require_teams: bool
                 else:
                     squad = None
 
-                gameside = GameSide.create(game=newgame, squad=squad, size=len(player_group), team=allied_team, position=side_position)
+                gameside = GameSide.create(game=newgame, squad=squad, size=len(player_group), team=allied_team, position=side_position,
+                                           player_signature=GameSide.signature_for(player_group), player_count=len(player_group), is_full=True)
                 side_position = side_position + 1
 
                 # Create Lineup records
                 for player in player_group:
                     Lineup.create(game=newgame, gameside=gameside, player=player)
+                if not creator:
+                    creator = player_group[0]
+
+            newgame.creator = creator
+            newgame.save()
 
         return newgame
 
@@ -1314,6 +1478,7 @@ def reverse_elo_changes(self):
             gameside.team_elo_after_game = None
             gameside.team_elo_after_game_alltime = None
             gameside.save()
+        clear_max_elo()
 
     def delete_game(self):
         # resets any relevant ELO changes to players and teams, deletes related lineup records, and deletes the game entry itself
@@ -1342,6 +1507,7 @@ def delete_game(self):
 
             if recalculate:
                 Game.recalculate_elo_since(timestamp=since)
+        clear_max_elo()  # again once committed, in case another thread reloaded it from the old values in the meantime
 
     def get_side_win_chances(largest_team: int, gameside_list, gameside_elo_list):
         n = len(gameside_list)
@@ -1462,6 +1628,20 @@ def declare_winner(self, winning_side: 'GameSide', confirm: bool):
             self.is_completed = True
             self.save()
 
+        if confirm is True and self.is_ranked:
+            self.note_elo_changes()
+
+    def note_elo_changes(self):
+        # Updates the max_elo() cache from this game's Lineups once their ELO changes are committed, so a rolled back win can't leave
+        # a maximum that nobody has. Inside an enclosing transaction (ie. recalculating ELO) the cache is only cleared, and that caller clears it again
+        if db.in_transaction():
+            return clear_max_elo()
+        for lineup in self.lineup:
+            if lineup.elo_after_game is not None:
+                note_elo_change(lineup.player.guild_id, lineup.elo_after_game - lineup.elo_change_player, lineup.elo_after_game)
+            if lineup.elo_after_game_global is not None:
+                note_elo_change(None, lineup.elo_after_game_global - lineup.elo_change_discordmember, lineup.elo_after_game_global)
+
     def has_player(self, player: Player = None, discord_id: int = None):
         # if player (or discord_id) was a participant in this game: return True, GameSide
         # else, return False, None
@@ -1500,6 +1680,25 @@ def player(self, player: Player = None, discord_id: int = None, name: str = None
     def capacity(self):
         return (len(self.lineup), sum(s.size for s in self.gamesides))
 
+    def update_capacity(self):
+        # Refresh GameSide.player_count/is_full, Game.is_full and Game.creator from this game's Lineup rows.
+        # Must be called after any Lineup is added to or removed from a pending game, in the same transaction as that change.
+        # Each UPDATE counts in the database rather than trusting in-memory lineups. The row lock on the game makes concurrent callers
+        # take turns, so under READ COMMITTED the later one's counts include Lineups the earlier one has committed.
+        side_count = Lineup.select(fn.COUNT(Lineup.id)).where(Lineup.gameside == GameSide.id)
+        open_sides = GameSide.select(GameSide.game).where((GameSide.game == self) & (GameSide.is_full == False))
+        first_player = Lineup.select(Lineup.player).join(GameSide).where(
+            (Lineup.game == self) & (GameSide.position == 1)
+        ).order_by(Lineup.id).limit(1)
+
+        with db.atomic():
+            Game.select().where(Game.id == self.id).for_update().execute()
+            GameSide.update(player_count=side_count, is_full=(GameSide.size <= side_count)).where(GameSide.game == self).execute()
+            Game.update(is_full=Game.id.not_in(open_sides), creator=first_player).where(Game.id == self.id).execute()
+
+        self.is_full, self.creator = Game.select(Game.is_full, Game.creator).where(Game.id == self.id).tuples().get()
+        return self.is_full
+
     def list_gameside_membership(self):
         sidenames = []
         gamesides = list(self.gamesides)
@@ -1552,42 +1751,88 @@ def gameside_by_name(self, name: str):
             raise exceptions.TooManyMatches(f'{len(matches)} matches found for "{name}" in game {self.id}. Be more specific or use a @Mention.')
 
     def elo_requirements(self):
+        return (self.elo_min, self.elo_max, self.global_elo_min, self.global_elo_max)
+
+    def restrictions_from_notes(notes: str):
+        # returns (min_elo, max_elo, min_elo_g, max_elo_g, [invited discord IDs]) from free-text game notes
+        # ie. '1200 elo max 1000 global elo min <@272510639124250625>'
 
         min_elo, max_elo = 0, 3000
         min_elo_g, max_elo_g = 0, 3000
-        notes = self.notes if self.notes else ''
+        notes = notes if notes else ''
 
         m = re.search(r'(\d+) elo max', notes, re.I)
         if m:
-            max_elo = int(m[1])
+            max_elo = min(int(m[1]), 32767)
         m = re.search(r'(\d+) elo min', notes, re.I)
         if m:
-            min_elo = int(m[1])
+            min_elo = min(int(m[1]), 32767)
 
         m = re.search(r'(\d+) global elo max', notes, re.I)
         if m:
-            max_elo_g = int(m[1])
+            max_elo_g = min(int(m[1]), 32767)
         m = re.search(r'(\d+) global elo min', notes, re.I)
         if m:
-            min_elo_g = int(m[1])
+            min_elo_g = min(int(m[1]), 32767)
 
-        return (min_elo, max_elo, min_elo_g, max_elo_g)
+        invitees = list(dict.fromkeys(int(discord_id) for discord_id in re.findall(r'<@!?(\d+)>', notes)))
 
-    def waiting_for_creator(creator_discord_id: int):
-        # Games for which creator_discord_id is in the 'creating player' slot (first player in GameSide.position == 1) and Game is full/waiting to start
+        return (min_elo, max_elo, min_elo_g, max_elo_g, invitees)
+
+    def update_restrictions(self):
+        # Parses self.notes into the elo_min/elo_max/global_elo_min/global_elo_max/is_invite_only columns and GameInvitee rows
+        # Call when a pending game is created (after its sides exist) and whenever its notes change
+
+        (self.elo_min, self.elo_max, self.global_elo_min, self.global_elo_max, invitees) = Game.restrictions_from_notes(self.notes)
+        capacity = GameSide.select(fn.SUM(GameSide.size)).where(GameSide.game == self).scalar() or 0
 
-        # subq = List of all lineup IDs for creating player for full pending games
-        subq = GameSide.select(fn.MIN(Lineup.id).alias('game_creator')).join(Lineup).join_from(GameSide, Game).where(
-            (GameSide.position == 1) & (Game.is_pending == 1) & (Game.id.not_in(Game.subq_open_games_with_capacity()))
-        ).group_by(GameSide.game)
+        # Only treat the mentions as an invite list if there are enough of them to fill the game, assuming the host is the 'other' person
+        # this isnt really ideal.. could have some games where the restriction should be honored but people are allowed to join.. but better than making the lock too restrictive
+        self.is_invite_only = bool(invitees) and len(invitees) >= capacity - 1
 
-        q = Lineup.select(Lineup.game).join(Player).join(DiscordMember).where(
-            (Lineup.player.discord_member.discord_id == creator_discord_id) & (Lineup.id.in_(subq))
+        with db.atomic():
+            self.save()
+            GameInvitee.delete().where(GameInvitee.game == self).execute()
+            if invitees:
+                GameInvitee.insert_many([{'game': self, 'discord_id': discord_id} for discord_id in invitees]).execute()
+
+    def is_invited(self, discord_id: int):
+        # False only if the game is invite-only and discord_id is not on its invite list
+        if not self.is_invite_only:
+            return True
+        return GameInvitee.select().where((GameInvitee.game == self) & (GameInvitee.discord_id == discord_id)).exists()
+
+    def invited_game_ids(discord_id: int):
+        # ids of pending games discord_id is on the invite list of. For checking is_invited() against many games with one query
+        return {game_id for (game_id,) in GameInvitee.select(GameInvitee.game).join(Game).where(
+            (GameInvitee.discord_id == discord_id) & (Game.is_pending == 1)
+        ).tuples()}
+
+    def subq_eligible_for(player):
+        # Pending games whose ELO and invite restrictions allow player to join, plus any pending game player is already in
+        invited = GameInvitee.select(GameInvitee.game).where(GameInvitee.discord_id == player.discord_member.discord_id)
+        joined = Lineup.select(Lineup.game).where(Lineup.player == player)
+
+        return Game.select(Game.id).where(
+            (Game.is_pending == 1) & (
+                (
+                    (Game.elo_min <= player.elo) & (Game.elo_max >= player.elo) &
+                    (Game.global_elo_min <= player.discord_member.elo) & (Game.global_elo_max >= player.discord_member.elo) &
+                    ((Game.is_invite_only == False) | (Game.id.in_(invited)))
+                ) | (Game.id.in_(joined))
+            )
         )
 
-        return q
+    def waiting_for_creator(creator_discord_id: int):
+        # Games for which creator_discord_id is in the 'creating player' slot (first player in GameSide.position == 1) and Game is full/waiting to start
+        # Served by the game_pending_full_creator partial index
+
+        return Game.select(Game.id).join(Player, on=(Game.creator == Player.id)).join(DiscordMember).where(
+            (DiscordMember.discord_id == creator_discord_id) & (Game.is_pending == 1) & (Game.is_full == True)
+        ).order_by(Game.id)
 
-    def search_pending(status_filter: int = 0, ranked_filter: int = 2, guild_id: int = None, player_discord_id: int = None, host_discord_id: int = None):
+    def search_pending(status_filter: int = 0, ranked_filter: int = 2, guild_id: int = None, player_discord_id: int = None, host_discord_id: int = None, eligible_player: Player = None):
+        # eligible_player: only games whose ELO/invite restrictions allow that Player to join (or that they are already in)
         # status_filter
         # 0 = all open games
         # 1 = full games / waiting to start
@@ -1599,6 +1844,9 @@ def search_pending(status_filter: int = 0, ranked_filter: int = 2, guild_id: int
 
         ranked_filter = [0, 1] if ranked_filter == 2 else [ranked_filter]  # [0] or [1]
 
+        # side.lineup, lineup.player and player.discord_member are all prefetched so results can be checked in memory
+        lineup_subq = Lineup.select(Lineup, Player, DiscordMember).join(Player).join(DiscordMember)
+
         if guild_id:
             guild_filter = Game.select(Game.id).where(Game.guild_id == guild_id)
         else:
@@ -1625,43 +1873,51 @@ def search_pending(status_filter: int = 0, ranked_filter: int = 2, guild_id: int
             # Pass None to not filter by Game.host
             host_filter = Game.select(Game.id)
 
+        if eligible_player:
+            eligible_filter = Game.id.in_(Game.subq_eligible_for(eligible_player))
+        else:
+            eligible_filter = SQL('TRUE')
+
         if status_filter == 1:
             # full games / waiting to start
             q = Game.select().where(
-                (Game.id.not_in(Game.subq_open_games_with_capacity())) &
+                (Game.is_full == True) &
                 (Game.is_pending == 1) &
                 (Game.id.in_(guild_filter)) &
                 (Game.id.in_(player_filter)) &
                 (Game.id.in_(host_filter)) &
+                (eligible_filter) &
                 (Game.is_ranked.in_(ranked_filter))
             )
-            return q.prefetch(GameSide, Lineup, Player)
+            return q.prefetch(GameSide, lineup_subq)
 
         elif status_filter == 2:
             # games with open capacity
             return Game.select().where(
-                (Game.id.in_(Game.subq_open_games_with_capacity())) &
+                (Game.is_full == False) &
                 (Game.is_pending == 1) &
                 (Game.id.in_(guild_filter)) &
                 (Game.id.in_(player_filter)) &
                 (Game.id.in_(host_filter)) &
+                (eligible_filter) &
                 (Game.is_ranked.in_(ranked_filter))
-            ).order_by(-Game.id).prefetch(GameSide, Lineup, Player)
+            ).order_by(-Game.id).prefetch(GameSide, lineup_subq)
 
         else:
             # Any kind of open game
             # sorts by capacity-player_count, so full games are at bottom of list
             return Game.select(
-                Game, fn.SUM(GameSide.size).alias('player_capacity'), fn.COUNT(Lineup.id).alias('player_count'),
-            ).join(GameSide, on=(GameSide.game == Game.id)).join(Lineup, JOIN.LEFT_OUTER).where(
+                Game, fn.SUM(GameSide.size).alias('player_capacity'), fn.SUM(GameSide.player_count).alias('player_count'),
+            ).join(GameSide, on=(GameSide.game == Game.id)).where(
                 (Game.is_pending == 1) &
                 (Game.id.in_(guild_filter)) &
                 (Game.id.in_(player_filter)) &
                 (Game.id.in_(host_filter)) &
+                (eligible_filter) &
                 (Game.is_ranked.in_(ranked_filter))
             ).group_by(Game.id).order_by(
-                -(fn.SUM(GameSide.size) - fn.COUNT(Lineup.id))
-            ).prefetch(GameSide, Lineup, Player)
+                -(fn.SUM(GameSide.size) - fn.SUM(GameSide.player_count))
+            ).prefetch(GameSide, lineup_subq)
 
     def search(player_filter=None, team_filter=None, title_filter=None, status_filter: int = 0, guild_id: int = None):
         # Returns Games by almost any combination of player/team participation, and game status
@@ -1710,11 +1966,12 @@ def search(player_filter=None, team_filter=None, title_filter=None, status_filte
             player_subq = Game.select(Game.id)
 
         if title_filter:
-            title_subq = Game.select(Game.id).where(
-                (Game.name.contains('%'.join(title_filter))) | (Game.notes.contains('%'.join(title_filter)))
-            )
+            # Filter game.name/game.notes directly rather than through an IN-subquery so postgres can combine
+            # the game_name_trgm and game_notes_trgm GIN indexes (see migrator.py) for ILIKE '%term%term%'
+            title_pattern = '%' + '%'.join(title_filter) + '%'
+            title_expression = (Game.name ** title_pattern) | (Game.notes ** title_pattern)
         else:
-            title_subq = Game.select(Game.id)
+            title_expression = SQL('TRUE')
 
         if (not player_filter and not team_filter) or status_filter not in [3, 4]:
             # No filtering on wins/losses
@@ -1751,7 +2008,7 @@ def search(player_filter=None, team_filter=None, title_filter=None, status_filte
             ) & (
                 Game.id.in_(player_subq)
             ) & (
-                Game.id.in_(title_subq)
+                title_expression
             ) & (
                 Game.is_completed.in_(completed_filter)
             ) & (
@@ -1772,23 +2029,14 @@ def series_record(self):
         if len(gamesides) != 2:
             raise exceptions.CheckFailedError('This can only be used for games with exactly two sides.')
 
-        player_lists = []
-        for side in gamesides:
-            player_lists.append([lineup.player for lineup in side.lineup])
+        signatures = [side.player_signature or GameSide.signature_for([lineup.player_id for lineup in side.lineup]) for side in gamesides]
 
-        games_with_same_teams = Game.by_opponents(player_lists)
+        # Ranked, confirmed wins in head-to-head games between these two sides, counted by the signature of the winning side
+        wins_by_signature = dict(GameSide.select(GameSide.player_signature, fn.COUNT('*')).join(Game, on=(Game.winner == GameSide.id)).where(
+            (Game.id.in_(Game.subq_by_side_signatures(signatures))) & (Game.is_ranked == 1) & (Game.is_confirmed == 1)
+        ).group_by(GameSide.player_signature).tuples())
 
-        s1_wins, s2_wins = 0, 0
-        for game in games_with_same_teams:
-            if not game.is_ranked:
-                continue
-            if game.is_confirmed:
-                if game.winner.has_same_players_as(gamesides[0]):
-                    s1_wins += 1
-                    logger.debug(f'series_record(): s1_wins incremented for game {game.id}')
-                else:
-                    s2_wins += 1
-                    logger.debug(f'series_record(): s2_wins incremented for game {game.id}')
+        s1_wins, s2_wins = wins_by_signature.get(signatures[0], 0), wins_by_signature.get(signatures[1], 0)
 
         logger.debug(f'series_record(): game {self.id}, side 0, id {gamesides[0].id}, wins {s1_wins}. side 1, id {gamesides[1].id}, wins {s2_wins}')
         if s2_wins > s1_wins:
@@ -1819,37 +2067,23 @@ def by_opponents(player_lists):
             raise exceptions.CheckFailedError('At least two sides must be queried, ie: [[p1, p2], [p3, p4]]')
 
         logger.debug(f'by_opponents() with player_lists = {player_lists}')
-        side_games = []
-        for player_list in player_lists:
-            # for this given player_list, find all games that had this exact list on one side
-
-            query = GameSide.select(GameSide.game).join(Lineup).group_by(GameSide.game, GameSide.id).having(
-                (fn.SUM(Lineup.player.in_(player_list).cast('integer')) == len(player_list)) & (fn.SUM(Lineup.player.not_in(player_list).cast('integer')) == 0)
-            )
-            side_games.append(set((res[0] for res in query.tuples())))
-            # side_games will be a list of sets, each set being game_ids for other games with this specific gamesides
-
-        intersection_of_games = set.intersection(*side_games)
-        # this becomes a set of game IDs where -all- the game sides participated
+        signatures = [GameSide.signature_for(player_list) for player_list in player_lists]
 
-        subq_games_with_same_number_of_sides = GameSide.select(GameSide.game).group_by(GameSide.game).having(fn.COUNT('*') == len(player_lists))
-
-        query = Game.select().where(
-            (Game.id.in_(intersection_of_games)) & (Game.id.in_(subq_games_with_same_number_of_sides)) & (Game.is_pending == 0)
+        return Game.select().where(
+            (Game.id.in_(Game.subq_by_side_signatures(signatures))) & (Game.is_pending == 0)
         )
 
-        return query
+    def subq_by_side_signatures(signatures):
+        # ids of games made up of exactly these sides (GameSide.player_signature values) - every signature present and no other sides
+        # Both steps are index lookups on gameside.player_signature / gameside.game_id rather than aggregates over every lineup
 
-        # Commented out block negated by subq_games_with_same_number_of_sides - which needs to be more thoroughly vetted
-        # games_with_same_number_of_sides = []
-        # for game in query:
-        #     # ugly fix - without this block games without the same number of sides will be mixed together.
-        #     # if game 1 is p1 vs p2, and game 2 is p1 vs p2 vs p3, they would be compared
-        #     # could fix this with better SQL querying but this was a quick fix
-        #     if len(game.gamesides) == len(player_lists):
-        #         games_with_same_number_of_sides.append(game)
+        subq_games_with_all_sides = GameSide.select(GameSide.game).where(
+            GameSide.player_signature.in_(signatures)
+        ).group_by(GameSide.game).having(fn.COUNT(fn.DISTINCT(GameSide.player_signature)) == len(set(signatures)))
 
-        # return games_with_same_number_of_sides
+        return GameSide.select(GameSide.game).where(
+            GameSide.game.in_(subq_games_with_all_sides)
+        ).group_by(GameSide.game).having(fn.COUNT('*') == len(signatures))
 
     def recalculate_elo_since(timestamp):
         games = Game.select().where(
@@ -1866,6 +2100,7 @@ def recalculate_elo_since(timestamp):
         for g in games:
             full_game = Game.load_full_game(game_id=g.id)
             full_game.declare_winner(winning_side=full_game.winner, confirm=True)
+        clear_max_elo()
         elo_logger.debug(f'recalculate_elo_since complete')
 
     def recalculate_all_elo():
@@ -1892,6 +2127,7 @@ def recalculate_all_elo():
                 full_game = Game.load_full_game(game_id=game.id)
                 full_game.declare_winner(winning_side=full_game.winner, confirm=True)
 
+        clear_max_elo()
         elo_logger.info(f'recalculate_all_elo complete')
 
     def first_open_side(self, roles):
@@ -1940,39 +2176,104 @@ def get_side(self, lookup):
     def subq_open_games_with_capacity(guild_id: int = None):
         # All games that have open capacity
         # not restricted by expiration
-
-        # Subq: MatchSides with openings
-        subq = GameSide.select(GameSide.id).join(Lineup, JOIN.LEFT_OUTER).group_by(GameSide.id, GameSide.size).having(
-            fn.COUNT(Lineup.id) < GameSide.size)
+        # Served by the game_pending_guild_full partial index
 
         if guild_id:
-            q = GameSide.select(GameSide.game).join(Game).where(
-                (GameSide.id.in_(subq)) & (GameSide.game.guild_id == guild_id) & (GameSide.game.is_pending == 1)
-            ).group_by(GameSide.game).order_by(GameSide.game)
+            q = Game.select(Game.id).where(
+                (Game.guild_id == guild_id) & (Game.is_full == False) & (Game.is_pending == 1)
+            ).order_by(Game.id)
 
         else:
-            q = GameSide.select(GameSide.game).join(Game).where(
-                (GameSide.id.in_(subq)) & (GameSide.game.is_pending == 1)
-            ).group_by(GameSide.game).order_by(GameSide.game)
+            q = Game.select(Game.id).where(
+                (Game.is_full == False) & (Game.is_pending == 1)
+            ).order_by(Game.id)
 
         return q
 
+    def unhosted_lobby_summary():
+        # Summarizes every unhosted open game with capacity in a single aggregate query, for keeping settings.lobbies populated
+        # returns {(guild_id, (side sizes by position), is_ranked, notes): bool}, bool True if at least one of those games has no players yet
+
+        q = Game.select(
+            Game.guild_id, Game.is_ranked, Game.notes,
+            fn.array_agg(GameSide.size).order_by(GameSide.position).alias('sizes'),
+            fn.SUM(GameSide.player_count).alias('players')
+        ).join(GameSide).where(
+            (Game.host.is_null(True)) & (Game.is_full == False) & (Game.is_pending == 1)
+        ).group_by(Game.id).tuples()
+
+        lobbies = {}
+        for guild_id, is_ranked, notes, sizes, players in q:
+            key = (guild_id, tuple(sizes), is_ranked, notes)
+            lobbies[key] = lobbies.get(key, False) or not players
+        return lobbies
+
+    def create_open_game(guild_id: int, team_sizes, is_ranked: bool, expiration, notes: str = None, host=None, required_roles=None, required_role_names=None):
+        # Creates a pending game and its empty sides, and sets its ELO/invite restrictions from notes. Shared by $opengame and the $queue matchmaker
+        # Call inside a transaction. Callers add Lineups and then call game.update_capacity()
+        required_roles = required_roles or [None] * len(team_sizes)
+        required_role_names = required_role_names or [None] * len(team_sizes)
+
+        game = Game.create(host=host, expiration=expiration, notes=notes, guild_id=guild_id, is_pending=True, is_ranked=is_ranked)
+        for count, size in enumerate(team_sizes):
+            GameSide.create(game=game, size=size, position=count + 1, required_role_id=required_roles[count], sidename=required_role_names[count])
+        game.update_restrictions()
+        return game
+
+    def create_lobbies(lobby_list):
+        # Creates many empty, unhosted open games with one bulk insert per table
+        # lobby_list: list of dicts with keys guild_id, team_sizes, is_ranked, notes, expiration, and role_locks: [(role_id, role_name), ...] per side
+        if not lobby_list:
+            return []
+
+        for lobby in lobby_list:
+            if len(lobby['role_locks']) != len(lobby['team_sizes']):
+                logger.error(f'Lobby {lobby} has {len(lobby["role_locks"])} role locks for {len(lobby["team_sizes"])} sides')
+                raise ValueError('Each lobby needs exactly one role lock (or None) per side')
+
+        game_rows = []
+        for lobby in lobby_list:
+            (elo_min, elo_max, global_elo_min, global_elo_max, invitees) = Game.restrictions_from_notes(lobby['notes'])
+            game_rows.append({
+                'host': None, 'guild_id': lobby['guild_id'], 'notes': lobby['notes'], 'is_pending': True, 'is_ranked': lobby['is_ranked'],
+                'expiration': lobby['expiration'], 'elo_min': elo_min, 'elo_max': elo_max, 'global_elo_min': global_elo_min,
+                'global_elo_max': global_elo_max, 'is_invite_only': bool(invitees) and len(invitees) >= sum(lobby['team_sizes']) - 1
+            })
+
+        with db.atomic():
+            # postgres returns the new ids in the same order as the VALUES list
+            game_ids = [row[0] for row in Game.insert_many(game_rows).returning(Game.id).tuples().execute()]
+
+            side_rows, invitee_rows = [], []
+            for game_id, lobby in zip(game_ids, lobby_list):
+                for count, (size, (role_id, role_name)) in enumerate(zip(lobby['team_sizes'], lobby['role_locks'])):
+                    side_rows.append({'game': game_id, 'size': size, 'position': count + 1, 'required_role_id': role_id, 'sidename': role_name})
+                invitee_rows.extend({'game': game_id, 'discord_id': discord_id} for discord_id in Game.restrictions_from_notes(lobby['notes'])[4])
+
+            GameSide.insert_many(side_rows).execute()
+            if invitee_rows:
+                GameInvitee.insert_many(invitee_rows).execute()
+
+        return game_ids
+
     def purge_expired_games():
+        # Deletes expired open games in one statement, using the game_pending_expiration partial index. GameSide, Lineup and
+        # GameInvitee rows go with them through ON DELETE CASCADE. Returns number of games deleted
+        now = datetime.datetime.now()
 
         # Full matches that expired more than 3 days ago (ie. host has 3 days to start match before it vanishes)
-        purge_deadline = (datetime.datetime.now() + datetime.timedelta(days=-3))
+        purge_deadline = (now + datetime.timedelta(days=-3))
 
         delete_query = Game.delete().where(
-            (Game.expiration < purge_deadline) & (Game.is_pending == 1)
-        )
-
-        # Expired matches that never became full
-        delete_query2 = Game.delete().where(
-            (Game.expiration < datetime.datetime.now()) & (Game.id.in_(Game.subq_open_games_with_capacity())) & (Game.is_pending == 1)
+            (Game.is_pending == 1) & (
+                (Game.expiration < purge_deadline) |
+                ((Game.expiration < now) & (Game.is_full == False))  # Expired matches that never became full
+            )
         )
 
-        logger.info(f'purge_expired_games #1: Purged {delete_query.execute()}  games.')
-        logger.info(f'purge_expired_games #2: Purged {delete_query2.execute()}  games.')
+        purged = delete_query.execute()
+        logger.info(f'purge_expired_games: Purged {purged} games.')
+        return purged
 
     def confirmations_reset(self):
         with db.atomic():
@@ -1995,9 +2296,17 @@ def confirmations_count(self):
         return (confirmed_count, side_count, fully_confirmed)
 
 
+# Partial indexes for the open game list. Only pending games are indexed, so they stay small however many completed games accumulate
+Game.add_index(Game.index(Game.guild_id, Game.is_full, name='game_pending_guild_full', where=(Game.is_pending == True)))
+Game.add_index(Game.index(Game.elo_min, Game.elo_max, Game.global_elo_min, Game.global_elo_max, name='game_pending_elo', where=(Game.is_pending == True)))
+Game.add_index(Game.index(Game.creator, name='game_pending_full_creator', where=((Game.is_pending == True) & (Game.is_full == True))))
+Game.add_index(Game.index(Game.expiration, name='game_pending_expiration', where=(Game.is_pending == True)))
+
+
 class Squad(BaseModel):
     elo = SmallIntegerField(default=1000)
     guild_id = BitField(unique=False, null=False)
+    member_signature = TextField(null=True, unique=True)  # GameSide.signature_for() of the squad's players
 
     def upsert(player_list, guild_id: int):
 
@@ -2005,9 +2314,13 @@ def upsert(player_list, guild_id: int):
 
         if len(squads) == 0:
             # Insert new squad based on this combination of players
-            sq = Squad.create(guild_id=guild_id)
-            for p in player_list:
-                SquadMember.create(player=p, squad=sq)
+            try:
+                with db.atomic():
+                    sq = Squad.create(guild_id=guild_id, member_signature=GameSide.signature_for(player_list))
+                    SquadMember.insert_many([(p, sq) for p in player_list], fields=[SquadMember.player, SquadMember.squad]).execute()
+            except IntegrityError:
+                # Same squad was inserted concurrently
+                return Squad.get_matching_squad(player_list).get()
             return sq
 
         return squads[0]
@@ -2095,12 +2408,9 @@ def leaderboard(date_cutoff, guild_id: int):
 
     def get_matching_squad(player_list):
         # Takes [List, of, Player, Records] (not names)
-        # Returns squad with exactly the same participating players. See https://stackoverflow.com/q/52010522/1281743
-        query = Squad.select().join(SquadMember).group_by(Squad.id).having(
-            (fn.SUM(SquadMember.player.in_(player_list).cast('integer')) == len(player_list)) & (fn.SUM(SquadMember.player.not_in(player_list).cast('integer')) == 0)
-        )
+        # Returns squad with exactly the same participating players, as a lookup on the unique member_signature index
 
-        return query
+        return Squad.select().where(Squad.member_signature == GameSide.signature_for(player_list))
 
     def get_all_matching_squads(player_list, guild_id: int):
         # Takes [List, of, Player, Records] (not names)
@@ -2115,15 +2425,24 @@ def get_all_matching_squads(player_list, guild_id: int):
         else:
             min_games = 2
 
-        squad_with_matching_members = Squad.select().join(SquadMember).group_by(Squad.id).having(
-            (fn.SUM(SquadMember.player.in_(player_list).cast('integer')) == len(player_list))
-        )
+        # Starts from the (player, squad) index on SquadMember, so only squads containing these players are ever grouped
+        squad_with_matching_members = SquadMember.select(SquadMember.squad).where(
+            SquadMember.player.in_(player_list)
+        ).group_by(SquadMember.squad).having(fn.COUNT(fn.DISTINCT(SquadMember.player)) == len(player_list))
 
-        query = GameSide.select(GameSide.squad, fn.COUNT('*').alias('games_played')).where(
-            (GameSide.squad.in_(Squad.subq_squads_by_size(min_size=2))) &
-            (GameSide.squad.in_(Squad.subq_squads_with_completed_games(min_games=min_games))) &
-            (GameSide.squad.in_(squad_with_matching_members))
-        ).group_by(GameSide.squad).order_by(-SQL('games_played'))
+        squads_with_enough_members = SquadMember.select(SquadMember.squad).where(
+            SquadMember.squad.in_(squad_with_matching_members)
+        ).group_by(SquadMember.squad).having(fn.COUNT('*') >= 2)
+
+        if min_games <= 0:
+            # Squads who at least have one in progress game
+            games_filter = fn.SUM((Game.is_pending == 0).cast('integer')) > 0
+        else:
+            games_filter = fn.SUM(Game.is_completed.cast('integer')) >= min_games
+
+        query = GameSide.select(GameSide.squad, fn.COUNT('*').alias('games_played')).join(Game).where(
+            GameSide.squad.in_(squads_with_enough_members)
+        ).group_by(GameSide.squad).having(games_filter).order_by(-SQL('games_played'))
 
         return query
 
@@ -2152,6 +2471,9 @@ class SquadMember(BaseModel):
     player = ForeignKeyField(Player, null=False, on_delete='CASCADE')
     squad = ForeignKeyField(Squad, null=False, backref='squadmembers', on_delete='CASCADE')
 
+    class Meta:
+        indexes = ((('player', 'squad'), False),)   # player -> squads lookups for Squad.get_all_matching_squads
+
 
 class GameSide(BaseModel):
     game = ForeignKeyField(Game, null=False, backref='gamesides', on_delete='CASCADE')
@@ -2169,6 +2491,21 @@ class GameSide(BaseModel):
     position = SmallIntegerField(null=False, unique=False, default=1)
     win_confirmed = BooleanField(default=False)
     team_chan_external_server = BitField(unique=False, null=True, default=None)
+    player_signature = TextField(null=True, index=True)  # GameSide.signature_for() of the side's players, used to find head-to-head games
+    player_count = SmallIntegerField(default=0)  # number of Lineups on this side. Maintained by Game.update_capacity()
+    is_full = BooleanField(default=False)  # player_count >= size
+
+    def signature_for(player_list):
+        # Canonical identifier for a set of players (Player objects or ids) regardless of order - md5 of the sorted, comma-separated player ids
+        # Matches the backfill in migrator.py: md5(string_agg(player_id::text, ',' ORDER BY player_id))
+        player_ids = sorted(p if isinstance(p, int) else p.id for p in player_list)
+        if not player_ids:
+            return None
+        return hashlib.md5(','.join(str(p) for p in player_ids).encode()).hexdigest()
+
+    def update_signature(self):
+        self.player_signature = GameSide.signature_for([l.player_id for l in Lineup.select(Lineup.player).where(Lineup.gameside == self)])
+        self.save()
 
     def has_same_players_as(self, gameside):
         # Given side1.has_same_players_as(side2)
@@ -2232,7 +2569,8 @@ def adjusted_elo(self, missing_players: int, own_elo: int, opponent_elos: int):
         missing_player_elo = own_elo - handicap_elo
         return int(round((own_elo * size + missing_player_elo * missing_players) / (size + missing_players)))
 
-    def name(self):
+    def name(self, game_player_count: int = None):
+        # game_player_count can be passed in by callers that already know it, to avoid loading self.game.lineup
 
         side_players = len(self.lineup)
         if side_players == 0 and self.size == 1:
@@ -2240,9 +2578,12 @@ def name(self):
             return '_____\u200b________\u200b_____'
         elif side_players == 1 and self.size == 1:
             # 1-player side, show player name
-            if len(self.game.lineup) > 10:
+            if game_player_count is None:
+                game_player_count = len(self.game.lineup)
+
+            if game_player_count > 10:
                 return self.lineup[0].player.discord_member.name[:10]
-            elif len(self.game.lineup) > 6:
+            elif game_player_count > 6:
                 return self.lineup[0].player.discord_member.name[:20]
             else:
                 return self.lineup[0].player.name[:30]
@@ -2369,8 +2710,14 @@ def emoji_str(self):
             return ''
 
 
+class GameInvitee(BaseModel):
+    # Players @Mentioned in the notes of an invite-only open game. Maintained by Game.update_restrictions()
+    game = ForeignKeyField(Game, null=False, backref='invitees', on_delete='CASCADE')
+    discord_id = BitField(unique=False, null=False, index=True)
+
+
 with db:
-    db.create_tables([Team, DiscordMember, Game, Player, Tribe, Squad, GameSide, SquadMember, Lineup])
+    db.create_tables([Team, DiscordMember, Game, Player, Tribe, Squad, GameSide, SquadMember, Lineup, GameInvitee])
     # Only creates missing tables so should be safe to run each time
     try:
         # Creates deferred FK http://docs.peewee-orm.com/en/latest/peewee/models.html#circular-foreign-key-dependencies
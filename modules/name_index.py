@@ -0,0 +1,293 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# In-memory name lookups so that resolving a player or member name does not need a database query or a scan of every guild member.
+# This module deliberately does not import models so that models can keep it updated without a circular import.
+
+_lock = threading.RLock()
+_player_indexes = {}  # guild_id: PlayerNameIndex
+player_index_max_age = 60 * 60  # seconds. games_played weights are only refreshed when a guild's index is rebuilt
+rebuild_attempts = 3
+_player_changes = 0  # bumped by every change to player name data, so a rebuild can tell if it missed one while loading
+
+
+class NgramIndex:
+    # Substring search over a collection of short strings. Each string is split into overlapping n-grams and the candidates
+    # for a search term are the intersection of the buckets for each of the term's n-grams, confirmed with a plain 'in' check.
+    # Terms shorter than n fall back to checking every string.
+
+    def __init__(self, n: int = 3):
+        self.n = n
+        self.values = {}  # key: lowercased string
+        self.buckets = {}  # n-gram: set of keys
+
+    def ngrams(self, text: str):
+        return {text[i:i + self.n] for i in range(len(text) - self.n + 1)}
+
+    def add(self, key, text: str):
+        self.remove(key)
+        if text is None:
+            return
+        text = text.lower()
+        self.values[key] = text
+        for gram in self.ngrams(text):
+            self.buckets.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        text = self.values.pop(key, None)
+        if text is None:
+            return
+        for gram in self.ngrams(text):
+            bucket = self.buckets.get(gram)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[gram]
+
+    def search(self, term: str):
+        # returns set of keys whose string contains term, case-insensitive
+        term = term.lower()
+        if len(term) < self.n:
+            return {key for key, text in self.values.items() if term in text}
+
+        candidates = None
+        for gram in sorted(self.ngrams(term), key=lambda g: len(self.buckets.get(g, ()))):
+            bucket = self.buckets.get(gram)
+            if not bucket:
+                return set()
+            candidates = set(bucket) if candidates is None else candidates & bucket
+        return {key for key in candidates if term in self.values[key]}
+
+
+class PlayerNameIndex:
+    # Name data for every Player in one guild, keyed by Player.id, used by models.Player.string_matches()
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.created_at = time.monotonic()
+        self.discord_ids = {}  # discord_id: player_id
+        self.player_discord_ids = {}  # player_id: discord_id
+        self.exact_names = {}  # lowercased discord name: set of player_id
+        self.names = NgramIndex()  # DiscordMember.name
+        self.nicks = NgramIndex()  # Player.nick
+        self.polytopia_ids = NgramIndex()
+        self.polytopia_names = NgramIndex()
+        self.games_played = {}  # player_id: number of games, used to rank substring matches
+
+    def is_stale(self):
+        return time.monotonic() - self.created_at > player_index_max_age
+
+    def add_player(self, player_id: int, discord_id: int, name: str, nick: str, polytopia_id: str, polytopia_name: str, games_played: int = None):
+        with _lock:
+            old_discord_id = self.player_discord_ids.get(player_id)
+            if old_discord_id is not None and old_discord_id != discord_id:
+                self.discord_ids.pop(old_discord_id, None)
+            self.discord_ids[discord_id] = player_id
+            self.player_discord_ids[player_id] = discord_id
+
+            self.set_name(player_id, name)
+            self.nicks.add(player_id, nick)
+            self.polytopia_ids.add(player_id, polytopia_id)
+            self.polytopia_names.add(player_id, polytopia_name)
+            if games_played is not None:
+                self.games_played[player_id] = games_played
+            else:
+                self.games_played.setdefault(player_id, 0)
+
+    def set_name(self, player_id: int, name: str):
+        with _lock:
+            old_name = self.names.values.get(player_id)
+            if old_name is not None:
+                self.exact_names.get(old_name, set()).discard(player_id)
+            self.names.add(player_id, name)
+            if name is not None:
+                self.exact_names.setdefault(name.lower(), set()).add(player_id)
+
+    def player_by_discord_id(self, discord_id: int):
+        with _lock:
+            return self.discord_ids.get(discord_id)
+
+    def exact_name_matches(self, name: str):
+        # case-insensitive equality against DiscordMember.name
+        with _lock:
+            return sorted(self.exact_names.get(name.lower(), ()))
+
+    def substring_matches(self, nick_string: str, name_string: str):
+        # players whose nick contains nick_string or discord name contains name_string, ordered by most games played
+        # games_played is only a ranking hint (it is refreshed when the index is rebuilt or by set_games_played()), so callers
+        # that need to exclude players without games must check that against the database
+        with _lock:
+            matches = self.nicks.search(nick_string) | self.names.search(name_string)
+            return sorted(matches, key=lambda player_id: (-self.games_played.get(player_id, 0), player_id))
+
+    def set_games_played(self, player_id: int, games_played: int):
+        with _lock:
+            if player_id in self.player_discord_ids:
+                self.games_played[player_id] = games_played
+
+    def polytopia_matches(self, term: str):
+        with _lock:
+            return sorted(self.polytopia_ids.search(term) | self.polytopia_names.search(term))
+
+
+def player_index(guild_id: int, loader):
+    # Returns the PlayerNameIndex for a guild, building it the first time it is needed and again once it is older than player_index_max_age
+    # loader(guild_id) must return rows of (player_id, discord_id, discord_name, nick, polytopia_id, polytopia_name, games_played)
+    with _lock:
+        index = _player_indexes.get(guild_id)
+        if index is not None and not index.is_stale():
+            return index
+
+    # Built outside the lock so a rebuild for one guild does not hold up lookups in every other guild. A player change made while
+    # loading may not be in the loaded rows and would be lost when the new index is swapped in, so the load is repeated in that case
+    for attempt in range(1, rebuild_attempts + 1):
+        with _lock:
+            changes_before = _player_changes
+        new_index = PlayerNameIndex(guild_id)
+        for row in loader(guild_id):
+            new_index.add_player(*row)
+
+        with _lock:
+            index = _player_indexes.get(guild_id)
+            if index is not None and not index.is_stale():
+                return index  # another thread finished a rebuild first
+            if _player_changes != changes_before and attempt < rebuild_attempts:
+                logger.debug(f'Player data changed while building player name index for guild {guild_id} - loading again')
+                continue
+            if _player_changes != changes_before:
+                new_index.created_at = float('-inf')  # still used for this lookup, but marked stale so the next one rebuilds it
+            _player_indexes[guild_id] = new_index
+            logger.debug(f'Built player name index for guild {guild_id} with {len(new_index.player_discord_ids)} players')
+            return new_index
+
+
+def note_player_change():
+    global _player_changes
+    with _lock:
+        _player_changes += 1
+
+
+def add_player(player, discord_member):
+    # Called when a Player is created or updated. Guilds whose index has not been built yet will pick the player up when it is
+    with _lock:
+        note_player_change()
+        index = _player_indexes.get(player.guild_id)
+        if index:
+            index.add_player(player.id, discord_member.discord_id, discord_member.name, player.nick,
+                             discord_member.polytopia_id, discord_member.polytopia_name)
+
+
+def update_player_nick(guild_id: int, player_id: int, nick: str):
+    with _lock:
+        note_player_change()
+        index = _player_indexes.get(guild_id)
+        if index and player_id in index.player_discord_ids:
+            index.nicks.add(player_id, nick)
+
+
+def update_discord_member(discord_member):
+    # Name and polytopia fields live on DiscordMember, which is shared by that member's Player in every guild
+    with _lock:
+        note_player_change()
+        for index in _player_indexes.values():
+            player_id = index.discord_ids.get(discord_member.discord_id)
+            if player_id is None:
+                continue
+            index.set_name(player_id, discord_member.name)
+            index.polytopia_ids.add(player_id, discord_member.polytopia_id)
+            index.polytopia_names.add(player_id, discord_member.polytopia_name)
+
+
+def clear_player_indexes():
+    # For changes that are awkward to apply in place, such as moving players between discord accounts
+    with _lock:
+        note_player_change()
+        _player_indexes.clear()
+
+
+_member_indexes = {}  # guild_id: GuildMemberIndex
+
+
+class GuildMemberIndex:
+    # Name and nick lookups for the discord members of one guild, used by utilities.get_guild_member()
+    # Only member ids are stored. Callers resolve them with guild.get_member() so they always get discord.py's current Member object
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.positions = {}  # member_id: insertion order, so results come back in a stable order like guild.members
+        self.names = {}  # member_id: (name.upper(), nick.upper() or None)
+        self.exact_names = {}  # name.upper(): set of member_id
+        self.exact_nicks = {}  # nick.upper(): set of member_id
+        self.full_names = NgramIndex()  # nick + name, same string the old linear search matched substrings against
+        self.counter = 0
+
+    def add_member(self, member_id: int, name: str, nick: str):
+        self.remove_member(member_id)
+        name_upper, nick_upper = name.upper(), nick.upper() if nick else None
+        self.counter += 1
+        self.positions[member_id] = self.counter
+        self.names[member_id] = (name_upper, nick_upper)
+        self.exact_names.setdefault(name_upper, set()).add(member_id)
+        if nick_upper:
+            self.exact_nicks.setdefault(nick_upper, set()).add(member_id)
+        self.full_names.add(member_id, nick_upper + name_upper if nick_upper else name_upper)
+
+    def remove_member(self, member_id: int):
+        names = self.names.pop(member_id, None)
+        if names is None:
+            return
+        name_upper, nick_upper = names
+        self.exact_names.get(name_upper, set()).discard(member_id)
+        if nick_upper:
+            self.exact_nicks.get(nick_upper, set()).discard(member_id)
+        self.full_names.remove(member_id)
+        del self.positions[member_id]
+
+    def ordered(self, member_ids):
+        return sorted(member_ids, key=lambda member_id: self.positions[member_id])
+
+    def exact_name_matches(self, name: str):
+        return self.ordered(self.exact_names.get(name.upper(), ()))
+
+    def search(self, input: str):
+        # Same priority as the original scan of guild.members: exact name matches, then exact nick matches, then substring matches against nick + name
+        input_upper = input.upper()
+        name_matches = self.exact_names.get(input_upper)
+        if name_matches:
+            return self.ordered(name_matches)
+        nick_matches = self.exact_nicks.get(input_upper)
+        if nick_matches:
+            return self.ordered(nick_matches)
+        return self.ordered(self.full_names.search(input_upper))
+
+
+def build_member_index(guild):
+    index = GuildMemberIndex(guild.id)
+    for member in guild.members:
+        index.add_member(member.id, member.name, member.nick)
+    _member_indexes[guild.id] = index
+    logger.debug(f'Built member index for guild {guild.id} with {len(index.names)} members')
+    return index
+
+
+def member_index(guild):
+    # Normally built in on_ready, but built on first use if a guild was missed
+    index = _member_indexes.get(guild.id)
+    if index is None:
+        index = build_member_index(guild)
+    return index
+
+
+def update_member(member):
+    index = _member_indexes.get(member.guild.id)
+    if index:
+        index.add_member(member.id, member.name, member.nick)
+
+
+def remove_member(member):
+    index = _member_indexes.get(member.guild.id)
+    if index:
+        index.remove_member(member.id)
@@ -0,0 +1,270 @@
+import asyncio
+import collections
+import itertools
+import time
+import discord
+import logging
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# Queue for Discord API calls that commands should not have to wait on: channel creation/greeting/renames/deletion, role changes and broadcasts.
+# Callers submit a zero-argument function that returns an awaitable (ie. lambda: chan.edit(name=...)) so that an operation that is
+# coalesced away never creates a coroutine that is not awaited.
+#
+# - Priority lanes: REPLY work that a user is actively waiting on runs ahead of GAME channel traffic, which runs ahead of MAINTENANCE
+# - Routes: every operation names a route such as ('channel_edit', channel_id). Each route has a token bucket sized from route_limits so
+#   the queue holds back work that would only run into a 429 from Discord, and other routes keep moving in the meantime
+# - Coalescing: an operation submitted with the coalesce_key of one that is still queued replaces it in place (ie. a channel renamed
+#   three times in a row is only renamed once, to the final name). Callers of the replaced operation get the result of the new one
+# - Metrics: queue depth per lane, wait and run latency, and counts of completed/failed/coalesced/throttled operations. See stats()
+
+REPLY, GAME, MAINTENANCE = 0, 1, 2
+lane_names = {REPLY: 'reply', GAME: 'game', MAINTENANCE: 'maintenance'}
+
+# route kind: (operations, per seconds). Channel name/topic edits are limited by Discord to 2 per 10 minutes per channel
+route_limits = {
+    'channel_edit': (2, 600),
+    'channel_create': (5, 10),
+    'channel_delete': (5, 10),
+    'member_roles': (10, 10),
+    'send': (5, 5),
+}
+default_route_limit = (5, 5)
+# route kind: operations that may run at once on one route. Routes not listed run one operation at a time
+route_concurrency = {
+    'channel_create': 3,  # lets the channels of a new game be created side by side, per guild
+    'channel_delete': 3,
+    'member_roles': 2,  # role changes for different members of one guild
+}
+worker_count = 4
+bucket_eviction_interval = 60  # seconds between sweeps for idle token buckets
+retry_limit = 2  # times an operation is re-queued after an HTTP 429 from Discord
+
+
+class TokenBucket:
+
+    def __init__(self, capacity: int, per: float):
+        self.capacity = capacity
+        self.rate = capacity / per  # tokens per second
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if now <= self.updated:
+            return  # now can be from before this bucket was created, when a worker's pass creates it
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float):
+        # seconds until a token is available, 0 if one is available now
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self.refill(now)
+        self.tokens -= 1
+
+    def penalize(self, retry_after: float):
+        # after a 429, hold the route for as long as Discord asked
+        self.tokens = min(self.tokens, 0) - retry_after * self.rate
+
+
+class Operation:
+    __slots__ = ('func', 'route', 'lane', 'coalesce_key', 'description', 'futures', 'submitted_at', 'sequence', 'retries', 'throttled')
+
+    def __init__(self, func, route, lane: int, coalesce_key, description: str, sequence: int):
+        self.func = func
+        self.route = route
+        self.lane = lane
+        self.coalesce_key = coalesce_key
+        self.description = description
+        self.futures = [asyncio.get_event_loop().create_future()]
+        self.submitted_at = time.monotonic()
+        self.sequence = sequence
+        self.retries = 0
+        self.throttled = False  # True once it has had to wait on its route's token bucket
+
+
+class OutboundQueue:
+
+    def __init__(self):
+        self.lanes = {lane: collections.deque() for lane in lane_names}
+        self.buckets = {}  # route: TokenBucket. Full buckets for idle routes are dropped by evict_idle_buckets()
+        self.last_eviction = time.monotonic()
+        self.pending = {}  # coalesce_key: queued Operation
+        self.running = collections.Counter()  # route: operations currently running, limited by route_concurrency
+        self.wakeup = None
+        self.workers = []
+        self.sequence = itertools.count()
+
+        self.counts = collections.Counter()  # submitted, completed, failed, coalesced, throttled, retried
+        self.wait_times = collections.deque(maxlen=500)  # seconds from submit to start, most recent operations
+        self.run_times = collections.deque(maxlen=500)
+        self.max_depth = 0
+
+    def start(self):
+        if self.workers:
+            return
+        self.wakeup = asyncio.Event()
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(worker_count)]
+        logger.info(f'Started {worker_count} outbound workers')
+
+    def bucket(self, route):
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            capacity, per = route_limits.get(route[0], default_route_limit)
+            bucket = self.buckets[route] = TokenBucket(capacity, per)
+        return bucket
+
+    def evict_idle_buckets(self, now: float):
+        # A full bucket behaves the same as a new one, so buckets for routes with nothing queued or running can be dropped.
+        # Without this there would be one bucket for every channel the bot ever sent to
+        self.last_eviction = now
+        queued_routes = {op.route for lane in self.lanes.values() for op in lane}
+        idle = [route for route, bucket in self.buckets.items()
+                if route not in queued_routes and route not in self.running and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity]
+        for route in idle:
+            del self.buckets[route]
+        if idle:
+            logger.debug(f'Dropped {len(idle)} idle outbound token buckets, {len(self.buckets)} remain')
+
+    def depth(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def submit(self, func, route, lane: int = MAINTENANCE, coalesce_key=None, description: str = None):
+        # Returns an asyncio.Future for the result of func(). Callers can await it or ignore it
+        self.start()
+        description = description or f'{route[0]} {route[1:]}'
+
+        if coalesce_key is not None and coalesce_key in self.pending:
+            op = self.pending[coalesce_key]
+            op.func, op.description = func, description
+            if lane < op.lane:
+                # promote to the more urgent lane, keeping its place relative to other operations by sequence number
+                self.lanes[op.lane].remove(op)
+                op.lane = lane
+                self.insert(op)
+            future = asyncio.get_event_loop().create_future()
+            op.futures.append(future)
+            self.counts['coalesced'] += 1
+            logger.debug(f'Coalesced outbound operation {description} into queued operation for {coalesce_key}')
+            return future
+
+        op = Operation(func, route, lane, coalesce_key, description, next(self.sequence))
+        if coalesce_key is not None:
+            self.pending[coalesce_key] = op
+        self.lanes[lane].append(op)
+        self.counts['submitted'] += 1
+        self.max_depth = max(self.max_depth, self.depth())
+        self.wakeup.set()
+        return op.futures[0]
+
+    def insert(self, op):
+        lane = self.lanes[op.lane]
+        index = next((i for i, queued in enumerate(lane) if queued.sequence > op.sequence), len(lane))
+        lane.insert(index, op)
+
+    def next_operation(self, now: float):
+        # Returns (Operation, None) for the first runnable operation in priority order, or (None, seconds until one might be runnable)
+        if now - self.last_eviction > bucket_eviction_interval:
+            self.evict_idle_buckets(now)
+
+        soonest = None
+        for lane in sorted(self.lanes):
+            for op in self.lanes[lane]:
+                if self.running[op.route] >= route_concurrency.get(op.route[0], 1):
+                    continue
+                wait = self.bucket(op.route).wait_time(now)
+                if wait == 0:
+                    self.lanes[lane].remove(op)
+                    return op, None
+                if not op.throttled:
+                    op.throttled = True
+                    self.counts['throttled'] += 1  # once per operation that had to wait on a bucket
+                soonest = wait if soonest is None else min(soonest, wait)
+        return None, soonest
+
+    async def worker(self):
+        while True:
+            now = time.monotonic()
+            op, wait = self.next_operation(now)
+            if op is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if op.coalesce_key is not None and self.pending.get(op.coalesce_key) is op:
+                del self.pending[op.coalesce_key]
+            self.running[op.route] += 1
+            self.bucket(op.route).take(now)
+            self.wait_times.append(now - op.submitted_at)
+
+            try:
+                result = await op.func()
+            except discord.HTTPException as e:
+                if e.status == 429 and op.retries < retry_limit:
+                    op.retries += 1
+                    self.counts['retried'] += 1
+                    retry_after = e.response.headers.get('Retry-After') if e.response is not None else None
+                    self.bucket(op.route).penalize(float(retry_after) if retry_after else 5)
+                    logger.warn(f'Outbound operation {op.description} was rate limited. Re-queueing (attempt {op.retries})')
+                    self.insert(op)
+                else:
+                    self.finish(op, exception=e)
+            except Exception as e:
+                self.finish(op, exception=e)
+            else:
+                self.finish(op, result=result)
+            finally:
+                self.running[op.route] -= 1
+                if not self.running[op.route]:
+                    del self.running[op.route]
+                self.run_times.append(time.monotonic() - now)
+                self.wakeup.set()  # another worker may have been waiting on this route
+
+    def finish(self, op, result=None, exception=None):
+        if exception is not None:
+            self.counts['failed'] += 1
+            logger.error(f'Outbound operation {op.description} failed: {exception}')
+        else:
+            self.counts['completed'] += 1
+        for future in op.futures:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+                future.exception()  # mark as retrieved - most callers do not await the future and errors are already logged
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        def summary(samples):
+            if not samples:
+                return (0, 0)
+            return (sum(samples) / len(samples), max(samples))
+
+        return {
+            'depth': {lane_names[lane]: len(ops) for lane, ops in self.lanes.items()},
+            'max_depth': self.max_depth,
+            'running': sum(self.running.values()),
+            'wait': summary(self.wait_times),  # (average seconds, max seconds)
+            'run': summary(self.run_times),
+            'counts': dict(self.counts),
+            'throttled_routes': sum(1 for bucket in self.buckets.values() if bucket.wait_time(time.monotonic()) > 0),
+        }
+
+
+_queue = OutboundQueue()
+
+
+def submit(func, route, lane: int = MAINTENANCE, coalesce_key=None, description: str = None):
+    return _queue.submit(func, route=route, lane=lane, coalesce_key=coalesce_key, description=description)
+
+
+def stats():
+    return _queue.stats()
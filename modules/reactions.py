@@ -0,0 +1,104 @@
+import asyncio
+import time
+import logging
+
+logger = logging.getLogger('polybot.' + __name__)
+
+# Routes reaction_add events to whatever is waiting on reactions to one message, such as a utilities.paginate() embed.
+# bot.wait_for('reaction_add') runs the check of every waiting paginator against every reaction the bot sees, so this keeps
+# one listener per message id instead and a reaction only reaches the listener for its own message.
+# Timeouts are kept on a single timer wheel: listeners are bucketed by the slot their timeout falls in and one task expires
+# a whole slot at a time, rather than every listener holding its own timeout.
+# Events are fed in by the on_reaction_add listener in the games cog.
+
+wheel_resolution = 5  # seconds per timer wheel slot. Listeners can outlive their timeout by up to this much
+
+_listeners = {}  # message_id: ReactionListener
+_wheel = {}  # slot: set of message_id expiring in that slot
+_wheel_task = None
+
+
+class ReactionListener:
+
+    def __init__(self, message_id: int, check, timeout: float):
+        self.message_id = message_id
+        self.check = check  # check(reaction, user) -> bool, same as for bot.wait_for()
+        self.events = asyncio.Queue()
+        self.slot = None
+        self.expired = False
+        self.busy = False  # True from when wait() returns an event until the next wait(), while the caller handles it
+        self.reset_timeout(timeout)
+
+    def reset_timeout(self, timeout: float):
+        slot = int((time.monotonic() + timeout) // wheel_resolution) + 1
+        if slot == self.slot:
+            return
+        if self.slot is not None:
+            _wheel.get(self.slot, set()).discard(self.message_id)
+        self.slot = slot
+        _wheel.setdefault(slot, set()).add(self.message_id)
+
+    async def wait(self, timeout: float):
+        # Returns the next (reaction, user) that passed check, or raises asyncio.TimeoutError if none arrived within timeout
+        if self.expired:
+            raise asyncio.TimeoutError
+        self.busy = False
+        self.reset_timeout(timeout)
+        event = await self.events.get()
+        if event is None:
+            raise asyncio.TimeoutError
+        self.busy = True
+        return event
+
+    def is_idle(self):
+        return not self.busy and self.events.empty()
+
+
+def listen(message_id: int, check, timeout: float):
+    # Callers should stop_listening() when done, normally in a finally block
+    global _wheel_task
+    stop_listening(message_id)
+    listener = ReactionListener(message_id, check, timeout)
+    _listeners[message_id] = listener
+    if _wheel_task is None or _wheel_task.done():
+        _wheel_task = asyncio.ensure_future(run_wheel())
+    return listener
+
+
+def stop_listening(message_id: int):
+    listener = _listeners.pop(message_id, None)
+    if listener is not None:
+        _wheel.get(listener.slot, set()).discard(message_id)
+
+
+def dispatch(reaction, user):
+    listener = _listeners.get(reaction.message.id)
+    if listener is None or listener.expired:
+        return
+    try:
+        if listener.check(reaction, user):
+            listener.events.put_nowait((reaction, user))
+    except Exception as e:
+        logger.error(f'Error in reaction check for message {reaction.message.id}: {e}')
+
+
+def expire_slots(now: float):
+    # Only idle listeners are expired. One that is handling a reaction, or has one waiting, is moved to the next slot instead
+    current_slot = int(now // wheel_resolution)
+    for slot in [slot for slot in _wheel if slot <= current_slot]:
+        for message_id in _wheel.pop(slot):
+            listener = _listeners.get(message_id)
+            if listener is None or listener.slot != slot:
+                continue
+            if not listener.is_idle():
+                listener.slot = current_slot + 1
+                _wheel.setdefault(listener.slot, set()).add(message_id)
+                continue
+            listener.expired = True
+            listener.events.put_nowait(None)
+
+
+async def run_wheel():
+    while _listeners:
+        await asyncio.sleep(wheel_resolution)
+        expire_slots(time.monotonic())
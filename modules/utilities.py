@@ -1,11 +1,13 @@
 import discord
-from discord.ext import commands
 import logging
 import asyncio
 import settings
 import modules.models as models
+import modules.name_index as name_index
+import modules.outbound as outbound
+import modules.reactions as reactions
 import re
-# import peewee
+import peewee
 
 logger = logging.getLogger('polybot.' + __name__)
 
@@ -22,13 +24,49 @@ def connect():
 async def buffered_send(destination, content, max_length=2000):
     # use to replace await ctx.send(message) if message could potentially be over the Discord limit of 2000 characters
     # will split message by \n characters and send in chunks up to max_length size
-    paginator = commands.Paginator(prefix='', suffix='', max_size=max_length)
-
-    for line in content.split('\n'):
-        paginator.add_line(line)
+    await buffered_send_lines(destination, content.split('\n'), max_length=max_length)
+
+
+async def buffered_send_lines(destination, lines, max_length=2000):
+    # Streaming version of buffered_send(). lines can be any iterable or async iterable of strings
+    # A plain iterable is consumed on the event loop, so if producing a line blocks (ie. runs a query) pass an async generator that awaits an executor instead
+    # Each page is queued on the outbound queue as soon as it is full, so earlier pages are sent while later lines are still being produced
+    # Pages to one channel are sent one at a time in the order they were queued. Returns once every page has been sent
+    channel_id = getattr(destination, 'channel', destination).id  # destination is a Context or a channel
+    page_futures = []
+    page, page_length = [], 0
+
+    async def queue_page():
+        content = '\n'.join(page)
+        page_futures.append(outbound.submit(lambda: destination.send(content), route=('send', channel_id), lane=outbound.REPLY,
+                                            description=f'page {len(page_futures) + 1} to channel {channel_id}'))
+        await asyncio.sleep(0)  # let the queue start on it before producing the next page
+
+    async def add_line(line):
+        nonlocal page, page_length
+        while len(line) > max_length:
+            # same limit commands.Paginator enforces, but split instead of raising
+            await add_line(line[:max_length])
+            line = line[max_length:]
+        if page and page_length + len(line) + 1 > max_length:
+            await queue_page()
+            page, page_length = [], 0
+        page.append(line)
+        page_length += len(line) + 1
+
+    if hasattr(lines, '__aiter__'):
+        async for line in lines:
+            await add_line(line)
+    else:
+        for line in lines:
+            await add_line(line)
+    if page:
+        await queue_page()
 
-    for page in paginator.pages:
-        await destination.send(page)
+    results = await asyncio.gather(*page_futures, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logger.error(f'{len(errors)} of {len(results)} pages could not be sent to channel {channel_id}: {errors[0]}')
 
 
 def escape_role_mentions(input: str):
@@ -80,16 +118,18 @@ def string_to_user_id(input):
 async def get_guild_member(ctx, input):
 
     # Find matching Guild member by @Mention or Name. Fall back to case-insensitive search
+    # Name lookups go through the guild's name_index.GuildMemberIndex rather than scanning ctx.guild.members
     # TODO: use exceptions.NoSingleMatch etc like Player.get_or_except()
 
-    name_matches, nick_matches, substring_matches = [], [], []
-
     user_id_match = string_to_user_id(input)
     if user_id_match:
         result = ctx.guild.get_member(user_id_match) or discord.utils.get(ctx.message.mentions, id=user_id_match)
         if result:
             # input is a user id or mention, and a member matching that ID was retrieved
             return [result]
+
+    index = name_index.member_index(ctx.guild)
+
     if len(input) > 5 and input[-5] == '#':
         # The 5 length is checking to see if #0000 is in the string,
         # as a#0000 has a length of 6, the minimum for a potential
@@ -98,32 +138,17 @@ async def get_guild_member(ctx, input):
 
         # do the actual lookup and return if found
         # if it isn't found then we'll do a full name lookup below.
-        result = discord.utils.get(ctx.guild.members, name=input[:-5], discriminator=potential_discriminator)
-        if result is not None:
-            return [result]
+        for member_id in index.exact_name_matches(input[:-5]):
+            result = ctx.guild.get_member(member_id)
+            if result and result.name == input[:-5] and result.discriminator == potential_discriminator:
+                return [result]
 
     # No matches by user ID or Name#Discriminator. Move on to name/nick matches
+    # exact name matches first, exact nick matches second, lastly partial matches against nick or name equally weighted
 
     input = input.strip('@')  # Attempt to handle fake @Mentions that sometimes slip through
-    for p in ctx.guild.members:
-
-        if p.name.upper() == input.upper():
-            name_matches.append(p)
-        elif p.nick and p.nick.upper() == input.upper():
-            nick_matches.append(p)
-        else:
-            full_name_str = p.nick.upper() + p.name.upper() if p.nick else p.name.upper()
-            if input.upper() in full_name_str:
-                substring_matches.append(p)
-
-    if name_matches:
-        # prioritize exact name matches first
-        return name_matches
-    if nick_matches:
-        # prioritize exact nick matches second
-        return nick_matches
-    # lastly, partial matches against nick or name equally weighted
-    return substring_matches
+    members = [ctx.guild.get_member(member_id) for member_id in index.search(input)]
+    return [member for member in members if member]
 
 
 def get_matching_roles(discord_member, list_of_role_names):
@@ -135,32 +160,26 @@ def get_matching_roles(discord_member, list_of_role_names):
 def summarize_game_list(games_query):
     # Turns a list/query-result of several games (or GameSide) into a List of Tuples that can be sent to the pagination function
     # ie. [('Game 330   :nauseated_face: DrippyIsGod vs Nelluk :spy: Mountain Of Songs', '2018-10-05 - 1v1 - WINNER: Nelluk')]
-    game_list = []
+    # Games, sides, teams, lineups, players and discord members are all loaded by a single prefetch() and every string is built
+    # from those objects in memory, so the number of queries does not grow with the number of games
+    # In case a list of GameSide is passed instead of a list of Games. game_id is the foreign key column, so no query per side
+    game_ids = [game.game_id if isinstance(game, models.GameSide) else game.id for game in games_query]
 
-    # for counter, game in enumerate(games_query):
-    # for game in peewee.prefetch(games_query, models.GameSide):
-    for game in games_query:
-        if isinstance(game, models.GameSide):
-            game = game.game  # In case a list of GameSide is passed instead of a list of Games
-
-        if game.is_pending:
-            status_str = 'Not Started'
-        elif game.is_completed is False:
-            status_str = 'Incomplete'
-        else:
-            if game.is_confirmed is False:
-                (confirmed_count, side_count, _) = game.confirmations_count()
-                if side_count > 2:
-                    status_str = f'**WINNER** (Unconfirmed by {side_count - confirmed_count} of {side_count}): {game.winner.name()}'
-                else:
-                    status_str = f'**WINNER** (Unconfirmed): {game.winner.name()}'
-            else:
-                status_str = f'**WINNER:** {game.winner.name()}'
+    if not game_ids:
+        return []
+
+    games = models.Game.select().where(models.Game.id.in_(game_ids))
+    subq = models.GameSide.select(models.GameSide, models.Team).join(models.Team, peewee.JOIN.LEFT_OUTER)
+    subq2 = models.Lineup.select(models.Lineup, models.Player, models.DiscordMember).join(models.Player).join(models.DiscordMember)
+    games_by_id = {game.id: game for game in peewee.prefetch(games, subq, subq2)}
 
+    game_list = []
+    for game_id in game_ids:
+        game = games_by_id[game_id]
         rank_str = 'Unranked - ' if not game.is_ranked else ''
         game_list.append((
             f'{game.get_headline()}'[:255],
-            f'{(str(game.date))} - {rank_str}{game.size_string()} - {status_str}'
+            f'{(str(game.date))} - {rank_str}{game.size_string()} - {game.get_game_status_string()}'
         ))
         # logger.debug(f'Parsed game {game_list[-1]}')
     return game_list
@@ -197,81 +216,133 @@ async def paginate(bot, ctx, title, message_list, page_start=0, page_end=10, pag
     # Allows user to page through a long list of messages with reactions
     # message_list should be a [(List of, two-item tuples)]. Each tuple will be split into an embed field name/value
 
+    async def get_page(start, end):
+        return message_list[start:end]
+
     page_end = page_end if len(message_list) > page_end else len(message_list)
+    await paginate_pages(bot, ctx, title, get_page, item_count=len(message_list), page_start=page_start, page_end=page_end, page_size=page_size)
+
+
+async def paginate_lazy(bot, ctx, title, page_provider, item_count, page_size=10):
+    # Same reaction interface as paginate(), but pages are only built when someone asks to see them
+    # page_provider(offset, limit) should return a [(List of, two-item tuples)] for that slice, ie. by formatting query.offset(offset).limit(limit)
+    # It is run in an executor since it will usually hit the database. Once a page is shown the page after it is loaded in the background
+
+    pages = {}
+
+    def load_page(start, end):
+        connect()
+        return page_provider(start, end - start)
+
+    def page_done(future):
+        # retrieves the error of a prefetched page that nobody awaited, so it is logged once instead of as 'exception was never retrieved'
+        if not future.cancelled() and future.exception():
+            logger.warn(f'Error loading page of {title}: {future.exception()}')
+
+    def request_page(start, end):
+        if (start, end) not in pages:
+            pages[(start, end)] = bot.loop.run_in_executor(None, load_page, start, end)
+            pages[(start, end)].add_done_callback(page_done)
+        return pages[(start, end)]
+
+    async def get_page(start, end):
+        entries = await request_page(start, end)
+        if end < item_count:
+            request_page(end, min(end + page_size, item_count))
+        return entries
+
+    try:
+        await paginate_pages(bot, ctx, title, get_page, item_count=item_count, page_start=0, page_end=min(page_size, item_count), page_size=page_size)
+    finally:
+        for future in pages.values():
+            future.cancel()  # prefetches nobody will look at. No-op for pages already loaded
+
+
+async def paginate_pages(bot, ctx, title, get_page, item_count, page_start, page_end, page_size):
+    # Reaction loop shared by paginate() and paginate_lazy()
+    # get_page(start, end) is a coroutine returning the (name, value) tuples for entries start through end - 1
 
     first_loop = True
     reaction, user = None, None
+    listener = None
+
+    def check(reaction, user):
+        # Reads page_start/page_end from the enclosing function, so it always checks against the page currently shown
+        e = str(reaction.emoji)
+        compare = False
+        if page_size < item_count:
+            if page_start > 0 and e in '⏪⬅':
+                compare = True
+            elif page_end < item_count and e in '➡⏩':
+                compare = True
+        return ((user == ctx.message.author) and compare)
 
-    while True:
-        embed = discord.Embed(title=title)
-        for entry in range(page_start, page_end):
-            embed.add_field(name=message_list[entry][0], value=message_list[entry][1], inline=False)
-        if page_size < len(message_list):
-            embed.set_footer(text=f'{page_start + 1} - {page_end} of {len(message_list)}')
-
-        if first_loop is True:
-            sent_message = await ctx.send(embed=embed)
-            if len(message_list) > page_size:
-                await sent_message.add_reaction('⏪')
-                await sent_message.add_reaction('⬅')
-                await sent_message.add_reaction('➡')
-                await sent_message.add_reaction('⏩')
+    try:
+        while True:
+            embed = discord.Embed(title=title)
+            for entry in await get_page(page_start, page_end):
+                embed.add_field(name=entry[0], value=entry[1], inline=False)
+            if page_size < item_count:
+                embed.set_footer(text=f'{page_start + 1} - {page_end} of {item_count}')
+
+            if first_loop is True:
+                sent_message = await ctx.send(embed=embed)
+                if item_count > page_size:
+                    # reactions.dispatch() only passes this listener reactions on sent_message
+                    listener = reactions.listen(sent_message.id, check, timeout=45.0)
+                    await sent_message.add_reaction('⏪')
+                    await sent_message.add_reaction('⬅')
+                    await sent_message.add_reaction('➡')
+                    await sent_message.add_reaction('⏩')
+                else:
+                    return
             else:
-                return
-        else:
-            try:
-                await reaction.remove(user)
-            except (discord.ext.commands.errors.CommandInvokeError, discord.errors.Forbidden):
-                logger.warn('Unable to remove message reaction due to insufficient permissions. Giving bot \'Manage Messages\' permission will improve usability.')
-            await sent_message.edit(embed=embed)
-
-        def check(reaction, user):
-            e = str(reaction.emoji)
-            compare = False
-            if page_size < len(message_list):
-                if page_start > 0 and e in '⏪⬅':
-                    compare = True
-                elif page_end < len(message_list) and e in '➡⏩':
-                    compare = True
-            return ((user == ctx.message.author) and (reaction.message.id == sent_message.id) and compare)
-
-        try:
-            reaction, user = await bot.wait_for('reaction_add', timeout=45.0, check=check)
-        except asyncio.TimeoutError:
+                try:
+                    await reaction.remove(user)
+                except (discord.ext.commands.errors.CommandInvokeError, discord.errors.Forbidden):
+                    logger.warn('Unable to remove message reaction due to insufficient permissions. Giving bot \'Manage Messages\' permission will improve usability.')
+                await sent_message.edit(embed=embed)
+
             try:
-                await sent_message.clear_reactions()
-            except (discord.ext.commands.errors.CommandInvokeError, discord.errors.Forbidden):
-                logger.warn('Unable to clear message reaction due to insufficient permissions. Giving bot \'Manage Messages\' permission will improve usability.')
-            finally:
-                break
-        else:
-
-            if '⏪' in str(reaction.emoji):
-                # all the way to beginning
-                page_start = 0
-                page_end = page_start + page_size
-
-            if '⏩' in str(reaction.emoji):
-                # last page
-                page_end = len(message_list)
-                page_start = page_end - page_size
-
-            if '➡' in str(reaction.emoji):
-                # next page
-                page_start = page_start + page_size
-                page_end = page_start + page_size
-
-            if '⬅' in str(reaction.emoji):
-                # previous page
-                page_start = page_start - page_size
-                page_end = page_start + page_size
-
-            if page_start < 0:
-                page_start = 0
-                page_end = page_start + page_size
-
-            if page_end > len(message_list):
-                page_end = len(message_list)
-                page_start = page_end - page_size if (page_end - page_size) >= 0 else 0
-
-            first_loop = False
+                reaction, user = await listener.wait(timeout=45.0)
+            except asyncio.TimeoutError:
+                try:
+                    await sent_message.clear_reactions()
+                except (discord.ext.commands.errors.CommandInvokeError, discord.errors.Forbidden):
+                    logger.warn('Unable to clear message reaction due to insufficient permissions. Giving bot \'Manage Messages\' permission will improve usability.')
+                finally:
+                    break
+            else:
+
+                if '⏪' in str(reaction.emoji):
+                    # all the way to beginning
+                    page_start = 0
+                    page_end = page_start + page_size
+
+                if '⏩' in str(reaction.emoji):
+                    # last page
+                    page_end = item_count
+                    page_start = page_end - page_size
+
+                if '➡' in str(reaction.emoji):
+                    # next page
+                    page_start = page_start + page_size
+                    page_end = page_start + page_size
+
+                if '⬅' in str(reaction.emoji):
+                    # previous page
+                    page_start = page_start - page_size
+                    page_end = page_start + page_size
+
+                if page_start < 0:
+                    page_start = 0
+                    page_end = page_start + page_size
+
+                if page_end > item_count:
+                    page_end = item_count
+                    page_start = page_end - page_size if (page_end - page_size) >= 0 else 0
+
+                first_loop = False
+    finally:
+        if listener is not None:
+            reactions.stop_listening(listener.message_id)
@@ -0,0 +1,82 @@
+from peewee import PostgresqlDatabase
+from timeit import default_timer as timer
+import argparse
+import random
+import settings
+
+# Compares Game.search(title_filter=...) style ILIKE '%term%' lookups against a synthetic copy of the game table,
+# first as a sequential scan and then using the pg_trgm GIN indexes created in migrator.py.
+# Everything happens in a TEMP table so the real game table is never touched.
+# usage: python search_benchmark.py --rows 500000 --queries 50
+
+db = PostgresqlDatabase(settings.psql_db, user=settings.psql_user)
+
+
+def setup_table(rows: int):
+    db.execute_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+    db.execute_sql('DROP TABLE IF EXISTS game_search_benchmark;')
+    db.execute_sql('CREATE TEMP TABLE game_search_benchmark (id serial PRIMARY KEY, name text, notes text);')
+    db.execute_sql(
+        """INSERT INTO game_search_benchmark (name, notes)
+           SELECT 'Game ' || substr(md5(random()::text), 1, 10) || ' ' || substr(md5(random()::text), 1, 6),
+                  CASE WHEN random() < 0.4 THEN 'Notes ' || substr(md5(random()::text), 1, 20) ELSE NULL END
+           FROM generate_series(1, %s);""", (rows,))
+    db.execute_sql('ANALYZE game_search_benchmark;')
+
+
+def sample_terms(count: int):
+    # Pick substrings of real rows so every query has at least one hit, similar to users searching for a known game
+    cursor = db.execute_sql('SELECT name FROM game_search_benchmark ORDER BY random() LIMIT %s;', (count,))
+    terms = []
+    for (name,) in cursor.fetchall():
+        word = random.choice(name.split()[1:])
+        start = random.randint(0, max(len(word) - 4, 0))
+        terms.append(word[start:start + 4])
+    return terms
+
+
+def run_queries(terms):
+    sql = 'SELECT id FROM game_search_benchmark WHERE name ILIKE %s OR notes ILIKE %s;'
+    start = timer()
+    for term in terms:
+        pattern = f'%{term}%'
+        db.execute_sql(sql, (pattern, pattern)).fetchall()
+    return (timer() - start) / len(terms)
+
+
+def query_plan(term):
+    pattern = f'%{term}%'
+    cursor = db.execute_sql('EXPLAIN SELECT id FROM game_search_benchmark WHERE name ILIKE %s OR notes ILIKE %s;', (pattern, pattern))
+    return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500000, help='Number of synthetic games to generate')
+    parser.add_argument('--queries', type=int, default=50, help='Number of title searches to time')
+    args = parser.parse_args()
+
+    with db:
+        print(f'Generating {args.rows} synthetic games...')
+        start = timer()
+        setup_table(args.rows)
+        print(f'Generated in {timer() - start:.1f}s')
+        terms = sample_terms(args.queries)
+
+        unindexed = run_queries(terms)
+        print(f'\nWithout trigram indexes: {unindexed * 1000:.2f}ms per search')
+        print(query_plan(terms[0]))
+
+        start = timer()
+        db.execute_sql('CREATE INDEX ON game_search_benchmark USING gin (name gin_trgm_ops);')
+        db.execute_sql('CREATE INDEX ON game_search_benchmark USING gin (notes gin_trgm_ops);')
+        db.execute_sql('ANALYZE game_search_benchmark;')
+        print(f'\nBuilt trigram indexes in {timer() - start:.1f}s')
+
+        indexed = run_queries(terms)
+        print(f'With trigram indexes: {indexed * 1000:.2f}ms per search ({unindexed / indexed:.1f}x faster)')
+        print(query_plan(terms[0]))
+
+
+if __name__ == '__main__':
+    main()